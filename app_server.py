@@ -6,6 +6,7 @@ import json
 import os
 import sys
 import subprocess
+import collections
 from lxml import etree
 from functools import wraps
 from flask import url_for, make_response
@@ -73,9 +74,10 @@ def entry_response(entry, cache_for=AcquisitionFeed.FEED_CACHE_TIME):
     return _make_response(entry, content_type, cache_for)
 
 def _make_response(content, content_type, cache_for):
+    streaming = isinstance(content, collections.Iterator)
     if isinstance(content, etree._Element):
         content = etree.tostring(content)
-    elif not isinstance(content, basestring):
+    elif not isinstance(content, basestring) and not streaming:
         content = unicode(content)
 
     if isinstance(cache_for, int):
@@ -88,8 +90,15 @@ def _make_response(content, content_type, cache_for):
     else:
         cache_control = "private, no-cache"
 
-    return make_response(content, 200, {"Content-Type": content_type,
-                                        "Cache-Control": cache_control})
+    headers = {"Content-Type": content_type, "Cache-Control": cache_control}
+    if streaming:
+        # An iterator over chunks, e.g. from AcquisitionFeed.page(stream=True).
+        # Send each chunk to the client as soon as it's generated. The
+        # chunks are generated from the request's database session, so
+        # the request isn't torn down until the last one has gone out.
+        content = flask.stream_with_context(content)
+        return flask.Response(content, 200, headers)
+    return make_response(content, 200, headers)
 
 def load_facets_from_request(config=Configuration):
     """Figure out which Facets object this request is asking for."""
@@ -110,7 +119,8 @@ def load_pagination_from_request(default_size=Pagination.DEFAULT_SIZE):
     arg = flask.request.args.get
     size = arg('size', default_size)
     offset = arg('after', 0)
-    return load_pagination(size, offset)
+    key = arg('key', None)
+    return load_pagination(size, offset, key)
 
 def load_facets(order, availability, collection, config=Configuration):
     """Turn user input into a Facets object."""
@@ -143,7 +153,7 @@ def load_facets(order, availability, collection, config=Configuration):
         collection=collection, availability=availability, order=order
     )
 
-def load_pagination(size, offset):
+def load_pagination(size, offset, key=None):
     """Turn user input into a Pagination object."""
     try:
         size = int(size)
@@ -155,7 +165,14 @@ def load_pagination(size, offset):
             offset = int(offset)
         except ValueError:
             return INVALID_INPUT.detailed(_("Invalid offset: %(offset)s", offset=offset))
-    return Pagination(offset, size)
+    if key:
+        try:
+            key = Pagination.decode_key(key)
+        except ValueError:
+            return INVALID_INPUT.detailed(_("Invalid pagination key: %(key)s", key=key))
+    else:
+        key = None
+    return Pagination(offset, size, key)
 
 def returns_problem_detail(f):
     @wraps(f)
@@ -18,6 +18,7 @@ from util.http import (
     HTTP,
     RemoteIntegrationException,
 )
+from rate_limit import RateLimiter
 from coverage import CoverageFailure
 from model import (
     Contributor,
@@ -57,6 +58,9 @@ class Axis360API(object):
     def __init__(self, _db, username=None, library_id=None, password=None,
                  base_url=None):
         self._db = _db
+        self.rate_limiter = RateLimiter.for_integration(
+            Configuration.AXIS_INTEGRATION
+        )
         (env_library_id, env_username, 
          env_password, env_base_url) = self.environment_values()
             
@@ -185,7 +189,7 @@ class Axis360API(object):
         """Actually make an HTTP request."""
         return HTTP.request_with_timeout(
             method, url, headers=headers, data=data,
-            params=params, **kwargs
+            params=params, rate_limiter=self.rate_limiter, **kwargs
         )
 
 
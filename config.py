@@ -100,6 +100,21 @@ class Configuration(object):
     GROUPS_MAX_AGE_POLICY = "default_groups_max_age" 
     DEFAULT_GROUPS_MAX_AGE = CACHE_FOREVER
 
+    # The in-process cache in front of the cachedfeeds table. It's
+    # disabled unless given a size in bytes.
+    FEED_MEMORY_CACHE_SIZE_POLICY = "feed_memory_cache_size"
+    DEFAULT_FEED_MEMORY_CACHE_SIZE = 0
+
+    # How long a worker may serve a feed from its in-process cache
+    # without checking the database for a newer version.
+    FEED_MEMORY_CACHE_MAX_AGE_POLICY = "feed_memory_cache_max_age"
+    DEFAULT_FEED_MEMORY_CACHE_MAX_AGE = 60
+
+    # How many worker processes to use when scaling a batch of cover
+    # images. 0 means scale everything in this process.
+    THUMBNAIL_PROCESSES_POLICY = "thumbnail_processes"
+    DEFAULT_THUMBNAIL_PROCESSES = 0
+
     # Loan policies
     DEFAULT_LOAN_PERIOD = "default_loan_period"
     DEFAULT_RESERVATION_PERIOD = "default_reservation_period"
@@ -138,9 +153,44 @@ class Configuration(object):
     OVERDRIVE_INTEGRATION = "Overdrive"
     THREEM_INTEGRATION = "3M"
 
+    # How many requests may be made to an integration's API at once.
+    MAX_CONCURRENT_REQUESTS = "max_concurrent_requests"
+
+    # How many requests per second may be made to an integration's
+    # API, by all the processes on this host together, and how many
+    # may be made at once after a quiet spell.
+    MAX_REQUESTS_PER_SECOND = "max_requests_per_second"
+    REQUEST_BURST = "request_burst"
+
+    # The longest, in seconds, that a request to an integration's API
+    # may wait for its turn before giving up. If this isn't set,
+    # requests wait as long as they have to, except while handling a
+    # web request.
+    RATE_LIMIT_MAX_WAIT = "rate_limit_max_wait"
+
     MINIMUM_FEATURED_QUALITY = "minimum_featured_quality"
     FEATURED_LANE_SIZE = "featured_lane_size"
 
+    # How many database connections to use at once when finding
+    # featured works for the sublanes of a groups feed. 0 means one
+    # sublane at a time, using the lane's own session.
+    SUBLANE_SAMPLING_THREADS = "sublane_sampling_threads"
+
+    # Sweep monitors and work processing scripts can split their work
+    # among this many processes.
+    SWEEP_PROCESSES = "sweep_processes"
+
+    # Representations at least this many bytes long are kept in the
+    # blob store under the data directory rather than in the database.
+    # If this is not set, everything is kept in the database.
+    REPRESENTATION_BLOB_THRESHOLD = "representation_blob_threshold"
+
+    # How many connections to keep open to each host we make HTTP
+    # requests to, and how many times to retry a request that
+    # couldn't connect or got a 502, 503 or 504 response.
+    HTTP_POOL_SIZE = "http_pool_size"
+    HTTP_MAX_RETRIES = "http_max_retries"
+
     S3_INTEGRATION = "S3"
     S3_ACCESS_KEY = "access_key"
     S3_SECRET_KEY = "secret_key"
@@ -286,6 +336,28 @@ class Configuration(object):
             return value
         return datetime.timedelta(seconds=int(value))
 
+    @classmethod
+    def feed_memory_cache_size(cls):
+        return int(cls.policy(
+            cls.FEED_MEMORY_CACHE_SIZE_POLICY,
+            cls.DEFAULT_FEED_MEMORY_CACHE_SIZE
+        ))
+
+    @classmethod
+    def feed_memory_cache_max_age(cls):
+        value = cls.policy(
+            cls.FEED_MEMORY_CACHE_MAX_AGE_POLICY,
+            cls.DEFAULT_FEED_MEMORY_CACHE_MAX_AGE
+        )
+        return datetime.timedelta(seconds=int(value))
+
+    @classmethod
+    def thumbnail_processes(cls):
+        return int(cls.policy(
+            cls.THUMBNAIL_PROCESSES_POLICY,
+            cls.DEFAULT_THUMBNAIL_PROCESSES
+        ))
+
     @classmethod
     def base_opds_authentication_document(cls):
         return cls.get(cls.BASE_OPDS_AUTHENTICATION_DOCUMENT, {})
@@ -303,6 +375,29 @@ class Configuration(object):
     def featured_lane_size(cls):
         return int(cls.policy(cls.FEATURED_LANE_SIZE, 15))
 
+    @classmethod
+    def sublane_sampling_threads(cls):
+        return int(cls.policy(cls.SUBLANE_SAMPLING_THREADS, 0))
+
+    @classmethod
+    def sweep_processes(cls):
+        return int(cls.policy(cls.SWEEP_PROCESSES, 1))
+
+    @classmethod
+    def http_pool_size(cls):
+        return int(cls.policy(cls.HTTP_POOL_SIZE, 10))
+
+    @classmethod
+    def http_max_retries(cls):
+        return int(cls.policy(cls.HTTP_MAX_RETRIES, 2))
+
+    @classmethod
+    def representation_blob_threshold(cls):
+        threshold = cls.policy(cls.REPRESENTATION_BLOB_THRESHOLD, None)
+        if threshold is None:
+            return None
+        return int(threshold)
+
     @classmethod
     def show_staff_picks_on_top_level(cls):
         return cls.policy(cls.SHOW_STAFF_PICKS_ON_TOP_LEVEL, default=True)
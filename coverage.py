@@ -1,10 +1,13 @@
 from nose.tools import set_trace
 import datetime
 import logging
+from multiprocessing.pool import ThreadPool
+import traceback
 
 from sqlalchemy.orm.session import Session
 from sqlalchemy.sql.functions import func
 
+from config import Configuration
 from model import (
     get_one,
     get_one_or_create,
@@ -21,6 +24,7 @@ from model import (
 from metadata_layer import (
     ReplacementPolicy
 )
+from util import estimate_query_count
 
 import log # This sets the appropriate log format.
 
@@ -85,6 +89,17 @@ class BaseCoverageProvider(object):
     coverage records are WorkCoverageRecord objects.
     """
 
+    # If the items that need coverage can be ordered by this column,
+    # run_once() will page through them by ID rather than by offset.
+    ID_COLUMN = None
+
+    # Counting the items that need coverage can take longer than
+    # processing a batch. Unless this is set, the number of items is
+    # only estimated, at the start of a run and every
+    # ESTIMATE_INTERVAL batches.
+    EXACT_COUNT = False
+    ESTIMATE_INTERVAL = 50
+
     def __init__(self, _db, service_name, operation, batch_size=100, 
                  cutoff_time=None):
         """Constructor.
@@ -103,6 +118,7 @@ class BaseCoverageProvider(object):
         self.operation = operation
         self.batch_size = batch_size
         self.cutoff_time = cutoff_time
+        self.batches_run = 0
 
     @property
     def log(self):
@@ -178,17 +194,41 @@ class BaseCoverageProvider(object):
         return (successes, transient_failures, persistent_failures), records
 
     def run_once(self, offset, count_as_covered=None):
+        """Process one batch of items that need coverage.
+
+        :param offset: Where the last batch left off. If the items can
+        be ordered by ID, this is the ID of the last item processed.
+        Otherwise it's an offset into the list of items that need
+        coverage. Start with 0.
+
+        :return: Where the next batch should start, or None if there
+        are no more items to process.
+        """
         count_as_covered = count_as_covered or BaseCoverageRecord.DEFAULT_COUNT_AS_COVERED
         # Make it clear which class of items we're covering on this
         # run.
         count_as_covered_message = '(counting %s as covered)' % (', '.join(count_as_covered))
 
         qu = self.items_that_need_coverage(count_as_covered=count_as_covered)
-        self.log.info("%d items need coverage%s", qu.count(), 
-                      count_as_covered_message)
-        batch = qu.limit(self.batch_size).offset(offset)
+        self.log_item_count(qu, offset, count_as_covered_message)
+        self.batches_run += 1
+
+        if self.pages_by_id(qu):
+            qu = qu.filter(self.ID_COLUMN > offset).order_by(self.ID_COLUMN)
+            batch = qu.limit(self.batch_size).all()
+            if not batch:
+                # The batch is empty. We're done.
+                return None
+            self.process_batch_and_handle_results(batch)
+
+            # Whatever happened to the items in this batch, the next
+            # batch starts after them, so each item is only processed
+            # once per run.
+            return batch[-1].id
+
+        batch = qu.limit(self.batch_size).offset(offset).all()
 
-        if not batch.count():
+        if not batch:
             # The batch is empty. We're done.
             return None
         (successes, transient_failures, persistent_failures), results = (
@@ -215,6 +255,31 @@ class BaseCoverageProvider(object):
         
         return offset
 
+    def pages_by_id(self, qu):
+        """Can run_once() page through this query by ID?
+
+        Only if the query finds the objects that own ID_COLUMN;
+        otherwise filtering on ID_COLUMN would turn it into a cross join.
+        """
+        if self.ID_COLUMN is None:
+            return False
+        entity = qu.column_descriptions[0]['entity']
+        return entity is self.ID_COLUMN.class_
+
+    def log_item_count(self, qu, offset, message):
+        """Log how many items need coverage.
+
+        This is either an exact count, every batch, or an estimate,
+        every so often.
+        """
+        if self.EXACT_COUNT:
+            self.log.info("%d items need coverage%s", qu.count(), message)
+        elif not offset or not self.batches_run % self.ESTIMATE_INTERVAL:
+            self.log.info(
+                "About %d items need coverage%s",
+                estimate_query_count(qu), message
+            )
+
     def process_batch_and_handle_results(self, batch):
         """:return: A 2-tuple (counts, records). 
 
@@ -383,7 +448,6 @@ class BaseCoverageProvider(object):
 
 
 class CoverageProvider(BaseCoverageProvider):
-
     """Run Identifiers of certain types (isbn, overdrive, oclc, etc.) 
     (the input_identifier_types) through code associated with a DataSource 
     (the `output_source`). 
@@ -394,6 +458,8 @@ class CoverageProvider(BaseCoverageProvider):
     Turns errors in processing into coverage records with failure flags.
     """
 
+    ID_COLUMN = Identifier.id
+
     # Does this CoverageProvider get its data from a source that also
     # provides licenses for books?
     CAN_CREATE_LICENSE_POOLS = False
@@ -674,6 +740,8 @@ class CoverageProvider(BaseCoverageProvider):
 
 class WorkCoverageProvider(BaseCoverageProvider):
 
+    ID_COLUMN = Work.id
+
     #
     # Implementation of BaseCoverageProvider virtual methods.
     #
@@ -732,6 +800,10 @@ class BibliographicCoverageProvider(CoverageProvider):
 
     CAN_CREATE_LICENSE_POOLS = True
 
+    # The name of the integration (see Configuration.integration)
+    # that configures this provider's API.
+    INTEGRATION = None
+
     def __init__(self, _db, api, datasource, batch_size=10,
                  metadata_replacement_policy=None, circulationdata_replacement_policy=None, 
                  cutoff_time=None
@@ -760,12 +832,86 @@ class BibliographicCoverageProvider(CoverageProvider):
     def process_batch(self, identifiers):
         """Returns a list of successful identifiers and CoverageFailures"""
         results = []
-        for identifier in identifiers:
-            result = self.process_item(identifier)
+        responses = None
+        concurrency = self.max_concurrent_requests()
+        if concurrency > 1 and len(identifiers) > 1 and self.can_fetch:
+            # Look up every identifier in the batch at once. The
+            # responses are processed afterwards, in order.
+            pool = ThreadPool(min(concurrency, len(identifiers)))
+            try:
+                responses = pool.map(self._fetch_in_thread, identifiers)
+            finally:
+                pool.close()
+                pool.join()
+        for i, identifier in enumerate(identifiers):
+            if responses is None:
+                result = self.process_item(identifier)
+            else:
+                data, exception = responses[i]
+                if exception is None:
+                    result = self.process_fetched(identifier, data)
+                else:
+                    result = CoverageFailure(
+                        identifier, exception,
+                        data_source=self.output_source, transient=True
+                    )
             if not isinstance(result, CoverageFailure):
                 self.handle_success(identifier)
             results.append(result)
         return results
 
+    def _fetch_in_thread(self, identifier):
+        """Call fetch() from a worker thread.
+
+        An exception only affects the identifier that raised it, so
+        it's returned instead of raised, and the main thread turns it
+        into a CoverageFailure.
+
+        :return: A 2-tuple (data, exception traceback).
+        """
+        try:
+            return self.fetch(identifier), None
+        except Exception, e:
+            self.log.warn(
+                "Error fetching data for %r: %s", identifier, e, exc_info=e
+            )
+            return None, traceback.format_exc()
+
+    def max_concurrent_requests(self):
+        """How many metadata lookups may be made at once."""
+        if not self.INTEGRATION:
+            return 1
+        integration = Configuration.integration(self.INTEGRATION)
+        return int(integration.get(Configuration.MAX_CONCURRENT_REQUESTS, 1))
+
+    @property
+    def can_fetch(self):
+        """Does this provider split its work into fetch() and
+        process_fetched()?
+        """
+        return (self.fetch.im_func is not
+                BibliographicCoverageProvider.fetch.im_func)
+
+    def process_item(self, identifier):
+        return self.process_fetched(identifier, self.fetch(identifier))
+
+    def fetch(self, identifier):
+        """Retrieve remote data about an identifier.
+
+        Lookups for a batch of identifiers may run concurrently in
+        different threads, so this must not use the database session.
+
+        :return: Whatever process_fetched() needs.
+        """
+        raise NotImplementedError()
+
+    def process_fetched(self, identifier, data):
+        """Turn the data retrieved by fetch() into coverage for an
+        identifier. This always runs in the main thread.
+
+        :return: The identifier, or a CoverageFailure.
+        """
+        raise NotImplementedError()
+
     def handle_success(self, identifier):
         self.set_presentation_ready(identifier)
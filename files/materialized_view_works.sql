@@ -1,4 +1,8 @@
-create materialized view mv_works_editions_datasources_identifiers
+-- The query that defines mv_works_editions_datasources_identifiers.
+-- The table itself is a copy of this view, kept up to date by
+-- SessionManager.refresh_materialized_views() and
+-- SessionManager.update_materialized_views().
+create or replace view mv_works_editions_datasources_identifiers_source
 as
  SELECT 
     distinct works.id AS works_id,
@@ -35,9 +39,12 @@ as
      JOIN datasources ON licensepools.data_source_id = datasources.id
      JOIN identifiers on editions.primary_identifier_id = identifiers.id
   WHERE works.presentation_ready = true
-    AND works.simple_opds_entry IS NOT NULL
-  
-  ORDER BY editions.sort_title, editions.sort_author, licensepools.availability_time;
+    AND works.simple_opds_entry IS NOT NULL;
+
+create table mv_works_editions_datasources_identifiers
+as
+ SELECT * FROM mv_works_editions_datasources_identifiers_source
+  ORDER BY sort_title, sort_author, availability_time;
 
 -- Create a unique index so that searches can look up books by work ID.
 
@@ -51,6 +58,11 @@ create index mv_works_editions_by_availability on mv_works_editions_datasources_
 
 create index mv_works_editions_by_modification on mv_works_editions_datasources_identifiers (last_update_time DESC, sort_author, sort_title, works_id);
 
+-- An index sorted by Work.random, so that a lane's featured works can be
+-- sampled without sorting the whole lane.
+
+create index mv_works_editions_by_random on mv_works_editions_datasources_identifiers (random, sort_author, sort_title, works_id);
+
 -- We need three versions of each index:
 --- One that orders by sort_author, sort_title, and works_id
 --- One that orders by sort_title, sort_author, and works_id
@@ -1,4 +1,9 @@
-create materialized view mv_works_editions_workgenres_datasources_identifiers
+-- The query that defines
+-- mv_works_editions_workgenres_datasources_identifiers. The table
+-- itself is a copy of this view, kept up to date by
+-- SessionManager.refresh_materialized_views() and
+-- SessionManager.update_materialized_views().
+create or replace view mv_works_editions_workgenres_datasources_identifiers_source
 as
  SELECT 
     works.id AS works_id,
@@ -39,9 +44,12 @@ as
      JOIN identifiers on editions.primary_identifier_id = identifiers.id
      JOIN workgenres ON works.id = workgenres.work_id
   WHERE works.presentation_ready = true
-    AND works.simple_opds_entry IS NOT NULL
+    AND works.simple_opds_entry IS NOT NULL;
 
-  ORDER BY (editions.sort_title, editions.sort_author, licensepools.availability_time);
+create table mv_works_editions_workgenres_datasources_identifiers
+as
+ SELECT * FROM mv_works_editions_workgenres_datasources_identifiers_source
+  ORDER BY sort_title, sort_author, availability_time;
 
 -- Create a work/genre lookup.
 create unique index mv_works_genres_work_id_genre_id on mv_works_editions_workgenres_datasources_identifiers (works_id, genre_id);
@@ -54,6 +62,11 @@ create index mv_works_genres_by_availability on mv_works_editions_workgenres_dat
 
 create index mv_works_genres_by_modification on mv_works_editions_workgenres_datasources_identifiers (last_update_time DESC, sort_author, sort_title, works_id);
 
+-- An index sorted by Work.random, so that a lane's featured works can be
+-- sampled without sorting the whole lane.
+
+create index mv_works_genres_by_random on mv_works_editions_workgenres_datasources_identifiers (random, sort_author, sort_title, works_id);
+
 -- We need three versions of each index:
 --- One that orders by sort_author, sort_title, and works_id
 --- One that orders by sort_title, sort_author, and works_id
@@ -0,0 +1,17 @@
+CREATE OR REPLACE FUNCTION fn_recursive_equivalents_identity()
+RETURNS TRIGGER
+AS
+$$
+BEGIN
+        INSERT INTO recursiveequivalents (identifier_id, equivalent_id, depth, strength)
+        VALUES (NEW.id, NEW.id, 0, 1);
+        RETURN NEW;
+END;
+$$
+LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS recursive_equivalents_identity ON identifiers;
+
+CREATE TRIGGER recursive_equivalents_identity
+AFTER INSERT ON identifiers
+FOR EACH ROW EXECUTE PROCEDURE fn_recursive_equivalents_identity();
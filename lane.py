@@ -1,6 +1,14 @@
 from collections import defaultdict
 from nose.tools import set_trace
+import base64
+import copy
 import datetime
+from decimal import (
+    Decimal,
+    InvalidOperation,
+)
+import json
+from multiprocessing.pool import ThreadPool
 import random
 import time
 import logging
@@ -16,13 +24,17 @@ from classifier import (
 )
 
 from sqlalchemy import (
+    and_,
+    false,
     or_,
     not_,
 )
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import (
     contains_eager,
     defer,
     lazyload,
+    sessionmaker,
 )
 
 from model import (
@@ -295,6 +307,15 @@ class Facets(FacetConstants):
 
 
 class Pagination(object):
+    """Which page of a feed to show.
+
+    A page is usually found by counting works from the start of the
+    feed (the offset). If the page is the one after a page we just
+    showed, it can instead be found by its `key`: the sort key of the
+    last work on the previous page. That lets the database seek
+    straight to the page instead of reading and discarding every
+    work on the pages before it.
+    """
 
     DEFAULT_SIZE = 50
     DEFAULT_SEARCH_SIZE = 10
@@ -304,14 +325,25 @@ class Pagination(object):
     def default(cls):
         return Pagination(0, cls.DEFAULT_SIZE)
 
-    def __init__(self, offset=0, size=DEFAULT_SIZE):
+    def __init__(self, offset=0, size=DEFAULT_SIZE, key=None):
         self.offset = offset
         self.size = size
+        self.key = key
         self.query_size = None
 
+        # Set by apply(), and used to find the key of the next page.
+        self.order_columns = None
+        self.last_item_key = None
+
+        # Set by page_loaded(), so that has_next_page can tell
+        # whether this page reached the end of the query.
+        self.this_page_size = None
+
     def items(self):
         yield("after", self.offset)
         yield("size", self.size)
+        if self.key is not None:
+            yield("key", self.encode_key(self.key))
 
     @property
     def query_string(self):
@@ -323,7 +355,9 @@ class Pagination(object):
 
     @property
     def next_page(self):
-        return Pagination(self.offset+self.size, self.size)
+        return Pagination(
+            self.offset+self.size, self.size, key=self.last_item_key
+        )
 
     @property
     def previous_page(self):
@@ -336,17 +370,163 @@ class Pagination(object):
     @property
     def has_next_page(self):
         """Returns boolean reporting whether pagination is done for a query"""
+        if self.this_page_size is not None:
+            if self.query_size is None:
+                # This page was found by its key, so the query wasn't
+                # counted. A short page is the last one.
+                return self.this_page_size >= self.size
+            return self.offset + self.this_page_size < self.query_size
         if self.query_size is None:
             return True
         if self.query_size==0:
             return False
         return (self.offset+1) * self.size < self.query_size
 
-    def apply(self, q):
-        """Modify the given query with OFFSET and LIMIT."""
+    def apply(self, q, facets=None, work_model=Work, edition_model=Edition):
+        """Modify the given query to find the works on this page.
+
+        If `facets` is provided, the query is ordered by
+        facets.order_by(), and this page has a key, the query is
+        restricted to works that sort after the key. Otherwise the
+        query is modified with OFFSET and LIMIT.
+        """
+        if facets:
+            order_by, self.order_columns = facets.order_by(
+                work_model, edition_model
+            )
+            if self.key is not None:
+                clause = self.seek_clause(
+                    self.order_columns, facets.order_ascending, self.key
+                )
+                if clause is not None:
+                    self.query_size = None
+                    return q.filter(clause).limit(self.size)
         self.query_size = fast_query_count(q)
         return q.offset(self.offset).limit(self.size)
 
+    def page_loaded(self, items):
+        """Note the key of the last item on this page, so that
+        next_page can seek to the page after it.
+        """
+        self.last_item_key = None
+        self.this_page_size = len(items)
+        if items and self.order_columns:
+            self.last_item_key = self.sort_key(items[-1], self.order_columns)
+
+    @classmethod
+    def sort_key(cls, item, columns):
+        """Find the values of `columns` for a Work or materialized work.
+
+        :return: A list of values, or None if the values can't be
+        found without going to the database.
+        """
+        values = []
+        for column in columns:
+            owner = item
+            if isinstance(item, Work) and column.class_ is Edition:
+                owner = item.presentation_edition
+            if not isinstance(owner, column.class_):
+                # e.g. LicensePool.availability_time for a Work with
+                # more than one LicensePool.
+                return None
+            values.append(getattr(owner, column.key))
+        return values
+
+    @classmethod
+    def seek_clause(cls, columns, ascending, key):
+        """A clause that matches rows that sort after `key` when
+        ordered by `columns`.
+
+        Only the first column can be sorted in descending order (see
+        Facets.order_by). Postgres puts NULL after other values in
+        ascending order and before them in descending order.
+
+        The clause starts with a range condition on the first column
+        alone, so that the database can use an index on that column
+        to seek to the page.
+        """
+        if len(columns) != len(key):
+            logging.warn("Ignoring pagination key %r for %r", key, columns)
+            return None
+
+        first_column, first_value = columns[0], key[0]
+        if ascending:
+            if first_value is None:
+                leading = first_column == None
+            else:
+                leading = or_(first_column >= first_value,
+                              first_column == None)
+        else:
+            if first_value is None:
+                leading = None
+            else:
+                leading = first_column <= first_value
+
+        clauses = []
+        for i, (column, value) in enumerate(zip(columns, key)):
+            if i > 0 or ascending:
+                if value is None:
+                    after = None
+                else:
+                    after = or_(column > value, column == None)
+            else:
+                if value is None:
+                    after = column != None
+                else:
+                    after = column < value
+            if after is not None:
+                earlier = [c == v for c, v in zip(columns[:i], key[:i])]
+                clauses.append(and_(*(earlier + [after])))
+        if not clauses:
+            # Nothing sorts after the key.
+            return false()
+        if leading is None:
+            return or_(*clauses)
+        return and_(leading, or_(*clauses))
+
+    @classmethod
+    def encode_key(cls, key):
+        """Turn a sort key into an opaque string for use in a URL."""
+        def encode(value):
+            if isinstance(value, datetime.datetime):
+                return dict(datetime=value.strftime("%Y-%m-%dT%H:%M:%S.%f"))
+            if isinstance(value, Decimal):
+                return dict(decimal=str(value))
+            return value
+        data = json.dumps([encode(x) for x in key], separators=(',', ':'))
+        return base64.urlsafe_b64encode(data).rstrip("=")
+
+    @classmethod
+    def decode_key(cls, string):
+        """Turn the output of encode_key back into a sort key.
+
+        :raise ValueError: If the string isn't a sort key.
+        """
+        def decode(value):
+            if isinstance(value, dict):
+                # Only the wrappers made by encode_key are allowed.
+                if value.keys() == ['datetime']:
+                    return datetime.datetime.strptime(
+                        value['datetime'], "%Y-%m-%dT%H:%M:%S.%f"
+                    )
+                if (value.keys() == ['decimal']
+                    and isinstance(value['decimal'], basestring)):
+                    return Decimal(value['decimal'])
+                raise ValueError(value)
+            if value is not None and not isinstance(
+                    value, (basestring, bool, int, long, float)):
+                raise ValueError(value)
+            return value
+        try:
+            string = str(string)
+            data = base64.urlsafe_b64decode(string + "=" * (-len(string) % 4))
+            key = json.loads(data)
+            if not isinstance(key, list):
+                raise ValueError(string)
+            return [decode(x) for x in key]
+        except (TypeError, UnicodeError, InvalidOperation):
+            raise ValueError(string)
+
 
 class UndefinedLane(Exception):
     """Cannot create a lane because its definition is contradictory
@@ -1074,7 +1254,7 @@ class Lane(object):
             q = facets.apply(self._db, q, work_model, edition_model,
                              distinct=distinct)
         if pagination:
-            q = pagination.apply(q)
+            q = pagination.apply(q, facets, work_model, edition_model)
 
         return q
 
@@ -1236,17 +1416,83 @@ class Lane(object):
     def sublane_samples(self, use_materialized_works=True):
         """Generates a list of samples from each sublane for a groups feed"""
 
+        sublanes = self.visible_sublanes
+        samples = None
+        threads = Configuration.sublane_sampling_threads()
+        if threads > 1 and len(sublanes) > 1:
+            samples = self._concurrent_featured_works(
+                sublanes, use_materialized_works, threads
+            )
+        if samples is None:
+            samples = [
+                sublane.featured_works(
+                    use_materialized_works=use_materialized_works
+                )
+                for sublane in sublanes
+            ]
+
         # This is a list rather than a dict because we want to
         # preserve the ordering of the lanes.
         works_and_lanes = []
-        for sublane in self.visible_sublanes:
-            works = sublane.featured_works(
-                use_materialized_works=use_materialized_works
-            )
+        for sublane, works in zip(sublanes, samples):
             for work in works:
                 works_and_lanes.append((work, sublane))
         return works_and_lanes
 
+    def _sampling_sessionmaker(self):
+        """A factory for the sessions used to sample sublanes
+        concurrently, or None if that's not possible.
+
+        Each session needs its own connection, so this only works
+        when our session is bound to an Engine rather than to a
+        single Connection.
+        """
+        bind = self._db.get_bind()
+        if not isinstance(bind, Engine):
+            return None
+        return sessionmaker(bind=bind)
+
+    def _concurrent_featured_works(self, sublanes, use_materialized_works,
+                                   threads):
+        """Run featured_works() for each of `sublanes` at the same
+        time, each in its own database session.
+
+        :return: A list containing the featured works for each
+        sublane, in the same order as `sublanes`, merged into this
+        lane's session. None if the sublanes can't be sampled
+        concurrently.
+        """
+        make_session = self._sampling_sessionmaker()
+        if make_session is None:
+            return None
+
+        def sample(sublane):
+            # Lanes are shared between requests, so rather than point
+            # the sublane itself at the new session, work on a copy.
+            _db = make_session()
+            lane = copy.copy(sublane)
+            lane._db = _db
+            try:
+                return lane.featured_works(
+                    use_materialized_works=use_materialized_works
+                )
+            finally:
+                # This detaches the works from the session, but
+                # leaves everything that was loaded in place.
+                _db.close()
+
+        pool = ThreadPool(min(threads, len(sublanes)))
+        try:
+            samples = pool.map(sample, sublanes)
+        finally:
+            pool.close()
+            pool.join()
+
+        return [
+            [self._db.merge(work, load=False) for work in works]
+            for works in samples
+        ]
+
     def featured_works(self, use_materialized_works=True):
         """Find a random sample of featured books.
 
@@ -1290,26 +1536,62 @@ class Lane(object):
         return books
 
     def randomized_sample_works(self, query, use_min_size=False):
-        """Find a random sample of works for a feed"""
+        """Find a random sample of works for a feed.
 
-        offset = 0
+        The sample is a run of works that are next to each other when
+        ordered by Work.random, starting from a random point and
+        wrapping around to the start if necessary. Since Work.random
+        is indexed, the database never has to count the works in the
+        lane or skip over any of them.
+        """
         target_size = Configuration.featured_lane_size()
         smallest_sample_size = target_size
 
         if use_min_size:
             smallest_sample_size = self.MINIMUM_SAMPLE_SIZE or (target_size-5)
-        total_size = query.count()
 
-        if total_size < smallest_sample_size:
+        model = self._random_model(query)
+        if model is None:
+            works = self._randomized_offset_sample(query, target_size)
+        else:
+            start = round(random.random(), 3)
+            works = query.filter(
+                or_(model.random >= start, model.random == None)
+            ).limit(target_size).all()
+            if len(works) < target_size:
+                works += query.filter(model.random < start).limit(
+                    target_size - len(works)
+                ).all()
+
+        if len(works) < smallest_sample_size:
             # There aren't enough works here. Ignore the lane.
             return []
+        random.shuffle(works)
+        return works
+
+    @classmethod
+    def _random_model(cls, query):
+        """The Work class or materialized view that `query` finds,
+        if it has a `random` field to sample by.
+        """
+        descriptions = query.column_descriptions
+        if len(descriptions) != 1:
+            return None
+        model = descriptions[0]['entity']
+        if model is None or not hasattr(model, 'random'):
+            return None
+        return model
+
+    def _randomized_offset_sample(self, query, target_size):
+        """Find a sample of works by counting the results of `query`
+        and starting at a random offset.
+        """
+        offset = 0
+        total_size = query.count()
         if total_size > target_size:
             # We have enough results to randomly offset the selection.
             offset = random.randint(0, total_size-target_size)
-
-        works = query.offset(offset).limit(target_size).all()
-        random.shuffle(works)
-        return works
+        return query.offset(offset).limit(target_size).all()
 
     @property
     def visible_sublanes(self):
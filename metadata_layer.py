@@ -19,6 +19,7 @@ from sqlalchemy.orm import aliased
 import csv
 import datetime
 import logging
+import traceback
 from util import LanguageCodes
 from util.median import median
 from model import (
@@ -43,6 +44,74 @@ from model import (
 )
 from classifier import NO_VALUE, NO_NUMBER
 
+class ThumbnailBatch(object):
+    """A number of cover images that need thumbnails.
+
+    Scaling the images together lets Representation.scale_many spread
+    the work across several processes.
+    """
+
+    log = logging.getLogger("Thumbnail batch")
+
+    def __init__(self):
+        self.jobs = {}
+        self.identifiers = defaultdict(set)
+
+    def add(self, representation, thumbnail_url, mirror, identifier=None):
+        """Make a thumbnail of `representation` when the batch is run, and
+        mirror it to `thumbnail_url` with `mirror`.
+
+        :param identifier: The Identifier whose cover this is. If the
+        thumbnail can't be made, run() will say so.
+        """
+        self.jobs[representation] = (thumbnail_url, mirror)
+        if identifier:
+            self.identifiers[representation].add(identifier)
+
+    def run(self):
+        """Make all the thumbnails and mirror the new ones.
+
+        :return: A dictionary mapping the Identifier of each cover
+        whose thumbnail couldn't be made or mirrored to a traceback.
+        """
+        jobs = []
+        for representation, (thumbnail_url, mirror) in self.jobs.items():
+            jobs.append((representation, [(
+                Edition.MAX_THUMBNAIL_HEIGHT, Edition.MAX_THUMBNAIL_WIDTH,
+                thumbnail_url, Representation.PNG_MEDIA_TYPE
+            )]))
+        failures = {}
+        try:
+            results = Representation.scale_many(jobs, force=True)
+        except Exception, e:
+            self.log.error("Error scaling cover images", exc_info=e)
+            results = {}
+            message = traceback.format_exc()
+            for representation in self.jobs:
+                for identifier in self.identifiers[representation]:
+                    failures[identifier] = message
+
+        for representation, (thumbnail_url, mirror) in self.jobs.items():
+            if representation not in results:
+                continue
+            try:
+                [(thumbnail, is_new)] = results[representation]
+                if is_new:
+                    # A thumbnail was created distinct from the original
+                    # image. Mirror it as well.
+                    mirror.mirror_one(thumbnail)
+            except Exception, e:
+                self.log.error(
+                    "Error making a thumbnail of %r", representation,
+                    exc_info=e
+                )
+                for identifier in self.identifiers[representation]:
+                    failures[identifier] = traceback.format_exc()
+        self.jobs = {}
+        self.identifiers = defaultdict(set)
+        return failures
+
+
 class ReplacementPolicy(object):
     """How serious should we be about overwriting old metadata with
     this new metadata?
@@ -59,7 +128,8 @@ class ReplacementPolicy(object):
             mirror=None,
             http_get=None,
             even_if_not_apparently_updated=False,
-            presentation_calculation_policy=None
+            presentation_calculation_policy=None,
+            thumbnail_batch=None,
     ):
         self.identifiers = identifiers
         self.subjects = subjects
@@ -75,6 +145,9 @@ class ReplacementPolicy(object):
             presentation_calculation_policy or
             PresentationCalculationPolicy()
         )
+        # If this is set, thumbnails of mirrored images are made all
+        # at once when the batch is run, rather than one at a time.
+        self.thumbnail_batch = thumbnail_batch
 
     @classmethod
     def from_license_source(self, **args):
@@ -467,6 +540,10 @@ class MetaToModelUtility(object):
 
         mirror = policy.mirror
         http_get = policy.http_get
+        if not http_get and link.rel == Hyperlink.OPEN_ACCESS_DOWNLOAD:
+            # Books can be big, so write them to disk rather than
+            # reading them into memory.
+            http_get = Representation.streaming_http_get
 
         _db = Session.object_session(link_obj)
         original_url = link.href
@@ -516,6 +593,9 @@ class MetaToModelUtility(object):
         # associated with the resource.
         link_obj.resource.representation = representation
 
+        # From here on, a representation that isn't going to be
+        # mirrored mustn't leave a downloaded copy behind on disk.
+
         # If we couldn't fetch this representation, don't mirror it,
         # and if this was an open access link, then suppress the associated 
         # license pool until someone fixes it manually.
@@ -526,6 +606,7 @@ class MetaToModelUtility(object):
                 pool.suppressed = True
                 pool.license_exception = "Fetch exception: %s" % representation.fetch_exception
                 self.log.error(pool.license_exception)
+            representation.remove_downloaded_content()
             return
 
         # If we fetched the representation and it hasn't changed,
@@ -535,6 +616,7 @@ class MetaToModelUtility(object):
             self.log.info(
                 "Representation has not changed, assuming mirror at %s is up to date.", representation.mirror_url
             )
+            representation.remove_downloaded_content()
             return
 
         if representation.status_code / 100 not in (2,3):
@@ -542,6 +624,7 @@ class MetaToModelUtility(object):
                 "Representation %s gave %s status code, not mirroring.",
                 representation.url, representation.status_code
             )
+            representation.remove_downloaded_content()
             return
 
         # The metadata may have some idea about the media type for this
@@ -553,6 +636,7 @@ class MetaToModelUtility(object):
         if not representation.mirrorable_media_type:
             self.log.info("Not mirroring %s: unsupported media type %s",
                           representation.url, representation.media_type)
+            representation.remove_downloaded_content()
             return
 
         # Determine the best URL to use when mirroring this
@@ -590,17 +674,24 @@ class MetaToModelUtility(object):
                 data_source, identifier, thumbnail_filename,
                 Edition.MAX_THUMBNAIL_HEIGHT
             )
-            thumbnail, is_new = representation.scale(
-                max_height=Edition.MAX_THUMBNAIL_HEIGHT,
-                max_width=Edition.MAX_THUMBNAIL_WIDTH,
-                destination_url=thumbnail_url,
-                destination_media_type=Representation.PNG_MEDIA_TYPE,
-                force=True
-            )
-            if is_new:
-                # A thumbnail was created distinct from the original
-                # image. Mirror it as well.
-                mirror.mirror_one(thumbnail)
+            if policy.thumbnail_batch is not None:
+                # The thumbnail will be made along with a number of
+                # others.
+                policy.thumbnail_batch.add(
+                    representation, thumbnail_url, mirror, identifier
+                )
+            else:
+                thumbnail, is_new = representation.scale(
+                    max_height=Edition.MAX_THUMBNAIL_HEIGHT,
+                    max_width=Edition.MAX_THUMBNAIL_WIDTH,
+                    destination_url=thumbnail_url,
+                    destination_media_type=Representation.PNG_MEDIA_TYPE,
+                    force=True
+                )
+                if is_new:
+                    # A thumbnail was created distinct from the original
+                    # image. Mirror it as well.
+                    mirror.mirror_one(thumbnail)
 
         if link_obj.rel == Hyperlink.OPEN_ACCESS_DOWNLOAD:
             # If we mirrored book content successfully, don't keep it in
@@ -608,6 +699,7 @@ class MetaToModelUtility(object):
             # ever need to resize them.
             if representation.mirrored_at and not representation.mirror_exception:
                 representation.content = None
+                representation.remove_downloaded_content()
 
 
 
@@ -0,0 +1 @@
+ALTER TABLE cachedfeeds ADD COLUMN request_count integer DEFAULT 0;
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+"""Replace the Postgres materialized views with tables copied from
+ordinary views, so that RefreshMaterializedViewsScript --incremental
+can update the rows for individual works.
+"""
+
+import os
+import sys
+bin_dir = os.path.split(__file__)[0]
+package_dir = os.path.join(bin_dir, "..", "..")
+sys.path.append(os.path.abspath(package_dir))
+
+from nose.tools import set_trace
+import core.model
+from core.model import (
+    production_session,
+    SessionManager,
+)
+
+_db = production_session()
+resource_path = os.path.join(
+    os.path.split(core.model.__file__)[0], "files"
+)
+
+for view_name, filename in SessionManager.MATERIALIZED_VIEWS.items():
+    if not SessionManager.is_materialized_view(_db, view_name):
+        print "%s is already a table." % view_name
+        continue
+    print "Converting %s to a table." % view_name
+    _db.execute("drop materialized view %s;" % view_name)
+    sql = open(os.path.join(resource_path, filename)).read()
+    # Execute the file as-is, without treating colons as bind parameters.
+    _db.connection().execute(sql)
+    _db.commit()
@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+"""Calculate the contents of the recursiveequivalents table, which
+replaces the fn_recursive_equivalents SQL function.
+"""
+
+import os
+import sys
+bin_dir = os.path.split(__file__)[0]
+package_dir = os.path.join(bin_dir, "..", "..")
+sys.path.append(os.path.abspath(package_dir))
+
+from nose.tools import set_trace
+from core.model import (
+    production_session,
+    RecursiveEquivalent,
+)
+
+_db = production_session()
+RecursiveEquivalent.rebuild(_db)
+_db.commit()
@@ -0,0 +1,26 @@
+CREATE OR REPLACE FUNCTION fn_recursive_equivalents_identity()
+RETURNS TRIGGER
+AS
+$$
+BEGIN
+        INSERT INTO recursiveequivalents (identifier_id, equivalent_id, depth, strength)
+        VALUES (NEW.id, NEW.id, 0, 1);
+        RETURN NEW;
+END;
+$$
+LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS recursive_equivalents_identity ON identifiers;
+
+CREATE TRIGGER recursive_equivalents_identity
+AFTER INSERT ON identifiers
+FOR EACH ROW EXECUTE PROCEDURE fn_recursive_equivalents_identity();
+
+-- Identifiers created since the recursiveequivalents table was filled
+-- in without going through the ORM don't have a row for themselves.
+INSERT INTO recursiveequivalents (identifier_id, equivalent_id, depth, strength)
+SELECT i.id, i.id, 0, 1 FROM identifiers i
+WHERE NOT EXISTS (
+        SELECT 1 FROM recursiveequivalents r
+        WHERE r.identifier_id = i.id AND r.depth = 0
+);
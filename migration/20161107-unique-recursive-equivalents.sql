@@ -0,0 +1,12 @@
+-- Concurrent recalculations could leave the same recursive
+-- equivalent in the table more than once. Keep one of each.
+DELETE FROM recursiveequivalents r
+USING recursiveequivalents other
+WHERE r.identifier_id = other.identifier_id
+        AND r.equivalent_id = other.equivalent_id
+        AND r.depth = other.depth
+        AND r.id > other.id;
+
+ALTER TABLE recursiveequivalents
+ADD CONSTRAINT recursiveequivalents_identifier_id_equivalent_id_depth_key
+UNIQUE (identifier_id, equivalent_id, depth);
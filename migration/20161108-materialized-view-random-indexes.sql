@@ -0,0 +1,6 @@
+-- Featured works are sampled in order of Work.random, starting from a
+-- random value.
+
+create index if not exists mv_works_editions_by_random on mv_works_editions_datasources_identifiers (random, sort_author, sort_title, works_id);
+
+create index if not exists mv_works_genres_by_random on mv_works_editions_workgenres_datasources_identifiers (random, sort_author, sort_title, works_id);
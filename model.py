@@ -18,6 +18,8 @@ import os
 import random
 import re
 import requests
+import tempfile
+import threading
 import time
 import traceback
 import urllib
@@ -41,7 +43,9 @@ from sqlalchemy.orm import (
     sessionmaker,
 )
 from sqlalchemy import (
+    event,
     func,
+    inspect,
     or_,
     MetaData,
     Table,
@@ -54,6 +58,7 @@ from sqlalchemy.orm import (
     contains_eager,
     joinedload,
     lazyload,
+    subqueryload,
 )
 from sqlalchemy.orm.exc import (
     NoResultFound,
@@ -76,6 +81,7 @@ from sqlalchemy.sql.expression import (
     literal_column,
     case,
     table,
+    text,
 )
 from sqlalchemy.exc import (
     IntegrityError
@@ -115,6 +121,8 @@ from util import (
     MetadataSimilarity,
     TitleProcessor,
 )
+from util.blob_store import LocalBlobStore
+from util.cache import LRUCache
 from util.http import (
     HTTP,
     RemoteIntegrationException,
@@ -169,6 +177,11 @@ class SessionManager(object):
     # is also defined in SQL.
     RECURSIVE_EQUIVALENTS_FUNCTION = 'recursive_equivalents.sql'
 
+    # So is the trigger that gives every new Identifier a
+    # RecursiveEquivalent row for itself.
+    RECURSIVE_EQUIVALENTS_IDENTITY_TRIGGER = 'recursive_equivalents_identity'
+    RECURSIVE_EQUIVALENTS_IDENTITY_FILE = 'recursive_equivalents_identity.sql'
+
     engine_for_url = {}
 
     @classmethod
@@ -230,6 +243,24 @@ class SessionManager(object):
             sql = open(resource_file).read()
             connection.execute(sql)
 
+        # Likewise the trigger that maintains RecursiveEquivalent's
+        # identity rows.
+        query = select(
+            [literal_column('tgname')]
+        ).select_from(
+            table('pg_trigger')
+        ).where(
+            literal_column('tgname')==cls.RECURSIVE_EQUIVALENTS_IDENTITY_TRIGGER
+        )
+        if not list(connection.execute(query)):
+            resource_file = os.path.join(
+                resource_path, cls.RECURSIVE_EQUIVALENTS_IDENTITY_FILE
+            )
+            if not os.path.exists(resource_file):
+                raise IOError("Could not load recursive equivalents trigger from %s: file does not exist." % resource_file)
+            sql = open(resource_file).read()
+            connection.execute(sql)
+
         if connection:
             connection.close()
 
@@ -273,11 +304,87 @@ class SessionManager(object):
         return engine, engine.connect()
 
     @classmethod
-    def refresh_materialized_views(self, _db):
-        for view_name in self.MATERIALIZED_VIEWS.keys():
-            _db.execute("refresh materialized view %s;" % view_name)
+    def refresh_materialized_views(cls, _db):
+        for view_name in cls.MATERIALIZED_VIEWS.keys():
+            if cls.is_materialized_view(_db, view_name):
+                _db.execute("refresh materialized view %s;" % view_name)
+            else:
+                cls.rebuild_materialized_view(_db, view_name)
             _db.commit()
 
+    # The 'materialized views' used to be real Postgres materialized
+    # views, which can only be refreshed all at once. Now they're
+    # tables copied from an ordinary view, so that the rows for
+    # individual works can be brought up to date.
+
+    @classmethod
+    def source_view_name(cls, view_name):
+        """The name of the view that a 'materialized view' table is
+        copied from.
+        """
+        return view_name + "_source"
+
+    @classmethod
+    def is_materialized_view(cls, _db, view_name):
+        """Is `view_name` a real Postgres materialized view, rather than
+        a table copied from a view?
+        """
+        result = _db.execute(
+            text("select 1 from pg_matviews where matviewname=:name"),
+            dict(name=view_name)
+        )
+        return len(list(result)) > 0
+
+    @classmethod
+    def rebuild_materialized_view(cls, _db, view_name):
+        """Replace the contents of a 'materialized view' table with
+        the current contents of its source view.
+        """
+        _db.execute("delete from %s;" % view_name)
+        _db.execute(
+            "insert into %s select * from %s;" % (
+                view_name, cls.source_view_name(view_name)
+            )
+        )
+
+    UPDATE_BATCH_SIZE = 1000
+
+    @classmethod
+    def update_materialized_views(cls, _db, work_ids):
+        """Bring the rows for the given works up to date in every
+        'materialized view' table.
+
+        A work that no longer exists (or no longer belongs in the
+        views) simply loses its rows, so `work_ids` should include
+        deleted works. Only the given works are touched; anything else
+        is left to the next full refresh.
+
+        :return: False if the views are real Postgres materialized
+        views, which can't be updated this way. True otherwise.
+        """
+        for view_name in cls.MATERIALIZED_VIEWS.keys():
+            if cls.is_materialized_view(_db, view_name):
+                return False
+
+        work_ids = sorted(set(work_ids))
+        for view_name in cls.MATERIALIZED_VIEWS.keys():
+            source_view_name = cls.source_view_name(view_name)
+            for i in range(0, len(work_ids), cls.UPDATE_BATCH_SIZE):
+                batch = dict(ids=work_ids[i:i+cls.UPDATE_BATCH_SIZE])
+                _db.execute(
+                    text("delete from %s where works_id = any(:ids);"
+                         % view_name),
+                    batch
+                )
+                _db.execute(
+                    text("insert into %s select * from %s "
+                         "where works_id = any(:ids);"
+                         % (view_name, source_view_name)),
+                    batch
+                )
+            _db.commit()
+        return True
+
     @classmethod
     def session(cls, url):
         engine = connection = 0
@@ -357,6 +464,56 @@ def create(db, model, create_method='',
     db.flush()
     return created, True
 
+
+class HasLookupCache(object):
+    """A mixin for small reference tables, like DataSource and Genre,
+    whose rows are looked up over and over by the same key.
+
+    The ID of each row that's looked up is remembered for the life of
+    the process. Later lookups get the row through the session's
+    identity map, which usually doesn't need a trip to the database.
+    IDs are only meaningful in the database they came from, so
+    there's a separate cache for each database URL.
+    """
+
+    @classmethod
+    def _lookup_cache(cls, _db):
+        # Each class gets its own cache.
+        if '_lookup_cache_ids' not in cls.__dict__:
+            cls._lookup_cache_ids = {}
+        url = str(_db.get_bind().engine.url)
+        return cls._lookup_cache_ids.setdefault(url, {})
+
+    @classmethod
+    def from_lookup_cache(cls, _db, key):
+        """Find the row cached under `key` and load it into `_db`.
+
+        :return: The row, or None if nothing is cached under `key`
+        (or the cached row has gone away).
+        """
+        cache = cls._lookup_cache(_db)
+        id = cache.get(key)
+        if id is None:
+            return None
+        obj = _db.query(cls).get(id)
+        if obj is None:
+            # This row was deleted, or created in a transaction that
+            # was rolled back.
+            cache.pop(key, None)
+        return obj
+
+    @classmethod
+    def add_to_lookup_cache(cls, key, obj):
+        if obj is not None and obj.id is not None:
+            _db = Session.object_session(obj)
+            cls._lookup_cache(_db)[key] = obj.id
+
+    @classmethod
+    def reset_lookup_cache(cls):
+        """Forget every row this class has cached."""
+        if '_lookup_cache_ids' in cls.__dict__:
+            cls._lookup_cache_ids.clear()
+
 Base = declarative_base()
 
 class Patron(Base):
@@ -695,7 +852,7 @@ class Annotation(Base):
         self.content = None
         self.timestamp = datetime.datetime.now()
 
-class DataSource(Base):
+class DataSource(Base, HasLookupCache):
 
     """A source for information about books, and possibly the books themselves."""
 
@@ -815,7 +972,11 @@ class DataSource(Base):
         # Turn a deprecated name (e.g. "3M" into the current name
         # (e.g. "Bibliotheca").
         name = cls.DEPRECATED_NAMES.get(name, name)
-        return get_one(_db, DataSource, name=name)
+        data_source = cls.from_lookup_cache(_db, name)
+        if not data_source:
+            data_source = get_one(_db, DataSource, name=name)
+            cls.add_to_lookup_cache(name, data_source)
+        return data_source
 
     URI_PREFIX = "http://librarysimplified.org/terms/sources/"
 
@@ -1173,15 +1334,34 @@ class WorkCoverageRecord(Base, BaseCoverageRecord):
 
     @classmethod
     def add_for(self, work, operation, timestamp=None, 
-                status=CoverageRecord.SUCCESS):
+                status=CoverageRecord.SUCCESS, batch=None):
+        """Record that `operation` was performed on `work`.
+
+        :param batch: A PresentationBatch containing `work`. The
+        batch loaded the Work's coverage records, so there's no need
+        to go back to the database for them.
+        """
         _db = Session.object_session(work)
         timestamp = timestamp or datetime.datetime.utcnow()
-        coverage_record, is_new = get_one_or_create(
-            _db, WorkCoverageRecord,
-            work=work,
-            operation=operation,
-            on_multiple='interchangeable'
-        )
+        if batch is not None and 'coverage_records' in work.__dict__:
+            coverage_record = None
+            for record in work.coverage_records:
+                if record.operation == operation:
+                    coverage_record = record
+                    break
+            is_new = coverage_record is None
+            if is_new:
+                coverage_record = WorkCoverageRecord(
+                    work=work, operation=operation
+                )
+                _db.add(coverage_record)
+        else:
+            coverage_record, is_new = get_one_or_create(
+                _db, WorkCoverageRecord,
+                work=work,
+                operation=operation,
+                on_multiple='interchangeable'
+            )
         coverage_record.status = status
         coverage_record.timestamp = timestamp
         return coverage_record, is_new
@@ -1239,6 +1419,352 @@ class Equivalency(Base):
             q = q.filter(~Equivalency.id.in_(exclude_ids))
         return q
 
+class RecursiveEquivalent(Base):
+    """A precalculated answer to the question of whether two
+    Identifiers are equivalent, taking indirect Equivalencies into
+    account.
+
+    For every Identifier there's a row saying that it's equivalent to
+    itself (with depth 0). For every other Identifier reachable from
+    it through a chain of Equivalencies with positive strength, there
+    is a row for each depth at which the strongest chain of at most
+    that many Equivalencies gets stronger. The strength of a chain is
+    the product of the strengths of its Equivalencies.
+
+    The depth-0 rows are created by a database trigger, so that an
+    Identifier gets one however it's inserted. The other rows are
+    kept up to date whenever Equivalencies are flushed to the
+    database; see update_recursive_equivalents_after_flush(). A
+    change that affects too many Identifiers to recalculate during
+    the flush is queued as RecursiveEquivalentUpdates instead, and
+    handled later by RecursiveEquivalentUpdateMonitor.
+    """
+    __tablename__ = 'recursiveequivalents'
+
+    # Equivalencies further away than this are not tracked.
+    MAX_DEPTH = 5
+
+    # A change to the Equivalencies that would mean recalculating the
+    # equivalents of more Identifiers than this is not handled
+    # during the flush.
+    SYNCHRONOUS_UPDATE_LIMIT = 100
+
+    # Recalculations take transaction-level advisory locks, with
+    # this as the first key and an Identifier's id modulo LOCK_BUCKETS
+    # as the second, so that recalculations of different parts of
+    # the graph don't wait for each other.
+    LOCK_CLASS = 1423
+    LOCK_BUCKETS = 256
+
+    id = Column(Integer, primary_key=True)
+    identifier_id = Column(
+        Integer, ForeignKey('identifiers.id', ondelete='CASCADE'),
+        index=True
+    )
+    equivalent_id = Column(
+        Integer, ForeignKey('identifiers.id', ondelete='CASCADE'),
+        index=True
+    )
+    depth = Column(Integer)
+    strength = Column(Float)
+
+    __table_args__ = (
+        UniqueConstraint('identifier_id', 'equivalent_id', 'depth'),
+    )
+
+    @classmethod
+    def lock(cls, connection, identifier_ids, locked=None):
+        """Wait until no other transaction is recalculating the
+        recursive equivalents of the given Identifiers, and keep them
+        from starting until this transaction ends.
+
+        Each recalculation reads the Equivalencies and then replaces
+        rows based on what it read. Without a lock, two transactions
+        changing the same part of the graph would each work from a
+        graph missing the other's changes. Under READ COMMITTED,
+        everything read after a lock is acquired includes whatever
+        the transaction that held it committed.
+
+        Locks are taken in order, so two transactions that lock their
+        Identifiers in one go can't deadlock.
+
+        :param locked: The buckets this transaction already holds.
+        :return: The buckets this transaction now holds.
+        """
+        locked = set(locked or [])
+        buckets = set(x % cls.LOCK_BUCKETS for x in identifier_ids)
+        for bucket in sorted(buckets - locked):
+            connection.execute(
+                select([func.pg_advisory_xact_lock(cls.LOCK_CLASS, bucket)])
+            )
+        return locked | buckets
+
+    @classmethod
+    def update_for(cls, connection, identifier_ids, limit=None):
+        """Recalculate the recursive equivalents of every Identifier
+        that might be affected by a change to the Equivalencies of
+        the given Identifiers.
+
+        Those are the Identifiers within MAX_DEPTH-1 Equivalencies of
+        the given Identifiers. Anything further away can't use a
+        changed Equivalency without going over MAX_DEPTH.
+
+        The affected Identifiers are locked before anything is
+        changed. Once they're locked the graph is read again, since
+        a transaction that held the lock may have changed it, and
+        if that brings in more Identifiers they're locked as well.
+
+        :param limit: Give up, without changing anything, if more
+        than this many Identifiers would need to be recalculated.
+
+        :return: True if the recursive equivalents were updated,
+        False if the limit was reached.
+        """
+        locked = set()
+        while True:
+            graph = _EquivalencyGraph(connection)
+            affected = cls._affected_by(graph, identifier_ids, limit)
+            if affected is None:
+                return False
+            if set(x % cls.LOCK_BUCKETS for x in affected) <= locked:
+                break
+            locked = cls.lock(connection, affected, locked)
+        cls.recalculate(connection, affected, graph)
+        return True
+
+    @classmethod
+    def _affected_by(cls, graph, identifier_ids, limit=None):
+        """Find the Identifiers within MAX_DEPTH-1 Equivalencies of the
+        given Identifiers.
+
+        :return: A set of Identifier IDs, or None if there are more
+        than `limit` of them.
+        """
+        affected = set(identifier_ids)
+        frontier = set(identifier_ids)
+        too_many = lambda: limit is not None and len(affected) > limit
+        for i in range(cls.MAX_DEPTH - 1):
+            if too_many():
+                return None
+            # Find the neighbors of the whole frontier with one query.
+            graph.load(frontier)
+            frontier = set(
+                neighbor for node in frontier
+                for neighbor in graph.neighbors(node)
+            ) - affected
+            if not frontier:
+                break
+            affected |= frontier
+        if too_many():
+            return None
+        return affected
+
+    @classmethod
+    def recalculate(cls, connection, identifier_ids, graph=None):
+        """Replace the recursive equivalents of the given Identifiers
+        (other than their equivalence to themselves).
+
+        The caller must hold lock() for all of them.
+        """
+        if not identifier_ids:
+            return
+        graph = graph or _EquivalencyGraph(connection)
+        identifier_ids = sorted(identifier_ids)
+        table = cls.__table__
+        connection.execute(
+            table.delete().where(
+                and_(table.c.identifier_id.in_(identifier_ids),
+                     table.c.depth > 0)
+            )
+        )
+        rows = []
+        for identifier_id in identifier_ids:
+            for equivalent_id, depth, strength in graph.equivalents(
+                    identifier_id, cls.MAX_DEPTH):
+                rows.append(dict(
+                    identifier_id=identifier_id,
+                    equivalent_id=equivalent_id,
+                    depth=depth,
+                    strength=strength,
+                ))
+        if rows:
+            connection.execute(table.insert(), rows)
+
+    @classmethod
+    def rebuild(cls, _db, batch_size=1000):
+        """Calculate every Identifier's recursive equivalents from
+        scratch.
+        """
+        connection = _db.connection()
+        cls.lock(connection, range(cls.LOCK_BUCKETS))
+        connection.execute(cls.__table__.delete())
+        # Any queued updates will be covered by the rebuild.
+        connection.execute(RecursiveEquivalentUpdate.__table__.delete())
+        connection.execute(
+            "insert into %s (identifier_id, equivalent_id, depth, strength) "
+            "select id, id, 0, 1 from identifiers" % cls.__tablename__
+        )
+        ids = connection.execute(
+            "select input_id from equivalents where strength > 0 "
+            "union select output_id from equivalents where strength > 0"
+        )
+        ids = sorted(x[0] for x in ids)
+        for i in range(0, len(ids), batch_size):
+            cls.recalculate(connection, ids[i:i+batch_size])
+
+Index("ix_recursiveequivalents_identifier_id_depth_strength",
+      RecursiveEquivalent.identifier_id, RecursiveEquivalent.depth,
+      RecursiveEquivalent.strength)
+
+
+class RecursiveEquivalentUpdate(Base):
+    """A note that the Equivalencies of an Identifier have changed,
+    but the RecursiveEquivalents that depend on them haven't been
+    recalculated yet.
+    """
+    __tablename__ = 'recursiveequivalentupdates'
+
+    id = Column(Integer, primary_key=True)
+    identifier_id = Column(
+        Integer, ForeignKey('identifiers.id', ondelete='CASCADE'),
+        index=True
+    )
+    timestamp = Column(DateTime)
+
+    @classmethod
+    def queue(cls, connection, identifier_ids):
+        now = datetime.datetime.utcnow()
+        connection.execute(
+            cls.__table__.insert(),
+            [dict(identifier_id=x, timestamp=now)
+             for x in sorted(identifier_ids)]
+        )
+
+    @classmethod
+    def process(cls, _db, batch_size=100):
+        """Handle up to `batch_size` queued updates.
+
+        :return: The number of queued updates handled.
+        """
+        connection = _db.connection()
+        table = cls.__table__
+        rows = connection.execute(
+            select([table.c.id, table.c.identifier_id]).order_by(
+                table.c.id
+            ).limit(batch_size)
+        ).fetchall()
+        if not rows:
+            return 0
+        RecursiveEquivalent.update_for(
+            connection, set(identifier_id for row_id, identifier_id in rows)
+        )
+        connection.execute(
+            table.delete().where(
+                table.c.id.in_([row_id for row_id, ignore in rows])
+            )
+        )
+        return len(rows)
+
+
+class _EquivalencyGraph(object):
+    """The Equivalencies with positive strength, loaded from the
+    database as they're needed.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._neighbors = dict()
+
+    def neighbors(self, identifier_id):
+        """Map the Identifiers directly equivalent to the given one to
+        the strength of the strongest Equivalency between them.
+        """
+        if identifier_id not in self._neighbors:
+            self.load([identifier_id])
+        return self._neighbors[identifier_id]
+
+    def load(self, identifier_ids):
+        identifier_ids = [
+            x for x in identifier_ids if x not in self._neighbors
+        ]
+        if not identifier_ids:
+            return
+        for identifier_id in identifier_ids:
+            self._neighbors[identifier_id] = dict()
+        table = Equivalency.__table__
+        query = select(
+            [table.c.input_id, table.c.output_id, table.c.strength]
+        ).where(
+            and_(table.c.strength > 0,
+                 or_(table.c.input_id.in_(identifier_ids),
+                     table.c.output_id.in_(identifier_ids)))
+        )
+        for input_id, output_id, strength in self.connection.execute(query):
+            for a, b in ((input_id, output_id), (output_id, input_id)):
+                if a in self._neighbors and a != b:
+                    neighbors = self._neighbors[a]
+                    neighbors[b] = max(strength, neighbors.get(b, 0))
+
+    def equivalents(self, identifier_id, max_depth):
+        """Find the Identifiers reachable from the given one through
+        at most `max_depth` Equivalencies.
+
+        :yield: A (equivalent_id, depth, strength) 3-tuple each time
+        the strongest chain to an Identifier gets stronger.
+        """
+        best = {identifier_id: 1}
+        frontier = {identifier_id: 1}
+        for depth in range(1, max_depth+1):
+            self.load(frontier.keys())
+            improved = dict()
+            for node, strength in frontier.items():
+                for neighbor, edge_strength in self.neighbors(node).items():
+                    chain_strength = strength * edge_strength
+                    if (chain_strength > best.get(neighbor, 0)
+                        and chain_strength > improved.get(neighbor, 0)):
+                        improved[neighbor] = chain_strength
+            if not improved:
+                break
+            best.update(improved)
+            frontier = improved
+            for equivalent_id, strength in improved.items():
+                yield equivalent_id, depth, strength
+
+
+def update_recursive_equivalents_after_flush(session, flush_context):
+    """Keep RecursiveEquivalent up to date as Equivalencies are
+    created, changed and deleted.
+    """
+    changed_identifier_ids = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if not isinstance(obj, Equivalency):
+            continue
+        attrs = inspect(obj).attrs
+        if obj in session.dirty and not any(
+                attrs[x].history.has_changes()
+                for x in ('input_id', 'output_id', 'strength')):
+            # Nothing that affects the graph has changed.
+            continue
+        # Include the old endpoints of an Equivalency that was moved.
+        for attr in (attrs.input_id, attrs.output_id):
+            for identifier_id in attr.history.sum():
+                if identifier_id is not None:
+                    changed_identifier_ids.add(identifier_id)
+    if changed_identifier_ids:
+        connection = session.connection()
+        if not RecursiveEquivalent.update_for(
+                connection, changed_identifier_ids,
+                limit=RecursiveEquivalent.SYNCHRONOUS_UPDATE_LIMIT):
+            # An Identifier with a lot of equivalents is involved.
+            # Leave it for RecursiveEquivalentUpdateMonitor rather
+            # than making this flush take an unbounded amount of time.
+            RecursiveEquivalentUpdate.queue(
+                connection, changed_identifier_ids
+            )
+
+event.listen(Session, 'after_flush', update_recursive_equivalents_after_flush)
+
+
 class Identifier(Base):
     """A way of uniquely referring to a particular edition.
     """
@@ -1374,15 +1900,9 @@ class Identifier(Base):
         if not foreign_identifier_type or not foreign_id:
             return None
 
-        # Turn a deprecated identifier type (e.g. "3M ID" into the
-        # current type (e.g. "Bibliotheca ID").
-        foreign_identifier_type = cls.DEPRECATED_NAMES.get(
-            foreign_identifier_type, foreign_identifier_type
+        foreign_identifier_type, foreign_id = cls.normalize_foreign_id(
+            foreign_identifier_type, foreign_id
         )
-        
-        if foreign_identifier_type in (
-                Identifier.OVERDRIVE_ID, Identifier.THREEM_ID):
-            foreign_id = foreign_id.lower()
         if autocreate:
             m = get_one_or_create
         else:
@@ -1395,6 +1915,23 @@ class Identifier(Base):
         else:
             return result, False
 
+    @classmethod
+    def normalize_foreign_id(cls, foreign_identifier_type, foreign_id):
+        """Put a foreign ID in the form it's stored in the database.
+
+        :return: A 2-tuple (type, identifier).
+        """
+        # Turn a deprecated identifier type (e.g. "3M ID" into the
+        # current type (e.g. "Bibliotheca ID").
+        foreign_identifier_type = cls.DEPRECATED_NAMES.get(
+            foreign_identifier_type, foreign_identifier_type
+        )
+        
+        if foreign_identifier_type in (
+                Identifier.OVERDRIVE_ID, Identifier.THREEM_ID):
+            foreign_id = foreign_id.lower()
+        return foreign_identifier_type, foreign_id
+
     @property
     def urn(self):
         identifier_text = urllib.quote(self.identifier)
@@ -1458,6 +1995,50 @@ class Identifier(Base):
 
         return cls.for_foreign_id(_db, type, identifier_string)
 
+    @classmethod
+    def parse_urns(cls, _db, identifier_strings, autocreate=True):
+        """Batch processing version of parse_urn.
+
+        Identifiers that already exist are looked up with a single query.
+
+        :return: A 2-tuple (identifiers_by_urn, failures). Each URN
+        that names an Identifier is mapped to that Identifier;
+        `failures` is a list of the URNs that couldn't be parsed.
+        """
+        failures = []
+        keys_by_urn = {}
+        identifiers_by_type = defaultdict(set)
+        for urn in identifier_strings:
+            try:
+                type, identifier = cls.type_and_identifier_for_urn(urn)
+            except ValueError, e:
+                type = identifier = None
+            if not type or not identifier:
+                failures.append(urn)
+                continue
+            key = cls.normalize_foreign_id(type, identifier)
+            keys_by_urn[urn] = key
+            identifiers_by_type[key[0]].add(key[1])
+
+        existing = {}
+        if identifiers_by_type:
+            clauses = [
+                and_(Identifier.type==type, Identifier.identifier.in_(ids))
+                for type, ids in identifiers_by_type.items()
+            ]
+            for identifier in _db.query(Identifier).filter(or_(*clauses)):
+                existing[(identifier.type, identifier.identifier)] = identifier
+
+        identifiers_by_urn = {}
+        for urn, key in keys_by_urn.items():
+            identifier = existing.get(key)
+            if not identifier and autocreate:
+                identifier, ignore = cls.for_foreign_id(_db, *key)
+                existing[key] = identifier
+            if identifier:
+                identifiers_by_urn[urn] = identifier
+        return identifiers_by_urn, failures
+
     def equivalent_to(self, data_source, identifier, strength):
         """Make one Identifier equivalent to another.
 
@@ -1494,9 +2075,23 @@ class Identifier(Base):
         like `Edition.primary_identifier_id` if the query will be used as
         a subquery.
 
-        This uses the function defined in files/recursive_equivalents.sql.
+        This looks up the answer in RecursiveEquivalent.
         """
-        return select([func.fn_recursive_equivalents(identifier_id_column, levels, threshold)])
+        return select([RecursiveEquivalent.equivalent_id]).where(
+            cls._recursive_equivalent_clause(
+                identifier_id_column, levels, threshold
+            )
+        )
+
+    @classmethod
+    def _recursive_equivalent_clause(cls, identifier_id_column, levels,
+                                     threshold):
+        closure = RecursiveEquivalent
+        return and_(
+            closure.identifier_id==identifier_id_column,
+            or_(closure.depth==0,
+                and_(closure.depth <= levels, closure.strength > threshold))
+        )
 
     @classmethod
     def recursively_equivalent_identifier_ids(
@@ -1504,7 +2099,7 @@ class Identifier(Base):
         """All Identifier IDs equivalent to the given set of Identifier
         IDs at the given confidence threshold.
 
-        This uses the function defined in files/recursive_equivalents.sql.
+        This looks up the answer in RecursiveEquivalent.
 
         Four levels is enough to go from a Gutenberg text to an ISBN.
         Gutenberg ID -> OCLC Work IS -> OCLC Number -> ISBN
@@ -1512,9 +2107,13 @@ class Identifier(Base):
         Returns a dictionary mapping each ID in the original to a
         list of equivalent IDs.
         """
-
-        query = select([Identifier.id, func.fn_recursive_equivalents(Identifier.id, levels, threshold)],
-                       Identifier.id.in_(identifier_ids))
+        closure = RecursiveEquivalent
+        query = select(
+            [closure.identifier_id, closure.equivalent_id],
+            and_(closure.identifier_id.in_(identifier_ids),
+                 cls._recursive_equivalent_clause(
+                     closure.identifier_id, levels, threshold))
+        ).distinct()
         results = _db.execute(query)
         equivalents = defaultdict(list)
         for r in results:
@@ -1710,7 +2309,8 @@ class Identifier(Base):
 
     @classmethod
     def evaluate_summary_quality(cls, _db, identifier_ids,
-                                 privileged_data_sources=None):
+                                 privileged_data_sources=None,
+                                 hyperlinks=None):
         """Evaluate the summaries for the given group of Identifier IDs.
 
         This is an automatic evaluation based solely on the content of
@@ -1726,6 +2326,11 @@ class Identifier(Base):
         of these data source will be instantly chosen, short-circuiting the
         decision process. Data sources are in order of priority.
 
+        :param hyperlinks: If present, the description Hyperlinks
+        associated with these identifiers have already been loaded, and
+        the summaries will be chosen from among them instead of
+        querying the database.
+
         :return: The single highest-rated summary Resource.
 
         """
@@ -1739,8 +2344,25 @@ class Identifier(Base):
         # Find all rel="description" resources associated with any of
         # these records.
         rels = [Hyperlink.DESCRIPTION, Hyperlink.SHORT_DESCRIPTION]
-        descriptions = cls.resources_for_identifier_ids(
-            _db, identifier_ids, rels, privileged_data_source).all()
+        if hyperlinks is None:
+            descriptions = cls.resources_for_identifier_ids(
+                _db, identifier_ids, rels, privileged_data_source).all()
+        else:
+            if isinstance(privileged_data_source, DataSource):
+                privileged_data_source = [privileged_data_source]
+            if privileged_data_source:
+                data_source_ids = set(
+                    [d.id for d in privileged_data_source]
+                )
+            descriptions = []
+            for link in hyperlinks:
+                if link.rel not in rels:
+                    continue
+                if (privileged_data_source
+                    and link.data_source_id not in data_source_ids):
+                    continue
+                if link.resource not in descriptions:
+                    descriptions.append(link.resource)
 
         champion = None
         # Add each resource's content to the evaluator's corpus.
@@ -1761,7 +2383,9 @@ class Identifier(Base):
         if privileged_data_source and not champion:
             # We could not find any descriptions from the privileged
             # data source. Try relaxing that restriction.
-            return cls.evaluate_summary_quality(_db, identifier_ids, privileged_data_sources[1:])
+            return cls.evaluate_summary_quality(
+                _db, identifier_ids, privileged_data_sources[1:], hyperlinks
+            )
         return champion, descriptions
 
     @classmethod
@@ -3011,6 +3635,13 @@ class PresentationCalculationPolicy(object):
             update_search_index=True,
         )
 
+    @property
+    def needs_identifier_ids(self):
+        """Will this policy need the set of identifiers equivalent to
+        a Work?
+        """
+        return self.classify or self.choose_summary or self.calculate_quality
+
 
 class Work(Base):
 
@@ -3437,7 +4068,7 @@ class Work(Base):
 
         other_work.calculate_presentation()
 
-    def set_summary(self, resource):
+    def set_summary(self, resource, batch=None):
         self.summary = resource
         # TODO: clean up the content
         if resource and resource.representation:
@@ -3445,7 +4076,8 @@ class Work(Base):
         else:
             self.summary_text = ""
         WorkCoverageRecord.add_for(
-            self, operation=WorkCoverageRecord.SUMMARY_OPERATION
+            self, operation=WorkCoverageRecord.SUMMARY_OPERATION,
+            batch=batch
         )
 
     @classmethod
@@ -3505,19 +4137,50 @@ class Work(Base):
         return q
 
     def all_identifier_ids(self, recursion_level=5):
-        _db = Session.object_session(self)
-        primary_identifier_ids = [
-            lp.identifier.id for lp in self.license_pools
-            if lp.identifier
-        ]
+        return self.all_identifier_ids_for(
+            [self], recursion_level
+        ).get(self.id, set())
+
+    @classmethod
+    def all_identifier_ids_for(cls, works, recursion_level=5):
+        """Find the identifiers equivalent to any of the given Works'
+        primary identifiers, using a single query for the whole batch.
+
+        :return: A dictionary mapping each Work's ID to a set of
+        identifier IDs.
+        """
+        works = [work for work in works if work is not None]
+        if not works:
+            return {}
+        _db = Session.object_session(works[0])
+
+        # Find the primary identifiers of all the Works' license
+        # pools at once, rather than loading the pools Work by Work.
+        primary_identifier_ids = dict((work.id, []) for work in works)
+        qu = _db.query(
+            LicensePool.work_id, LicensePool.identifier_id
+        ).filter(
+            LicensePool.work_id.in_(primary_identifier_ids.keys())
+        ).filter(
+            LicensePool.identifier_id != None
+        )
+        for work_id, identifier_id in qu:
+            primary_identifier_ids[work_id].append(identifier_id)
+        all_primary_ids = set()
+        for ids in primary_identifier_ids.values():
+            all_primary_ids.update(ids)
+
         # Get a dict that maps identifier ids to lists of their equivalents.
         equivalent_lists = Identifier.recursively_equivalent_identifier_ids(
-            _db, primary_identifier_ids, recursion_level)
+            _db, list(all_primary_ids), recursion_level)
 
-        identifier_ids = set()
-        for equivs in equivalent_lists.values():
-            identifier_ids.update(equivs)
-        return identifier_ids
+        by_work = dict()
+        for work_id, ids in primary_identifier_ids.items():
+            identifier_ids = set()
+            for primary_id in ids:
+                identifier_ids.update(equivalent_lists.get(primary_id, []))
+            by_work[work_id] = identifier_ids
+        return by_work
 
     @property
     def language_code(self):
@@ -3562,7 +4225,7 @@ class Work(Base):
         if self.presentation_edition.is_presentation_for:
             self.presentation_edition.is_presentation_for.work = self
 
-    def calculate_presentation_edition(self, policy=None):
+    def calculate_presentation_edition(self, policy=None, batch=None):
         """ Which of this Work's Editions should be used as the default?
 
         First, every LicensePool associated with this work must have
@@ -3623,7 +4286,8 @@ class Work(Base):
 
         # tell everyone else we tried to set work's presentation edition
         WorkCoverageRecord.add_for(
-            self, operation=WorkCoverageRecord.CHOOSE_EDITION_OPERATION
+            self, operation=WorkCoverageRecord.CHOOSE_EDITION_OPERATION,
+            batch=batch
         )
 
         changed = (
@@ -3633,7 +4297,8 @@ class Work(Base):
         return changed
 
 
-    def calculate_presentation(self, policy=None, search_index_client=None):
+    def calculate_presentation(self, policy=None, search_index_client=None,
+                               identifier_ids=None, batch=None):
         """Make a Work ready to show to patrons.
 
         Call calculate_presentation_edition() to find the best-quality presentation edition 
@@ -3646,6 +4311,14 @@ class Work(Base):
         * The intended audience for the work.
         * The best available summary for the work.
         * The overall popularity of the work.
+
+        :param identifier_ids: The IDs of all identifiers equivalent
+        to this Work, if they've already been looked up (e.g. by
+        all_identifier_ids_for() for a whole batch of Works).
+
+        :param batch: A PresentationBatch containing this Work, from
+        which classifications, measurements and descriptions will be
+        taken instead of being looked up individually.
         """
         
         # Gather information up front so we can see if anything
@@ -3656,7 +4329,7 @@ class Work(Base):
 
         policy = policy or PresentationCalculationPolicy()
 
-        edition_changed = self.calculate_presentation_edition(policy)
+        edition_changed = self.calculate_presentation_edition(policy, batch)
 
         summary = self.summary
         summary_text = self.summary_text
@@ -3673,28 +4346,45 @@ class Work(Base):
             if pool.data_source.name != DataSource.GUTENBERG:
                 licensed_data_sources.add(pool.data_source)
 
-        if policy.classify or policy.choose_summary or policy.calculate_quality:
+        if policy.needs_identifier_ids:
             # Find all related IDs that might have associated descriptions,
             # classifications, or measurements.
             _db = Session.object_session(self)
 
-            identifier_ids = self.all_identifier_ids()
+            if batch:
+                identifier_ids = batch.identifier_ids_for(self)
+            elif identifier_ids is None:
+                identifier_ids = self.all_identifier_ids()
         else:
             identifier_ids = []
 
         if policy.classify:
-            classification_changed = self.assign_genres(identifier_ids)
+            classifications = None
+            if batch:
+                classifications = batch.classifications_for(self)
+            classification_changed = self.assign_genres(
+                identifier_ids, classifications=classifications, batch=batch
+            )
             WorkCoverageRecord.add_for(
-                self, operation=WorkCoverageRecord.CLASSIFY_OPERATION
+                self, operation=WorkCoverageRecord.CLASSIFY_OPERATION,
+                batch=batch
             )
 
         if policy.choose_summary:
-            staff_data_source = DataSource.lookup(_db, DataSource.LIBRARY_STAFF)
+            if batch:
+                staff_data_source = batch.staff_data_source
+                hyperlinks = batch.descriptions_for(self)
+            else:
+                staff_data_source = DataSource.lookup(
+                    _db, DataSource.LIBRARY_STAFF
+                )
+                hyperlinks = None
             summary, summaries = Identifier.evaluate_summary_quality(
-                _db, identifier_ids, [staff_data_source, licensed_data_sources]
+                _db, identifier_ids, [staff_data_source, licensed_data_sources],
+                hyperlinks
             )
             # TODO: clean up the content
-            self.set_summary(summary)      
+            self.set_summary(summary, batch)
 
         if policy.calculate_quality:
             # In the absense of other data, we will make a rough
@@ -3713,7 +4403,12 @@ class Work(Base):
                     default_quality = q
             else:
                 default_quality = 0
-            self.calculate_quality(identifier_ids, default_quality)
+            measurements = None
+            if batch:
+                measurements = batch.measurements_for(self)
+            self.calculate_quality(
+                identifier_ids, default_quality, measurements, batch
+            )
 
         if self.summary_text:
             if isinstance(self.summary_text, unicode):
@@ -3738,13 +4433,13 @@ class Work(Base):
             self.last_update_time = datetime.datetime.utcnow()
 
         if changed or policy.regenerate_opds_entries:
-            self.calculate_opds_entries()
+            self.calculate_opds_entries(batch=batch)
 
         if changed or policy.update_search_index:
             # Ensure new changes are reflected in database queries
             _db = Session.object_session(self)
             _db.flush()
-            self.update_external_index(search_index_client)
+            self.update_external_index(search_index_client, batch=batch)
 
         # Now that everything's calculated, print it out.
         if policy.verbose:            
@@ -3827,7 +4522,7 @@ class Work(Base):
         l = [_ensure(s) for s in l]
         return u"\n".join(l)
 
-    def calculate_opds_entries(self, verbose=True):
+    def calculate_opds_entries(self, verbose=True, batch=None):
         from opds import (
             AcquisitionFeed,
             Annotator,
@@ -3843,11 +4538,13 @@ class Work(Base):
         if verbose is not None:
             self.verbose_opds_entry = etree.tostring(verbose)
         WorkCoverageRecord.add_for(
-            self, operation=WorkCoverageRecord.GENERATE_OPDS_OPERATION
+            self, operation=WorkCoverageRecord.GENERATE_OPDS_OPERATION,
+            batch=batch
         )
 
 
-    def update_external_index(self, client, add_coverage_record=True):
+    def update_external_index(self, client, add_coverage_record=True,
+                              batch=None):
         client = client or ExternalSearchIndex()
 
         args = dict(index=client.works_index,
@@ -3879,7 +4576,8 @@ class Work(Base):
                 client.delete(**args)
         if add_coverage_record and present_in_index:
             WorkCoverageRecord.add_for(
-                self, operation=(WorkCoverageRecord.UPDATE_SEARCH_INDEX_OPERATION + "-" + client.works_index)
+                self, operation=(WorkCoverageRecord.UPDATE_SEARCH_INDEX_OPERATION + "-" + client.works_index),
+                batch=batch
             )
         return present_in_index
 
@@ -3915,25 +4613,41 @@ class Work(Base):
         else:
             self.set_presentation_ready(search_index_client=search_index_client)
 
-    def calculate_quality(self, identifier_ids, default_quality=0):
+    def calculate_quality(self, identifier_ids, default_quality=0,
+                          measurements=None, batch=None):
+        """Calculate the Work's overall quality from Measurements of
+        the given identifiers.
+
+        :param measurements: If present, the relevant Measurements have
+        already been loaded and there's no need to query for them.
+
+        :param batch: A PresentationBatch containing this Work.
+        """
         _db = Session.object_session(self)
-        quantities = [Measurement.POPULARITY, Measurement.RATING,
-                      Measurement.DOWNLOADS, Measurement.QUALITY]
-        measurements = _db.query(Measurement).filter(
-            Measurement.identifier_id.in_(identifier_ids)).filter(
-                Measurement.is_most_recent==True).filter(
-                    Measurement.quantity_measured.in_(quantities)).all()
+        if measurements is None:
+            measurements = _db.query(Measurement).filter(
+                Measurement.identifier_id.in_(identifier_ids)).filter(
+                    Measurement.is_most_recent==True).filter(
+                        Measurement.quantity_measured.in_(
+                            Measurement.QUALITY_QUANTITIES)).all()
 
         self.quality = Measurement.overall_quality(
             measurements, default_value=default_quality)
         WorkCoverageRecord.add_for(
-            self, operation=WorkCoverageRecord.QUALITY_OPERATION
+            self, operation=WorkCoverageRecord.QUALITY_OPERATION,
+            batch=batch
         )
 
-    def assign_genres(self, identifier_ids, cutoff=0.15):
+    def assign_genres(self, identifier_ids, cutoff=0.15,
+                      classifications=None, batch=None):
         """Set classification information for this work based on the
         subquery to get equivalent identifiers.
 
+        :param classifications: If present, the Classifications of
+        these identifiers have already been loaded.
+
+        :param batch: A PresentationBatch containing this Work.
+
         :return: A boolean explaining whether or not any data actually
         changed.
         """
@@ -3944,9 +4658,10 @@ class Work(Base):
         old_target_age = self.target_age
 
         _db = Session.object_session(self)
-        classifications = Identifier.classifications_for_identifier_ids(
-            _db, identifier_ids
-        )
+        if classifications is None:
+            classifications = Identifier.classifications_for_identifier_ids(
+                _db, identifier_ids
+            )
         for classification in classifications:
             classifier.add(classification)
 
@@ -3954,7 +4669,7 @@ class Work(Base):
          self.target_age) = classifier.classify
 
         workgenres, workgenres_changed = self.assign_genres_from_weights(
-            genre_weights
+            genre_weights, batch
         )
 
         classification_changed = (
@@ -3966,13 +4681,22 @@ class Work(Base):
 
         return classification_changed
 
-    def assign_genres_from_weights(self, genre_weights):
+    def assign_genres_from_weights(self, genre_weights, batch=None):
         # Assign WorkGenre objects to the remainder.
         changed = False
         _db = Session.object_session(self)
         total_genre_weight = float(sum(genre_weights.values()))
         workgenres = []
-        current_workgenres = _db.query(WorkGenre).filter(WorkGenre.work==self)
+        # A PresentationBatch loaded this Work's WorkGenres, so we
+        # know which ones exist without asking the database. A
+        # collection loaded some other way might be out of date.
+        already_loaded = batch is not None and 'work_genres' in self.__dict__
+        if already_loaded:
+            current_workgenres = list(self.work_genres)
+        else:
+            current_workgenres = _db.query(WorkGenre).filter(
+                WorkGenre.work==self
+            )
         by_genre = dict()
         for wg in current_workgenres:
             by_genre[wg.genre] = wg
@@ -3984,6 +4708,10 @@ class Work(Base):
                 wg = by_genre[g]
                 is_new = False
                 del by_genre[g]
+            elif already_loaded:
+                wg = WorkGenre(work=self, genre=g)
+                _db.add(wg)
+                is_new = True
             else:
                 wg, is_new = get_one_or_create(
                     _db, WorkGenre, work=self, genre=g)
@@ -4330,6 +5058,145 @@ class Work(Base):
 Index("ix_works_audience_target_age_quality_random", Work.audience, Work.target_age, Work.quality, Work.random)
 Index("ix_works_audience_fiction_quality_random", Work.audience, Work.fiction, Work.quality, Work.random)
 
+
+class DeletedWork(Base):
+    """A record that a Work was deleted, e.g. by being merged into
+    another Work.
+
+    A deleted Work leaves no trace in the works table, so this is how
+    RefreshMaterializedViewsScript --incremental knows to remove its
+    rows from the materialized views. Old records are removed by the
+    next full refresh.
+    """
+    __tablename__ = 'deletedworks'
+
+    id = Column(Integer, primary_key=True)
+    work_id = Column(Integer, nullable=False)
+    timestamp = Column(DateTime, index=True)
+
+
+def record_deleted_works_after_flush(session, flush_context):
+    """Keep a DeletedWork record for every Work deleted in a flush."""
+    now = datetime.datetime.utcnow()
+    deleted = [
+        dict(work_id=obj.id, timestamp=now) for obj in session.deleted
+        if isinstance(obj, Work) and obj.id is not None
+    ]
+    if deleted:
+        session.connection().execute(DeletedWork.__table__.insert(), deleted)
+
+event.listen(Session, 'after_flush', record_deleted_works_after_flush)
+
+
+class PresentationBatch(object):
+    """Everything needed to calculate presentation for a batch of
+    Works, loaded with a handful of set-based queries.
+
+    Work.calculate_presentation() normally looks up classifications,
+    measurements, descriptions, WorkGenres and WorkCoverageRecords
+    separately for every Work. When it's given a PresentationBatch it
+    takes them from here instead, and the classification, quality and
+    summary calculations happen in memory. Changes are written when
+    the session is next flushed, in one batch.
+    """
+
+    def __init__(self, _db, works, policy=None):
+        self._db = _db
+        self.policy = policy or PresentationCalculationPolicy()
+        work_ids = [work.id for work in works]
+        if not work_ids:
+            self.works = []
+            self.identifier_ids = {}
+            self.genres_by_id = {}
+            self.data_sources_by_id = {}
+            return
+
+        # Reload the Works with their WorkGenres and
+        # WorkCoverageRecords. Work.assign_genres_from_weights() and
+        # WorkCoverageRecord.add_for() will use these collections
+        # rather than querying for each Work.
+        qu = _db.query(Work).filter(Work.id.in_(work_ids)).options(
+            subqueryload(Work.work_genres),
+            subqueryload(Work.coverage_records),
+        )
+        by_id = dict((work.id, work) for work in qu)
+        self.works = [by_id[id] for id in work_ids if id in by_id]
+
+        # Genres and DataSources are small tables. Loading them all
+        # puts them in the identity map, so that Subject.genre and
+        # Classification.data_source can be resolved without a
+        # query. The identity map only holds weak references, so the
+        # batch keeps them alive.
+        self.genres_by_id = dict((x.id, x) for x in _db.query(Genre))
+        self.data_sources_by_id = dict(
+            (x.id, x) for x in _db.query(DataSource)
+        )
+        self.staff_data_source = DataSource.lookup(
+            _db, DataSource.LIBRARY_STAFF
+        )
+
+        if self.policy.needs_identifier_ids:
+            self.identifier_ids = Work.all_identifier_ids_for(self.works)
+        else:
+            self.identifier_ids = {}
+        all_identifier_ids = set()
+        for ids in self.identifier_ids.values():
+            all_identifier_ids.update(ids)
+        all_identifier_ids = list(all_identifier_ids)
+
+        self.classifications = defaultdict(list)
+        if self.policy.classify and all_identifier_ids:
+            qu = Identifier.classifications_for_identifier_ids(
+                _db, all_identifier_ids
+            )
+            for classification in qu:
+                self.classifications[classification.identifier_id].append(
+                    classification
+                )
+
+        self.measurements = defaultdict(list)
+        if self.policy.calculate_quality and all_identifier_ids:
+            qu = _db.query(Measurement).filter(
+                Measurement.identifier_id.in_(all_identifier_ids)).filter(
+                    Measurement.is_most_recent==True).filter(
+                        Measurement.quantity_measured.in_(
+                            Measurement.QUALITY_QUANTITIES))
+            for measurement in qu:
+                self.measurements[measurement.identifier_id].append(
+                    measurement
+                )
+
+        self.descriptions = defaultdict(list)
+        if self.policy.choose_summary and all_identifier_ids:
+            rels = [Hyperlink.DESCRIPTION, Hyperlink.SHORT_DESCRIPTION]
+            qu = _db.query(Hyperlink).filter(
+                Hyperlink.identifier_id.in_(all_identifier_ids)).filter(
+                    Hyperlink.rel.in_(rels)).options(
+                        joinedload('resource').joinedload('representation')
+                    )
+            for hyperlink in qu:
+                self.descriptions[hyperlink.identifier_id].append(hyperlink)
+
+    def identifier_ids_for(self, work):
+        return self.identifier_ids.get(work.id, set())
+
+    def _gather(self, by_identifier, work):
+        results = []
+        for identifier_id in self.identifier_ids_for(work):
+            results.extend(by_identifier.get(identifier_id, []))
+        return results
+
+    def classifications_for(self, work):
+        return self._gather(self.classifications, work)
+
+    def measurements_for(self, work):
+        return self._gather(self.measurements, work)
+
+    def descriptions_for(self, work):
+        """The description Hyperlinks for all of a Work's identifiers."""
+        return self._gather(self.descriptions, work)
+
+
 class Measurement(Base):
     """A  measurement of some numeric quantity associated with a
     Identifier.
@@ -4348,6 +5215,9 @@ class Measurement(Base):
 
     GUTENBERG_FAVORITE = u"http://librarysimplified.org/terms/rel/lists/gutenberg-favorite"
 
+    # These quantities go into a Work's overall quality.
+    QUALITY_QUANTITIES = [POPULARITY, RATING, DOWNLOADS, QUALITY]
+
     # If a book's popularity measurement is found between index n and
     # index n+1 on this list, it is in the nth percentile for
     # popularity and its 'popularity' value should be n * 0.01.
@@ -4857,7 +5727,7 @@ class Resource(Base):
         return quality
 
 
-class Genre(Base):
+class Genre(Base, HasLookupCache):
     """A subject-matter classification for a book.
 
     Much, much more general than Classification.
@@ -4884,6 +5754,9 @@ class Genre(Base):
     def lookup(cls, _db, name, autocreate=False):
         if isinstance(name, GenreData):
             name = name.name
+        result = cls.from_lookup_cache(_db, name)
+        if result:
+            return result, False
         args = (_db, Genre)
         if autocreate:
             result, new = get_one_or_create(*args, name=name)
@@ -4892,6 +5765,7 @@ class Genre(Base):
             new = False
         if result is None:
             logging.getLogger().error('"%s" is not a recognized genre.', name)
+        cls.add_to_lookup_cache(name, result)
         return result, new
 
     @property
@@ -5363,6 +6237,10 @@ class CachedFeed(Base):
     license_pool_id = Column(Integer, ForeignKey('licensepools.id'),
         nullable=True, index=True)
 
+    # Approximately how many times this feed has been requested. This
+    # is used to decide which feeds to regenerate first.
+    request_count = Column(Integer, default=0)
+
     GROUPS_TYPE = 'groups'
     PAGE_TYPE = 'page'
     RECOMMENDATIONS_TYPE = 'recommendations'
@@ -5371,16 +6249,71 @@ class CachedFeed(Base):
 
     log = logging.getLogger("CachedFeed")
 
+    # A process-local cache of recently used feeds, in front of the
+    # cachedfeeds table. See memory_cache().
+    _memory_cache = None
+
+    # Requests that haven't yet been added to the corresponding
+    # CachedFeed.request_count. Counts are written to the database
+    # in batches of this size, so that a popular feed isn't updated
+    # (and its row locked) on every request.
+    _uncounted_requests = defaultdict(int)
+    _uncounted_requests_lock = threading.Lock()
+    REQUEST_COUNT_BATCH_SIZE = 10
+
+    @classmethod
+    def memory_cache(cls):
+        """The in-process cache for this worker, or None if it's disabled.
+
+        The cache maps the values that identify a CachedFeed to
+        (content, timestamp, cached_at) tuples, and is bounded by the
+        total length of the content.
+        """
+        max_size = Configuration.feed_memory_cache_size()
+        if not max_size:
+            return None
+        if cls._memory_cache is None or cls._memory_cache.max_size != max_size:
+            cls._memory_cache = LRUCache(
+                max_size, sizeof=lambda x: len(x[0])
+            )
+        return cls._memory_cache
+
+    @classmethod
+    def _count_request(cls, memory_key, force=False):
+        """Note a request for the feed identified by `memory_key`.
+
+        :return: The number of requests to add to the feed's
+        request_count now, or 0 if they should wait until more
+        requests have come in.
+        """
+        with cls._uncounted_requests_lock:
+            cls._uncounted_requests[memory_key] += 1
+            uncounted = cls._uncounted_requests[memory_key]
+            if not force and uncounted < cls.REQUEST_COUNT_BATCH_SIZE:
+                return 0
+            del cls._uncounted_requests[memory_key]
+            return uncounted
+
+    @classmethod
+    def max_cache_age(cls, lane, type):
+        """How long may a feed of the given type be cached for this lane?
+
+        :return: A timedelta, Configuration.CACHE_FOREVER, or None.
+        """
+        max_age = None
+        if lane and hasattr(lane, 'MAX_CACHE_AGE'):
+            max_age = lane.MAX_CACHE_AGE
+        elif type == cls.GROUPS_TYPE:
+            max_age = Configuration.groups_max_age()
+        elif type == cls.PAGE_TYPE:
+            max_age = Configuration.page_max_age()
+        return max_age
+
     @classmethod
     def fetch(cls, _db, lane, type, facets, pagination, annotator,
               force_refresh=False, max_age=None):
         if max_age is None:
-            if lane and hasattr(lane, 'MAX_CACHE_AGE'):
-                max_age = lane.MAX_CACHE_AGE
-            elif type == cls.GROUPS_TYPE:
-                max_age = Configuration.groups_max_age()
-            elif type == cls.PAGE_TYPE:
-                max_age = Configuration.page_max_age()
+            max_age = cls.max_cache_age(lane, type)
         if isinstance(max_age, int):
             max_age = datetime.timedelta(seconds=max_age)
 
@@ -5407,6 +6340,34 @@ class CachedFeed(Base):
         else:
             pagination_key = ""
 
+        # Before going to the database, see whether this worker has
+        # recently seen a usable version of the feed.
+        memory_cache = cls.memory_cache()
+        if license_pool:
+            license_pool_id = license_pool.id
+        else:
+            license_pool_id = None
+        memory_key = (lane_name, license_pool_id, type, languages_key,
+                      facets_key, pagination_key)
+        if memory_cache is not None and force_refresh is not True:
+            hit = memory_cache.get(memory_key)
+            if hit:
+                content, timestamp, cached_at = hit
+                now = datetime.datetime.utcnow()
+                if (cached_at >= now - Configuration.feed_memory_cache_max_age()
+                    and cls._is_usable(content, timestamp, max_age)):
+                    # This CachedFeed is never added to the database
+                    # session.
+                    feed = CachedFeed(
+                        lane_name=lane_name, license_pool_id=license_pool_id,
+                        type=type, languages=languages_key,
+                        facets=facets_key, pagination=pagination_key,
+                        content=content, timestamp=timestamp
+                    )
+                    cls._count_request(memory_key)
+                    return feed, True
+                memory_cache.invalidate(memory_key)
+
         # Get a CachedFeed object. We will either return its .content,
         # or update its .content.
         feed, is_new = get_one_or_create(
@@ -5423,12 +6384,25 @@ class CachedFeed(Base):
             # cached feed as stale.
             return feed, False
 
+        # Someone actually wants to see this feed. A new feed is
+        # counted right away, so the warming monitor knows about it.
+        # Otherwise the count is added in the database, so that
+        # simultaneous requests for the same feed don't overwrite
+        # each other's counts.
+        uncounted = cls._count_request(memory_key, force=is_new)
+        if is_new:
+            feed.request_count = uncounted
+        elif uncounted:
+            feed.request_count = (
+                func.coalesce(CachedFeed.request_count, 0) + uncounted
+            )
+
         if max_age is Configuration.CACHE_FOREVER:
             # This feed is so expensive to generate that it must be cached
             # forever (unless force_refresh is True).
             if not is_new and feed.content:
                 # Cacheable!
-                return feed, True
+                usable = True
             else:
                 # We're supposed to generate this feed, but as a group
                 # feed, it's too expensive.
@@ -5446,20 +6420,86 @@ class CachedFeed(Base):
                 )
         else:
             # This feed is cheap enough to generate on the fly.
-            cutoff = datetime.datetime.utcnow() - max_age
-            fresh = False
-            if feed.timestamp and feed.content:
-                if feed.timestamp >= cutoff:
-                    fresh = True
-            return feed, fresh
+            usable = cls._is_usable(feed.content, feed.timestamp, max_age)
 
-        # Either there is no cached feed or it's time to update it.
-        return feed, False
+        if usable and memory_cache is not None:
+            memory_cache.set(
+                memory_key,
+                (feed.content, feed.timestamp, datetime.datetime.utcnow())
+            )
+        return feed, usable
+
+    @classmethod
+    def _is_usable(cls, content, timestamp, max_age):
+        """Is a feed with the given content and timestamp fresh enough
+        to serve?
+        """
+        if not content:
+            return False
+        if max_age is Configuration.CACHE_FOREVER:
+            return True
+        cutoff = datetime.datetime.utcnow() - max_age
+        return bool(timestamp and timestamp >= cutoff)
+
+    @property
+    def memory_cache_key(self):
+        license_pool_id = self.license_pool_id
+        if license_pool_id is None and self.license_pool:
+            license_pool_id = self.license_pool.id
+        return (self.lane_name, license_pool_id, self.type, self.languages,
+                self.facets, self.pagination)
 
     def update(self, content):
         self.content = content
         self.timestamp = datetime.datetime.utcnow()
 
+        # Whatever this worker had cached for this feed is now out of date.
+        self._invalidate_memory_cache(self.memory_cache_key)
+
+    @classmethod
+    def _invalidate_memory_cache(cls, memory_key):
+        memory_cache = cls.memory_cache()
+        if memory_cache is not None:
+            memory_cache.invalidate(memory_key)
+
+    def update_from_chunks(self, chunks):
+        """Pass along each chunk of a feed as it's generated, and store
+        the complete feed as this CachedFeed's content once the last
+        chunk has gone out.
+
+        The chunks are generated from objects in this CachedFeed's
+        session, and the content is stored in that session too, so
+        the session mustn't be committed, rolled back or closed until
+        the last chunk has gone out. A web request has to send the
+        generator with flask.stream_with_context() so that its session
+        is cleaned up afterwards. If the session has moved on, the
+        generator raises an exception rather than going back to the
+        database for every object it needs.
+
+        If the generator is abandoned partway through (e.g. because
+        the client went away), the cached content is left alone.
+
+        :return: A generator of chunks.
+        """
+        _db = Session.object_session(self)
+        return self._store_chunks(chunks, _db, _db.transaction)
+
+    def _store_chunks(self, chunks, _db, transaction):
+        parts = []
+        for chunk in chunks:
+            self._check_stream_session(_db, transaction)
+            parts.append(chunk)
+            yield chunk
+        self._check_stream_session(_db, transaction)
+        self.update("".join(parts))
+
+    def _check_stream_session(self, _db, transaction):
+        if (Session.object_session(self) is not _db
+            or _db.transaction is not transaction):
+            raise Exception(
+                "The session used to generate a feed was committed, rolled back or closed before the feed was finished."
+            )
+
     def __repr__(self):
         if self.content:
             length = len(self.content)
@@ -6302,7 +7342,7 @@ class LicensePool(Base):
 Index("ix_licensepools_data_source_id_identifier_id", LicensePool.data_source_id, LicensePool.identifier_id, unique=True)
 
 
-class RightsStatus(Base):
+class RightsStatus(Base, HasLookupCache):
 
     """The terms under which a book has been made available to the general
     public.
@@ -6401,12 +7441,16 @@ class RightsStatus(Base):
     def lookup(cls, _db, uri):
         if not uri in cls.NAMES.keys():
             uri = cls.UNKNOWN
+        status = cls.from_lookup_cache(_db, uri)
+        if status:
+            return status
         name = cls.NAMES.get(uri)
         create_method_kwargs = dict(name=name)
         status, ignore = get_one_or_create(
             _db, RightsStatus, uri=uri,
             create_method_kwargs=create_method_kwargs
         )
+        cls.add_to_lookup_cache(uri, status)
         return status
 
     @classmethod
@@ -6794,8 +7838,9 @@ class Representation(Base):
     # If this representation is an image, the width of the image.
     image_width = Column(Integer, index=True)
 
-    # The content of the representation itself.
-    content = Column(Binary)
+    # The content of the representation itself, if it's kept in the
+    # database. Use .content to get it wherever it's kept.
+    _content = Column("content", Binary)
 
     # Instead of being stored in the database, the content of the
     # representation may be stored on a local file relative to the
@@ -6808,6 +7853,23 @@ class Representation(Base):
         UniqueConstraint('url', 'media_type'),
     )
 
+    # Content downloaded by streaming_http_get is kept in this
+    # directory, relative to the data root.
+    DOWNLOAD_DIRECTORY = "downloads"
+
+    # The key in Session.info under which downloaded files waiting
+    # for the session to be committed before they're deleted are kept.
+    DOWNLOADS_TO_REMOVE = "representation_downloads_to_remove"
+
+    # Large representations are kept in a content-addressed blob store
+    # in this directory, relative to the data root. Two representations
+    # with the same content share a file. BlobCollectionMonitor deletes
+    # files no representation points to any more.
+    BLOB_DIRECTORY = "blobs"
+
+    # streaming_http_get writes content to disk in pieces of this size.
+    STREAMING_CHUNK_SIZE = 1024 * 1024
+
     # A User-Agent to use when acting like a web browser.
     # BROWSER_USER_AGENT = "Mozilla/5.0 (Windows NT 6.3; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/37.0.2049.0 Safari/537.36 (Simplified)"
     BROWSER_USER_AGENT = "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:37.0) Gecko/20100101 Firefox/37.0"
@@ -6818,11 +7880,44 @@ class Representation(Base):
             return 1000000
         return (datetime.datetime.utcnow() - self.fetched_at).total_seconds()
 
+    @hybrid_property
+    def content(self):
+        """The content of the representation, whether it's kept in the
+        database or in the blob store.
+        """
+        if (self._content is None and self.in_blob_store
+            and Configuration.data_directory()
+            and os.path.exists(self.local_path)):
+            with open(self.local_path, "rb") as fh:
+                return fh.read()
+        return self._content
+
+    @content.setter
+    def _set_content(self, content):
+        """Keep `content` in the database.
+
+        If the old content was in the blob store, this representation
+        no longer points to it. Use store_content to put large content
+        in the blob store.
+        """
+        if self.in_blob_store:
+            self.local_content_path = None
+        self._content = content
+
+    @property
+    def in_blob_store(self):
+        return bool(
+            self.local_content_path
+            and self.local_content_path.startswith(self.BLOB_DIRECTORY + "/")
+        )
+
     @property
     def has_content(self):
-        if self.content and self.status_code == 200 and self.fetch_exception is None:
+        if self._content and self.status_code == 200 and self.fetch_exception is None:
             return True
-        if self.local_content_path and os.path.exists(self.local_content_path) and self.fetch_exception is None:
+        if (self.local_content_path and Configuration.data_directory()
+            and os.path.exists(self.local_path)
+            and self.fetch_exception is None):
             return True
         return False
 
@@ -6888,16 +7983,7 @@ class Representation(Base):
             max_age = max_age.total_seconds()
 
         # Do we already have a usable representation?
-        #
-        # 'Usable' means we tried it and either got some data or
-        # received a status code that's not in the 5xx series.
-        usable_representation = (
-            representation and not representation.fetch_exception
-            and (
-                representation.content or representation.local_path
-                or representation.status_code and representation.status_code / 100 != 5
-            )
-        )
+        usable_representation = representation and representation.is_usable
 
         # Assuming we have a usable representation, is it
         # fresh?
@@ -6931,10 +8017,7 @@ class Representation(Base):
             # We have a representation but it's not fresh. We will
             # be making a conditional HTTP request to see if there's
             # a new version.
-            if representation.last_modified:
-                headers['If-Modified-Since'] = representation.last_modified
-            if representation.etag:
-                headers['If-None-Match'] = representation.etag
+            headers.update(representation.conditional_request_headers)
 
         fetched_at = datetime.datetime.utcnow()
         if pause_before:
@@ -6942,8 +8025,14 @@ class Representation(Base):
         media_type = None
         fetch_exception = None
         exception_traceback = None
+        content_path = None
         try:
             status_code, headers, content = do_get(url, headers)
+            if isinstance(content, file):
+                # The content was written to disk rather than read
+                # into memory.
+                content_path = content.name
+                content = None
             if response_reviewer:
                 # An optional function passed to raise errors if the
                 # post response isn't worth caching.
@@ -6998,6 +8087,10 @@ class Representation(Base):
             # Representation object and return it as fresh.
             representation.status_code = status_code
             representation.content = content
+            if content_path:
+                representation.set_local_content_path(
+                    cls.normalize_content_path(content_path)
+                )
             representation.media_type = media_type
 
             for header, field in (
@@ -7011,11 +8104,16 @@ class Representation(Base):
                 setattr(representation, field, value)
 
             representation.headers = cls.headers_to_string(headers)
-            representation.content = content          
+            if content_path:
+                representation.content = content
+            else:
+                representation.store_content(content)
             representation.update_image_size()
             return representation, False
 
         # Okay, things didn't go so well.
+        if content_path and os.path.exists(content_path):
+            os.remove(content_path)
         date_string = fetched_at.strftime("%Y-%m-%d %H:%M:%S")
         representation.fetch_exception = representation.fetch_exception or (
             "Most recent fetch attempt (at %s) got status code %s" % (
@@ -7032,6 +8130,31 @@ class Representation(Base):
         representation.content = content
         return representation, False
 
+    @property
+    def is_usable(self):
+        """Did we fetch this representation and either get some data
+        or receive a status code that's not in the 5xx series?
+        """
+        return bool(
+            not self.fetch_exception
+            and (
+                self.content or self.local_path
+                or self.status_code and self.status_code / 100 != 5
+            )
+        )
+
+    @property
+    def conditional_request_headers(self):
+        """The headers to send when checking whether there's a newer
+        version of this representation.
+        """
+        headers = {}
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        return headers
+
     @classmethod
     def _best_media_type(cls, headers, default):
         """Determine the most likely media type for the given HTTP headers.
@@ -7135,15 +8258,54 @@ class Representation(Base):
         """
         if isinstance(content, unicode):
             content = content.encode("utf8")
-        self.content = content
-
-        self.local_content_path = self.normalize_content_path(content_path)
+        if content_path:
+            self.content = content
+            self.set_local_content_path(
+                self.normalize_content_path(content_path)
+            )
+        else:
+            self.set_local_content_path(None)
+            self.store_content(content)
         self.status_code = 200
         self.fetched_at = datetime.datetime.utcnow()
         self.fetch_exception = None
         self.update_image_size()
 
 
+    @classmethod
+    def blob_store(cls):
+        """The store for large representation bodies, or None if
+        they're all kept in the database.
+        """
+        data_directory = Configuration.data_directory()
+        if (not data_directory
+            or Configuration.representation_blob_threshold() is None):
+            return None
+        return LocalBlobStore(
+            os.path.join(data_directory, cls.BLOB_DIRECTORY)
+        )
+
+    def store_content(self, content):
+        """Keep newly obtained content in the database or, if it's
+        large, in the blob store.
+
+        .content reads it back from wherever it was kept. The old
+        content's blob, if any, is left for BlobCollectionMonitor,
+        since another representation may share it.
+        """
+        # Any file downloaded for the old content is out of date.
+        self.remove_downloaded_content()
+
+        store = self.blob_store()
+        if (not store or not content
+            or len(content) < Configuration.representation_blob_threshold()):
+            self.content = content
+            return
+
+        key = store.put(content)
+        self._content = None
+        self.local_content_path = os.path.join(self.BLOB_DIRECTORY, key)
+
     def set_as_mirrored(self):
         """Record the fact that the representation has been mirrored
         to its .mirror_url.
@@ -7165,6 +8327,82 @@ class Representation(Base):
         response = HTTP.get_with_timeout(url, headers=headers, **kwargs)
         return response.status_code, response.headers, response.content
 
+    @classmethod
+    def streaming_http_get(cls, url, headers, **kwargs):
+        """An HTTP-based GET that writes a successful response to a file
+        in the data directory, a piece at a time, instead of holding
+        it in memory.
+
+        :return: A 3-tuple (status_code, headers, content). If the
+        response was written to disk, `content` is the (closed) file,
+        and Representation.get will make it the representation's
+        local content.
+        """
+        if not 'allow_redirects' in kwargs:
+            kwargs['allow_redirects'] = True
+        kwargs['stream'] = True
+        response = HTTP.get_with_timeout(url, headers=headers, **kwargs)
+        data_directory = Configuration.data_directory()
+        if not data_directory or response.status_code / 100 != 2:
+            return response.status_code, response.headers, response.content
+
+        directory = os.path.join(data_directory, cls.DOWNLOAD_DIRECTORY)
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            # The directory already exists.
+            pass
+        fd, path = tempfile.mkstemp(dir=directory)
+        fh = os.fdopen(fd, "wb")
+        try:
+            for chunk in response.iter_content(cls.STREAMING_CHUNK_SIZE):
+                fh.write(chunk)
+        except Exception, e:
+            fh.close()
+            os.remove(path)
+            raise
+        finally:
+            response.close()
+        fh.close()
+        return response.status_code, response.headers, fh
+
+    def set_local_content_path(self, path):
+        """Point this representation at content stored on disk at
+        `path`, relative to the data directory.
+
+        A file streaming_http_get wrote the old content to is deleted.
+        """
+        if path != self.local_content_path:
+            self.remove_downloaded_content()
+        self.local_content_path = path
+
+    def remove_downloaded_content(self):
+        """Delete the file streaming_http_get wrote this representation's
+        content to, if there is one.
+
+        Content stored on disk by other means is left alone.
+
+        If this representation is in a session, the file is only
+        deleted once the session is committed. Until then, the
+        database still points to it, and if the session is rolled
+        back it's kept.
+        """
+        if not self.local_content_path or not self.local_content_path.startswith(
+                self.DOWNLOAD_DIRECTORY + "/"):
+            return
+        path = self.local_path
+        self.local_content_path = None
+        _db = Session.object_session(self)
+        if _db:
+            _db.info.setdefault(self.DOWNLOADS_TO_REMOVE, set()).add(path)
+        else:
+            self._remove_file(path)
+
+    @classmethod
+    def _remove_file(cls, path):
+        if os.path.exists(path):
+            os.remove(path)
+
     @classmethod
     def simple_http_post(cls, url, headers, **kwargs):
         """The most simple HTTP-based POST."""
@@ -7328,8 +8566,8 @@ class Representation(Base):
         This works whether the representation is kept in the database
         or in a file on disk.
         """
-        if self.content:
-            return StringIO(self.content)
+        if self._content:
+            return StringIO(self._content)
         elif self.local_path:
             if not os.path.exists(self.local_path):
                 raise ValueError("%s does not exist." % self.local_path)
@@ -7342,7 +8580,7 @@ class Representation(Base):
             raise ValueError(
                 "Cannot load non-image representation as image: type %s." 
                 % self.media_type)
-        if not self.content and not self.local_path:
+        if not self._content and not self.local_path:
             raise ValueError("Image representation has no content.")
 
         fh = self.content_fh()
@@ -7463,6 +8701,154 @@ class Representation(Base):
         thumbnail.scaled_at = now
         return thumbnail, True      
 
+    _thumbnail_pool = None
+
+    @classmethod
+    def thumbnail_pool(cls):
+        """The pool of processes used by scale_many(), or None if images
+        should be scaled in this process.
+        """
+        if cls._thumbnail_pool is None:
+            processes = Configuration.thumbnail_processes()
+            if processes > 0:
+                import multiprocessing
+                Representation._thumbnail_pool = multiprocessing.Pool(
+                    processes
+                )
+        return cls._thumbnail_pool
+
+    @classmethod
+    def close_thumbnail_pool(cls):
+        """Shut down the thumbnailing processes, if there are any."""
+        pool = cls._thumbnail_pool
+        if pool is None:
+            return
+        Representation._thumbnail_pool = None
+        pool.close()
+        pool.join()
+
+    @classmethod
+    def scale_many(cls, jobs, force=False):
+        """Scale down a number of images at once.
+
+        The images are decoded and scaled by the thumbnailing pool,
+        each image only once no matter how many sizes are wanted. The
+        database is only used in this process.
+
+        :param jobs: A list of (representation, sizes) 2-tuples. `sizes`
+        is a list of (max_height, max_width, destination_url,
+        destination_media_type) 4-tuples, the arguments that would be
+        passed into scale().
+
+        :return: A dictionary mapping each representation to a list
+        of (Representation, is_new) 2-tuples, one for each of its
+        sizes, as scale() would return them.
+        """
+        if not jobs:
+            return {}
+        _db = Session.object_session(jobs[0][0])
+        for representation, sizes in jobs:
+            for max_height, max_width, url, media_type in sizes:
+                if not media_type in cls.pil_format_for_media_type:
+                    raise ValueError(
+                        "Unsupported destination media type: %s" % media_type
+                    )
+
+        # Find all the thumbnails that already exist with one query.
+        urls = set(url for r, sizes in jobs for h, w, url, t in sizes)
+        existing = dict(
+            ((x.url, x.media_type), x)
+            for x in _db.query(Representation).filter(
+                Representation.url.in_(urls)
+            )
+        )
+        preexisting = set(existing.values())
+
+        results = {}
+        todo = []
+        data = []
+        for representation, sizes in jobs:
+            thumbnails = [existing.get((url, media_type))
+                          for h, w, url, media_type in sizes]
+            if not force and all(thumbnails):
+                # We're allowed to use the thumbnails we already have.
+                for thumbnail in thumbnails:
+                    thumbnail.thumbnail_of = representation
+                results[representation] = [(x, False) for x in thumbnails]
+                continue
+            todo.append((representation, sizes))
+            path = None
+            if not representation.content:
+                path = representation.local_path
+            data.append((
+                representation.content, path, representation.media_type,
+                [(w, h, cls.pil_format_for_media_type[media_type])
+                 for h, w, url, media_type in sizes]
+            ))
+
+        pool = cls.thumbnail_pool()
+        scaled = None
+        if pool and len(data) > 1:
+            try:
+                scaled = pool.map(_scale_image, data)
+            except Exception, e:
+                logging.error(
+                    "Exception scaling images in parallel", exc_info=e
+                )
+        if scaled is None:
+            scaled = map(_scale_image, data)
+
+        now = datetime.datetime.utcnow()
+        for (representation, sizes), (size, images, exception) in zip(
+                todo, scaled):
+            if exception:
+                representation.scale_exception = exception
+                representation.scaled_at = None
+                # This most likely indicates an error during the
+                # fetch phase.
+                representation.fetch_exception = (
+                    "Error found while scaling: %s" % exception
+                )
+                logging.error(
+                    "Error found while scaling %r: %s", representation,
+                    exception
+                )
+                results[representation] = [(representation, False)] * len(sizes)
+                continue
+
+            representation.image_width, representation.image_height = size
+            results[representation] = []
+            for (max_height, max_width, url, media_type), image in zip(
+                    sizes, images):
+                if image is None:
+                    # The image is already small enough.
+                    representation.thumbnails = []
+                    results[representation].append((representation, False))
+                    continue
+                thumbnail = existing.get((url, media_type))
+                if not thumbnail:
+                    thumbnail = Representation(url=url, media_type=media_type)
+                    _db.add(thumbnail)
+                    existing[(url, media_type)] = thumbnail
+                thumbnail.thumbnail_of = representation
+                if not force and thumbnail in preexisting:
+                    # We found a preexisting thumbnail and we're
+                    # allowed to use it.
+                    results[representation].append((thumbnail, False))
+                    continue
+
+                # Because the thumbnail is being changed, it will need
+                # to be mirrored later on.
+                thumbnail.mirror_url = thumbnail.url
+                thumbnail.mirrored_at = None
+                thumbnail.mirror_exception = None
+                (thumbnail.content, thumbnail.image_width,
+                 thumbnail.image_height) = image
+                thumbnail.scale_exception = None
+                thumbnail.scaled_at = now
+                results[representation].append((thumbnail, True))
+        return results
+
     @property
     def thumbnail_size_quality_penalty(self):
         return self._thumbnail_size_quality_penalty(
@@ -7526,7 +8912,81 @@ class Representation(Base):
         return quotient
 
 
-class DeliveryMechanism(Base):
+def _scale_image(data):
+    """Scale an image down to one or more sizes, decoding it only
+    once. Runs in a thumbnailing process.
+
+    :param data: A 4-tuple (content, path, media_type, sizes). The
+    image is read from `content`, or from the file at `path` if there
+    is no content. `sizes` is a list of (max_width, max_height,
+    pil_format) 3-tuples.
+
+    :return: A 3-tuple (size, images, exception). `size` is the
+    (width, height) of the original image. `images` contains a
+    (content, width, height) 3-tuple for each item in `sizes`, or None
+    if the original image is already small enough. If the image
+    couldn't be scaled, `exception` is the traceback.
+    """
+    content, path, media_type, sizes = data
+    try:
+        if not media_type or not media_type.startswith("image/"):
+            raise ValueError(
+                "Cannot load non-image representation as image: type %s."
+                % media_type)
+        if not content:
+            if not path:
+                raise ValueError("Image representation has no content.")
+            content = open(path).read()
+        is_svg = (Representation._clean_media_type(media_type)
+                  == Representation.SVG_MEDIA_TYPE)
+        if is_svg:
+            content = cairosvg.svg2png(content)
+        image = Image.open(StringIO(content))
+        width, height = image.size
+        if image.format == 'JPEG':
+            # Have the JPEG decoder do most of the downscaling, rather
+            # than decoding the whole image and throwing most of it
+            # away.
+            image.draft('RGB', (max(x[0] for x in sizes),
+                                max(x[1] for x in sizes)))
+        image.load()
+
+        images = []
+        for max_width, max_height, pil_format in sizes:
+            if not is_svg and height <= max_height and width <= max_width:
+                images.append(None)
+                continue
+            thumbnail = image.copy()
+            thumbnail.thumbnail((max_width, max_height), Image.ANTIALIAS)
+            if thumbnail.mode != 'RGB':
+                thumbnail = thumbnail.convert('RGB')
+            output = StringIO()
+            thumbnail.save(output, pil_format)
+            images.append((output.getvalue(),) + thumbnail.size)
+        return (width, height), images, None
+    except Exception, e:
+        return None, None, traceback.format_exc()
+
+
+def remove_downloads_after_commit(session):
+    """Delete the downloaded files that Representations stopped using
+    in the transaction that was just committed.
+    """
+    paths = session.info.pop(Representation.DOWNLOADS_TO_REMOVE, None)
+    for path in paths or []:
+        Representation._remove_file(path)
+
+def keep_downloads_after_rollback(session):
+    """The Representations that stopped using downloaded files in a
+    transaction that was rolled back still use them.
+    """
+    session.info.pop(Representation.DOWNLOADS_TO_REMOVE, None)
+
+event.listen(Session, 'after_commit', remove_downloads_after_commit)
+event.listen(Session, 'after_rollback', keep_downloads_after_rollback)
+
+
+class DeliveryMechanism(Base, HasLookupCache):
     """A technique for delivering a book to a patron.
 
     There are two parts to this: a DRM scheme and a content
@@ -7595,10 +9055,16 @@ class DeliveryMechanism(Base):
 
     @classmethod
     def lookup(cls, _db, content_type, drm_scheme):
-        return get_one_or_create(
+        key = (content_type, drm_scheme)
+        mechanism = cls.from_lookup_cache(_db, key)
+        if mechanism:
+            return mechanism, False
+        mechanism, is_new = get_one_or_create(
             _db, DeliveryMechanism, content_type=content_type,
             drm_scheme=drm_scheme
         )
+        cls.add_to_lookup_cache(key, mechanism)
+        return mechanism, is_new
 
     @property
     def implicit_medium(self):
@@ -4,6 +4,7 @@ import os
 import logging
 import time
 import traceback
+from sqlalchemy.orm import defer
 from sqlalchemy.sql.functions import func
 from sqlalchemy.sql.expression import (
     or_,
@@ -12,18 +13,34 @@ from sqlalchemy.sql.expression import (
 import log # This sets the appropriate log format and level.
 from config import Configuration
 from coverage import CoverageFailure
+from lane import (
+    Facets,
+    Lane,
+    Pagination,
+)
 from model import (
+    get_one,
     get_one_or_create,
+    CachedFeed,
     CoverageRecord,
     Edition,
     CustomListEntry,
     Identifier,
     LicensePool,
     PresentationCalculationPolicy,
+    RecursiveEquivalentUpdate,
+    Representation,
     Subject,
     Timestamp,
     Work,
 )
+from opds import AcquisitionFeed
+from util.blob_store import LocalBlobStore
+from util.sharding import (
+    id_ranges,
+    run_in_processes,
+    session_for_new_process,
+)
 
 class Monitor(object):
 
@@ -99,6 +116,15 @@ class IdentifierSweepMonitor(Monitor):
     # this log level.
     COMPLETION_LOG_LEVEL = logging.INFO
 
+    # The column whose values are used as this monitor's counter.
+    ID_COLUMN = Identifier.id
+
+    # The sweep is only split among Configuration.sweep_processes()
+    # processes if this is True. A subclass should only set it if its
+    # run_once() restricts its query with in_shard(), and if its work
+    # can safely be done by several processes at once.
+    SHARDABLE = False
+
     def __init__(self, _db, name, interval_seconds=3600,
                  default_counter=0, batch_size=100):
         super(IdentifierSweepMonitor, self).__init__(
@@ -106,15 +132,30 @@ class IdentifierSweepMonitor(Monitor):
         self.default_counter = default_counter
         self.batch_size = batch_size
 
-    def run(self):        
+        # When the sweep is split into shards, this is the highest ID
+        # the current shard will process.
+        self.shard_end = None
+
+    def run(self):
+        processes = 1
+        if self.SHARDABLE:
+            processes = Configuration.sweep_processes()
+        if processes > 1:
+            return self.run_sharded(processes)
+        self.sweep(self.service_name, self.default_counter)
+
+    def sweep(self, service_name, default_counter):
+        """Sweep through the table, keeping track of progress in the
+        Timestamp for `service_name`.
+        """
         self.timestamp, new = get_one_or_create(
             self._db, Timestamp,
-            service=self.service_name,
+            service=service_name,
             create_method_kwargs=dict(
-                counter=self.default_counter
+                counter=default_counter
             )
         )
-        offset = self.timestamp.counter or self.default_counter
+        offset = self.timestamp.counter or default_counter
 
         started_at = datetime.datetime.utcnow()
         while not self.stop_running:
@@ -130,6 +171,11 @@ class IdentifierSweepMonitor(Monitor):
                 # We completed a sweep. We're done.
                 self.stop_running = True
                 self.cleanup()
+                if self.shard_end is not None:
+                    # Leave the shard's counter at the end of its
+                    # range, so that it's not swept again if the
+                    # other shards have to be resumed.
+                    new_offset = self.shard_end
             self.counter = new_offset
             self.timestamp.counter = self.counter
             self._db.commit()
@@ -144,9 +190,99 @@ class IdentifierSweepMonitor(Monitor):
                 time.sleep(to_sleep)
             offset = new_offset
 
+    def shard_service_name(self, shard, shards):
+        return "%s (shard %d of %d)" % (self.service_name, shard+1, shards)
+
+    @property
+    def shards_service_name(self):
+        """The service name of the Timestamp that records the highest ID
+        of a sharded sweep.
+        """
+        return "%s (shards)" % self.service_name
+
+    def run_sharded(self, processes):
+        """Split the ID space into ranges and sweep through each range
+        in a separate process.
+
+        Each shard keeps track of its progress in its own Timestamp.
+        Another Timestamp records the highest ID at the start of the
+        sweep, so that the shards stay the same until they have all
+        finished, even if the sweep is interrupted and resumed. This
+        monitor's own Timestamp, used when the sweep isn't sharded,
+        is left alone.
+        """
+        self.timestamp, new = get_one_or_create(
+            self._db, Timestamp,
+            service=self.shards_service_name,
+            create_method_kwargs=dict(counter=0)
+        )
+        if not self.timestamp.counter:
+            [highest_id] = self._db.query(func.max(self.ID_COLUMN)).one()
+            self.timestamp.counter = highest_id or 0
+            self._db.commit()
+        highest_id = self.timestamp.counter
+        shards = id_ranges(highest_id, processes)
+        service_names = [
+            self.shard_service_name(i, len(shards))
+            for i in range(len(shards))
+        ]
+
+        def progress():
+            """Log the progress of the shards, and return whether
+            they've all finished.
+            """
+            self._db.expire_all()
+            swept = 0
+            finished = True
+            for service_name, (start, end) in zip(service_names, shards):
+                timestamp = get_one(self._db, Timestamp, service=service_name)
+                counter = (timestamp and timestamp.counter) or start
+                swept += min(max(counter - start, 0), end - start)
+                if counter < end:
+                    finished = False
+            self.log.info(
+                "Swept %d/%d IDs (%.1f%%)", swept, highest_id,
+                100.0 * swept / max(highest_id, 1)
+            )
+            self._db.commit()
+            return finished
+
+        exit_codes = run_in_processes(
+            self._run_shard,
+            [(service_name, start, end)
+             for service_name, (start, end) in zip(service_names, shards)],
+            progress=progress
+        )
+        if progress() and not any(exit_codes):
+            # Every shard has finished. The next sweep will start over,
+            # with newly calculated shards.
+            self.timestamp.counter = 0
+            for service_name in service_names:
+                timestamp = get_one(self._db, Timestamp, service=service_name)
+                if timestamp:
+                    timestamp.counter = 0
+            self._db.commit()
+
+    def _run_shard(self, service_name, start, end):
+        """Sweep through one range of IDs. This runs in its own process."""
+        # Hold on to the parent process's session so that it's not
+        # garbage collected, which would close the connection that
+        # the parent is still using.
+        self._parent_db = self._db
+        self._db = session_for_new_process(self._parent_db)
+        self.shard_end = end
+        self.service_name = service_name
+        self.sweep(service_name, start)
+
+    def in_shard(self, qu):
+        """Restrict a query to the IDs in the current shard, if any."""
+        if self.shard_end is not None:
+            qu = qu.filter(self.ID_COLUMN <= self.shard_end)
+        return qu
+
     def run_once(self, offset):
-        q = self.identifier_query().filter(
-            Identifier.id > offset).order_by(
+        q = self.in_shard(self.identifier_query().filter(
+            Identifier.id > offset)).order_by(
             Identifier.id).limit(self.batch_size)
         identifiers = q.all()
         if identifiers:
@@ -167,6 +303,8 @@ class IdentifierSweepMonitor(Monitor):
 
 class SubjectSweepMonitor(IdentifierSweepMonitor):
 
+    ID_COLUMN = Subject.id
+
     def __init__(self, _db, name, subject_type=None, filter_string=None,
                  batch_size=500):
         super(SubjectSweepMonitor, self).__init__(
@@ -176,8 +314,8 @@ class SubjectSweepMonitor(IdentifierSweepMonitor):
         self.filter_string = filter_string
 
     def run_once(self, offset):
-        q = self.subject_query().filter(
-            Subject.id > offset).order_by(
+        q = self.in_shard(self.subject_query().filter(
+            Subject.id > offset)).order_by(
             Subject.id).limit(self.batch_size)
         subjects = q.all()
         if subjects:
@@ -201,9 +339,11 @@ class SubjectSweepMonitor(IdentifierSweepMonitor):
 
 class CustomListEntrySweepMonitor(IdentifierSweepMonitor):
 
+    ID_COLUMN = CustomListEntry.id
+
     def run_once(self, offset):
-        q = self.custom_list_entry_query().filter(
-            CustomListEntry.id > offset).order_by(
+        q = self.in_shard(self.custom_list_entry_query().filter(
+            CustomListEntry.id > offset)).order_by(
             CustomListEntry.id).limit(self.batch_size)
         entries = q.all()
         if entries:
@@ -222,11 +362,13 @@ class CustomListEntrySweepMonitor(IdentifierSweepMonitor):
 
 class EditionSweepMonitor(IdentifierSweepMonitor):
 
+    ID_COLUMN = Edition.id
+
     def run_once(self, offset):
         if offset is None:
             offset = 0
-        q = self.edition_query().filter(
-            Edition.id > offset).order_by(
+        q = self.in_shard(self.edition_query().filter(
+            Edition.id > offset)).order_by(
             Edition.id).limit(self.batch_size)
         editions = q.all()
         if editions:
@@ -249,11 +391,13 @@ class EditionSweepMonitor(IdentifierSweepMonitor):
 
 class WorkSweepMonitor(IdentifierSweepMonitor):
 
+    ID_COLUMN = Work.id
+
     def run_once(self, offset):
         if offset is None:
             offset = 0
-        q = self.work_query().filter(
-            Work.id > offset).order_by(
+        q = self.in_shard(self.work_query().filter(
+            Work.id > offset)).order_by(
             Work.id).limit(self.batch_size)
         works = q.all()
         if works:
@@ -281,6 +425,8 @@ class PresentationReadyWorkSweepMonitor(WorkSweepMonitor):
 
 class OPDSEntryCacheMonitor(PresentationReadyWorkSweepMonitor):
 
+    SHARDABLE = True
+
     def __init__(self, _db, interval_seconds=None,
                  include_verbose_entry=True):
         super(OPDSEntryCacheMonitor, self).__init__(
@@ -297,6 +443,8 @@ class SimpleOPDSEntryCacheMonitor(OPDSEntryCacheMonitor):
 
 class SubjectAssignmentMonitor(SubjectSweepMonitor):
 
+    SHARDABLE = True
+
     def __init__(self, _db, subject_type=None, filter_string=None,
                  interval_seconds=None):
         super(SubjectAssignmentMonitor, self).__init__(
@@ -316,6 +464,8 @@ class SubjectAssignmentMonitor(SubjectSweepMonitor):
 class PermanentWorkIDRefreshMonitor(EditionSweepMonitor):
     """Recalculate the permanent work ID for every edition."""
 
+    SHARDABLE = True
+
     def __init__(self, _db, interval_seconds=None):
         super(PermanentWorkIDRefreshMonitor, self).__init__(
             _db, "Permanent Work ID refresh", interval_seconds)
@@ -345,16 +495,26 @@ class PresentationReadyMonitor(WorkSweepMonitor):
         return self._db.query(Work).filter(not_presentation_ready)
 
     def run_once(self, offset):
-        # Consolidate works.
-        LicensePool.consolidate_works(
-            self._db,
-            calculate_work_even_if_no_author=self.calculate_work_even_if_no_author)
+        # Consolidate works. This looks at every LicensePool, so it
+        # must not be done by several shards at once. (This monitor
+        # isn't SHARDABLE, but a subclass might be.)
+        if self.shard_end is None:
+            LicensePool.consolidate_works(
+                self._db,
+                calculate_work_even_if_no_author=self.calculate_work_even_if_no_author)
 
         return super(PresentationReadyMonitor, self).run_once(offset)
 
     def process_batch(self, batch):
         max_id = 0
-        one_success = False
+        policy = PresentationCalculationPolicy(
+            choose_edition=False
+        )
+
+        # Run every work past the coverage providers first, so that
+        # any equivalencies they register are in place before the
+        # equivalent identifiers are looked up.
+        ready = []
         for work in batch:
             failures = None
             exception = None
@@ -383,12 +543,16 @@ class PresentationReadyMonitor(WorkSweepMonitor):
             if exception:
                 work.presentation_ready_exception = exception
             else:
-                policy = PresentationCalculationPolicy(
-                    choose_edition=False
+                ready.append(work)
+
+        if ready:
+            # Look up equivalent identifiers for all the works at once.
+            identifier_ids = Work.all_identifier_ids_for(ready)
+            for work in ready:
+                work.calculate_presentation(
+                    policy, identifier_ids=identifier_ids.get(work.id)
                 )
-                work.calculate_presentation(policy)
-                work.set_presentation_ready()                    
-                one_success = True
+                work.set_presentation_ready()
         self.finalize_batch()
         return max_id
 
@@ -413,6 +577,8 @@ class PresentationReadyMonitor(WorkSweepMonitor):
 
 class WorkRandomnessUpdateMonitor(WorkSweepMonitor):
 
+    SHARDABLE = True
+
     def __init__(self, _db, interval_seconds=3600*24,
                  default_counter=0, batch_size=1000):
         super(WorkRandomnessUpdateMonitor, self).__init__(
@@ -420,9 +586,17 @@ class WorkRandomnessUpdateMonitor(WorkSweepMonitor):
 
     def run_once(self, offset):
         new_offset = offset + self.batch_size
+        if self.shard_end is not None:
+            # IDs in this shard are greater than `offset` and no
+            # greater than shard_end.
+            new_offset = min(new_offset, self.shard_end + 1)
+            if offset >= new_offset:
+                return 0
         text = "update works set random=random() where id >= :offset and id < :new_offset;"
         self._db.execute(text, dict(offset=offset, new_offset=new_offset))
         [[self.max_work_id]] = self._db.execute('select max(id) from works')
+        if self.shard_end is not None:
+            self.max_work_id = min(self.max_work_id, self.shard_end)
         if self.max_work_id < new_offset:
             return 0
         return new_offset
@@ -430,6 +604,8 @@ class WorkRandomnessUpdateMonitor(WorkSweepMonitor):
 
 class CustomListEntryLicensePoolUpdateMonitor(CustomListEntrySweepMonitor):
 
+    SHARDABLE = True
+
     def __init__(self, _db, interval_seconds=3600*24,
                  default_counter=0, batch_size=100):
         super(CustomListEntryLicensePoolUpdateMonitor, self).__init__(
@@ -440,3 +616,254 @@ class CustomListEntryLicensePoolUpdateMonitor(CustomListEntrySweepMonitor):
     def process_entry(self, entry):
         entry.set_license_pool()
 
+
+
+class RecursiveEquivalentUpdateMonitor(Monitor):
+    """Recalculate the RecursiveEquivalents that were too expensive to
+    recalculate when the Equivalencies they depend on changed.
+    """
+
+    SERVICE_NAME = "Recursive equivalent update monitor"
+
+    def __init__(self, _db, interval_seconds=60, batch_size=100):
+        super(RecursiveEquivalentUpdateMonitor, self).__init__(
+            _db, self.SERVICE_NAME, interval_seconds
+        )
+        self.batch_size = batch_size
+
+    def run_once(self, start, cutoff):
+        while True:
+            processed = RecursiveEquivalentUpdate.process(
+                self._db, self.batch_size
+            )
+            self._db.commit()
+            if not processed:
+                break
+            self.log.info("Handled %d queued updates.", processed)
+
+
+class BlobCollectionMonitor(Monitor):
+    """Delete the files in the representation blob store that no
+    Representation points to any more.
+    """
+
+    SERVICE_NAME = "Blob collection monitor"
+
+    # A blob stored more recently than this may belong to a
+    # Representation that hasn't been committed yet, so it's left
+    # alone.
+    DEFAULT_GRACE_PERIOD = datetime.timedelta(days=1)
+
+    def __init__(self, _db, interval_seconds=3600,
+                 grace_period=DEFAULT_GRACE_PERIOD):
+        super(BlobCollectionMonitor, self).__init__(
+            _db, self.SERVICE_NAME, interval_seconds
+        )
+        self.grace_period = grace_period
+
+    def run_once(self, start, cutoff):
+        data_directory = Configuration.data_directory()
+        if not data_directory:
+            return
+        store = LocalBlobStore(
+            os.path.join(data_directory, Representation.BLOB_DIRECTORY)
+        )
+
+        # Look at the files before the database, so that any file
+        # that's in use is already in use by the time we check.
+        stored_before = time.time() - self.grace_period.total_seconds()
+        candidates = list(store.keys(stored_before))
+        if not candidates:
+            return
+
+        prefix = Representation.BLOB_DIRECTORY + "/"
+        qu = self._db.query(Representation.local_content_path).filter(
+            Representation.local_content_path.like(prefix + "%")
+        )
+        in_use = set(path[len(prefix):] for (path,) in qu)
+
+        removed = 0
+        for key in candidates:
+            # The blob may have been stored again since we looked.
+            if key not in in_use and store.remove(key, stored_before):
+                removed += 1
+        self.log.info("Removed %d unused blobs.", removed)
+
+
+class CachedFeedWarmingMonitor(Monitor):
+    """Regenerate cached OPDS feeds before they go stale, so that
+    patrons don't have to wait while a feed is generated.
+
+    Every groups feed, and the first page of every lane under the
+    default facets, is kept warm. So is the first page of every other
+    combination of enabled facets that someone has actually asked
+    for. The most frequently requested feeds are regenerated first.
+    """
+
+    SERVICE_NAME = "Cached feed warming monitor"
+
+    # A feed that may be cached forever is regenerated once it gets
+    # this old.
+    DEFAULT_FOREVER_REFRESH_AGE = datetime.timedelta(days=1)
+
+    def __init__(self, _db, lanes, annotator, interval_seconds=600,
+                 use_materialized_works=True,
+                 forever_refresh_age=DEFAULT_FOREVER_REFRESH_AGE):
+        """Constructor.
+
+        :param lanes: A Lane or LaneList at the top of the hierarchy.
+        :param annotator: The Annotator used to generate the feeds
+        patrons see.
+        """
+        super(CachedFeedWarmingMonitor, self).__init__(
+            _db, self.SERVICE_NAME, interval_seconds
+        )
+        self.lanes = lanes
+        self.annotator = annotator
+        self.use_materialized_works = use_materialized_works
+        self.forever_refresh_age = forever_refresh_age
+
+    def run_once(self, start, cutoff):
+        for lane, type, facets in self.feeds_to_warm():
+            try:
+                self.warm(lane, type, facets)
+                self._db.commit()
+            except Exception, e:
+                self.log.error(
+                    "Error regenerating %s feed for %s", type, lane.name,
+                    exc_info=e
+                )
+                self._db.rollback()
+
+    def all_lanes(self):
+        """Yield every lane in the hierarchy, parents before children."""
+        if isinstance(self.lanes, Lane):
+            queue = [self.lanes]
+        else:
+            queue = list(self.lanes)
+        while queue:
+            lane = queue.pop(0)
+            yield lane
+            queue.extend(lane.sublanes)
+
+    def enabled_facets(self):
+        """Yield a Facets object for every combination of enabled facets."""
+        for order in Configuration.enabled_facets(
+                Facets.ORDER_FACET_GROUP_NAME):
+            for availability in Configuration.enabled_facets(
+                    Facets.AVAILABILITY_FACET_GROUP_NAME):
+                for collection in Configuration.enabled_facets(
+                        Facets.COLLECTION_FACET_GROUP_NAME):
+                    yield Facets(
+                        collection=collection, availability=availability,
+                        order=order
+                    )
+
+    @classmethod
+    def cache_key(cls, lane, type, facets):
+        """The values that identify the CachedFeed for a feed this
+        monitor would generate.
+        """
+        languages = None
+        if lane.languages:
+            languages = ",".join(lane.languages)
+        if type == CachedFeed.GROUPS_TYPE:
+            return (lane.name, languages, type, "", "")
+        return (lane.name, languages, type, facets.query_string,
+                Pagination.default().query_string)
+
+    def feeds_to_warm(self, now=None):
+        """Find the feeds that will go stale before this monitor runs
+        again.
+
+        :return: A list of (lane, feed type, facets) 3-tuples, the most
+        frequently requested feeds first.
+        """
+        now = now or datetime.datetime.utcnow()
+        lanes = list(self.all_lanes())
+        if not lanes:
+            return []
+
+        qu = self._db.query(CachedFeed).filter(
+            CachedFeed.lane_name.in_([lane.name for lane in lanes])
+        ).filter(
+            CachedFeed.license_pool_id==None
+        ).options(defer(CachedFeed.content))
+        cached_feeds = dict()
+        for cached in qu:
+            key = (cached.lane_name, cached.languages, cached.type,
+                   cached.facets, cached.pagination)
+            cached_feeds[key] = cached
+
+        default_facets = Facets.default()
+        all_facets = list(self.enabled_facets())
+        candidates = []
+        for lane in lanes:
+            if lane.has_visible_sublane():
+                candidates.append((lane, CachedFeed.GROUPS_TYPE, None, True))
+            for facets in all_facets:
+                always = (facets.query_string == default_facets.query_string)
+                candidates.append((lane, CachedFeed.PAGE_TYPE, facets, always))
+
+        to_warm = []
+        for index, (lane, type, facets, always) in enumerate(candidates):
+            cached = cached_feeds.get(self.cache_key(lane, type, facets))
+            request_count = 0
+            if cached:
+                request_count = cached.request_count or 0
+            if not always and not request_count:
+                # Nobody has asked for this feed.
+                continue
+            if not self.needs_refresh(cached, lane, type, now):
+                continue
+            # Sort by popularity, falling back to the lane hierarchy.
+            to_warm.append((-request_count, index, (lane, type, facets)))
+        return [feed for ignore, ignore, feed in sorted(to_warm)]
+
+    def needs_refresh(self, cached, lane, type, now):
+        """Will this cached feed be missing or stale by the time this
+        monitor runs again?
+        """
+        if not cached or not cached.timestamp:
+            return True
+        max_age = CachedFeed.max_cache_age(lane, type)
+        if max_age is Configuration.CACHE_FOREVER:
+            max_age = self.forever_refresh_age
+        elif isinstance(max_age, int):
+            max_age = datetime.timedelta(seconds=max_age)
+        if max_age is None:
+            return True
+        next_run = now + datetime.timedelta(seconds=self.interval_seconds)
+        return cached.timestamp + max_age <= next_run
+
+    def warm(self, lane, type, facets):
+        """Regenerate one feed, whether or not it's stale.
+
+        The feed is streamed, so its entries are serialized one at a
+        time instead of being built into a single document tree.
+
+        :return: The content of the regenerated feed.
+        """
+        self.log.info("Regenerating %s feed for %s", type, lane.name)
+        if type == CachedFeed.GROUPS_TYPE:
+            url = self.annotator.groups_url(lane)
+            chunks = AcquisitionFeed.groups(
+                self._db, lane.display_name, url, lane, self.annotator,
+                force_refresh=True,
+                use_materialized_works=self.use_materialized_works,
+                stream=True
+            )
+        else:
+            pagination = Pagination.default()
+            url = self.annotator.feed_url(lane, facets, pagination)
+            chunks = AcquisitionFeed.page(
+                self._db, lane.display_name, url, lane, self.annotator,
+                facets=facets, pagination=pagination, force_refresh=True,
+                use_materialized_works=self.use_materialized_works,
+                stream=True
+            )
+        # The entries are built as the chunks are consumed, so the
+        # session can only be committed afterwards.
+        content = "".join(chunks)
+        self._db.commit()
+        return content
@@ -13,6 +13,7 @@ from sqlalchemy.orm.exc import (
 from opds_import import SimplifiedOPDSLookup
 
 from config import Configuration
+from rate_limit import RateLimiter
 from metadata_layer import (
     Metadata,
     IdentifierData,
@@ -51,13 +52,21 @@ class NYTBestSellerAPI(NYTAPI):
     LIST_MAX_AGE = timedelta(days=1)
     HISTORICAL_LIST_MAX_AGE = timedelta(days=365)
 
+    # Unless the integration says otherwise, make no more than this
+    # many requests per second.
+    DEFAULT_MAX_REQUESTS_PER_SECOND = 10
+
     def __init__(self, _db, api_key=None, do_get=None, metadata_client=None):
         self._db = _db
         integration = Configuration.integration(Configuration.NYT_INTEGRATION)
         self.api_key = api_key or integration[
             Configuration.NYT_BEST_SELLERS_API_KEY
         ]
-        self.do_get = do_get or Representation.simple_http_get
+        self.rate_limiter = RateLimiter.for_integration(
+            Configuration.NYT_INTEGRATION,
+            self.DEFAULT_MAX_REQUESTS_PER_SECOND
+        )
+        self.do_get = do_get or self._do_get
         if not metadata_client:
             metadata_url = Configuration.integration_url(
                 Configuration.METADATA_WRANGLER_INTEGRATION)
@@ -80,11 +89,15 @@ class NYTBestSellerAPI(NYTAPI):
             joiner = '&'
         url += joiner + "api-key=" + self.api_key
         representation, cached = Representation.get(
-            self._db, url, do_get=self.do_get, max_age=max_age, debug=True,
-            pause_before=0.1)
+            self._db, url, do_get=self.do_get, max_age=max_age, debug=True)
         content = json.loads(representation.content)
         return content
 
+    def _do_get(self, url, headers, **kwargs):
+        return Representation.simple_http_get(
+            url, headers, rate_limiter=self.rate_limiter, **kwargs
+        )
+
     def list_of_lists(self, max_age=LIST_OF_LISTS_MAX_AGE):
         return self.request(self.LIST_NAMES_URL, max_age=max_age)
 
@@ -19,6 +19,7 @@ from util.http import (
     HTTP,
     #RemoteIntegrationException,
 )
+from rate_limit import RateLimiter
 from coverage import CoverageFailure
 
 from model import (
@@ -58,6 +59,9 @@ class OneClickAPI(object):
     def __init__(self, _db, library_id=None, username=None, password=None, 
         remote_stage=None, base_url=None, basic_token=None):
         self._db = _db
+        self.rate_limiter = RateLimiter.for_integration(
+            Configuration.ONECLICK_INTEGRATION
+        )
         (env_library_id, env_username, env_password, 
          env_remote_stage, env_base_url, env_basic_token) = self.from_config()
             
@@ -136,7 +140,7 @@ class OneClickAPI(object):
         """Actually make an HTTP request."""
         return HTTP.request_with_timeout(
             method, url, headers=headers, data=data,
-            params=params, **kwargs
+            params=params, rate_limiter=self.rate_limiter, **kwargs
         )
 
 
@@ -643,6 +647,8 @@ class OneClickRepresentationExtractor(object):
 class OneClickBibliographicCoverageProvider(BibliographicCoverageProvider):
     """Fill in bibliographic metadata for OneClick records."""
 
+    INTEGRATION = Configuration.ONECLICK_INTEGRATION
+
     def __init__(self, _db, input_identifier_types=None, 
                  metadata_replacement_policy=None, oneclick_api=None,
                  **kwargs):
@@ -659,26 +665,31 @@ class OneClickBibliographicCoverageProvider(BibliographicCoverageProvider):
         )
 
 
-    def process_item(self, identifier):
+    def fetch(self, identifier):
         """ OneClick availability information is served separately from 
         the book's metadata.  Furthermore, the metadata returned by the 
         "book by isbn" request is less comprehensive than the data returned 
         by the "search titles/genres/etc." endpoint.
 
-        This method hits the "by isbn" endpoint and updates the bibliographic 
-        metadata returned by it. 
+        This method hits the "by isbn" endpoint. process_fetched() updates
+        the bibliographic metadata returned by it.
+
+        :return: The response dictionary, or the ValueError or IOError
+        raised while trying to get it.
         """
         try:
-            response_dictionary = self.api.get_metadata_by_isbn(identifier)
-        except ValueError as error:
-            return CoverageFailure(identifier, error.message, data_source=self.output_source, transient=True)
-        except IOError as error:
-            return CoverageFailure(identifier, error.message, data_source=self.output_source, transient=True)
+            return self.api.get_metadata_by_isbn(identifier)
+        except (ValueError, IOError) as error:
+            return error
+
+    def process_fetched(self, identifier, response_dictionary):
+        if isinstance(response_dictionary, Exception):
+            return CoverageFailure(identifier, response_dictionary.message, data_source=self.output_source, transient=True)
 
         metadata = OneClickRepresentationExtractor.isbn_info_to_metadata(response_dictionary)
 
         if not metadata:
-            e = "Could not extract metadata from OneClick data: %r" % info
+            e = "Could not extract metadata from OneClick data: %r" % response_dictionary
             return CoverageFailure(identifier, e, data_source=self.output_source, transient=True)
 
         result = self.set_metadata(
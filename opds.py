@@ -19,6 +19,10 @@ import urllib
 
 from nose.tools import set_trace
 
+from sqlalchemy.orm import (
+    joinedload,
+    subqueryload,
+)
 from sqlalchemy.orm.query import Query
 from sqlalchemy.sql.expression import func
 from sqlalchemy.orm.session import Session
@@ -32,16 +36,20 @@ from classifier import Classifier
 from model import (
     BaseMaterializedWork,
     CachedFeed,
+    Contribution,
     CustomList,
     CustomListEntry,
     DataSource,
     Hyperlink,
+    LicensePool,
+    LicensePoolDeliveryMechanism,
     Resource,
     Identifier,
     Edition,
     Measurement,
     Subject,
     Work,
+    WorkGenre,
 )
 from lane import (
     Facets,
@@ -72,6 +80,13 @@ class Annotator(object):
 
     opds_cache_field = Work.simple_opds_entry.name
 
+    # If this is True, annotate_work_entry() only ever adds tags to
+    # the end of an entry, so a cached entry can be annotated without
+    # parsing it. Subclasses that only add tags may set this to True;
+    # their own subclasses that look at or change the existing
+    # contents of an entry must set it back to False.
+    splice_cached_entries = False
+
     @classmethod
     def annotate_work_entry(cls, work, license_pool, edition, identifier, feed,
                             entry):
@@ -91,6 +106,26 @@ class Annotator(object):
     def group_uri(cls, work, license_pool, identifier):
         return None, ""
 
+    @classmethod
+    def preload_options(cls):
+        """SQLAlchemy loader options for everything this Annotator
+        touches while building entries for a list of Works.
+
+        See AcquisitionFeed.preload().
+        """
+        license_pools = lambda: joinedload(Work.license_pools)
+        return [
+            joinedload(Work.presentation_edition),
+            joinedload(Work.summary).joinedload(Resource.representation),
+            subqueryload(Work.work_genres).joinedload(WorkGenre.genre),
+            license_pools().joinedload(LicensePool.presentation_edition),
+            license_pools().joinedload(LicensePool.data_source),
+            license_pools().joinedload(LicensePool.identifier),
+            license_pools().subqueryload(
+                LicensePool.delivery_mechanisms
+            ).joinedload(LicensePoolDeliveryMechanism.delivery_mechanism),
+        ]
+
     @classmethod
     def rating_tag(cls, type_uri, value):
         """Generate a schema:Rating tag for the given type and value."""
@@ -312,6 +347,9 @@ class VerboseAnnotator(Annotator):
 
     opds_cache_field = Work.verbose_opds_entry.name
 
+    # Ratings are only ever added to the end of an entry.
+    splice_cached_entries = True
+
     @classmethod
     def annotate_work_entry(cls, work, license_pool, edition, identifier, feed,
                             entry):
@@ -359,6 +397,23 @@ class VerboseAnnotator(Annotator):
         by_scheme.update(super(VerboseAnnotator, cls).categories(work))
         return by_scheme
 
+    @classmethod
+    def preload_options(cls):
+        """Also load every contributor to the editions used in entries."""
+        options = super(VerboseAnnotator, cls).preload_options()
+        for edition in (
+                joinedload(Work.presentation_edition),
+                joinedload(Work.license_pools).joinedload(
+                    LicensePool.presentation_edition
+                )
+        ):
+            options.append(
+                edition.subqueryload(Edition.contributions).joinedload(
+                    Contribution.contributor
+                )
+            )
+        return options
+
     @classmethod
     def authors(cls, work, license_pool, edition, identifier):
         """Create a detailed <author> tag for each author."""
@@ -408,9 +463,17 @@ class AcquisitionFeed(OPDSFeed):
 
     @classmethod
     def groups(cls, _db, title, url, lane, annotator,
-               force_refresh=False, use_materialized_works=True):
+               force_refresh=False, use_materialized_works=True,
+               stream=False):
         """The acquisition feed for 'featured' items from a given lane's
         sublanes, organized into per-lane groups.
+
+        :param stream: If True, return a generator of serialized
+        chunks instead of a CachedFeed. Entries are rendered and
+        serialized one at a time as the generator is consumed, and the
+        CachedFeed is updated once the last chunk has been generated.
+        The CachedFeed is updated in a separate session, so `_db` must
+        be committed before the generator is consumed.
         """
         # Find or create a CachedFeed.
         cached, usable = CachedFeed.fetch(
@@ -423,7 +486,7 @@ class AcquisitionFeed(OPDSFeed):
             force_refresh=force_refresh
         )
         if usable:
-            return cached
+            return cls._cached_chunks(cached, stream)
 
         works_and_lanes = lane.sublane_samples(
             use_materialized_works=use_materialized_works
@@ -444,7 +507,8 @@ class AcquisitionFeed(OPDSFeed):
                 _db, title, url, lane, annotator,
                 cache_type=CachedFeed.GROUPS_TYPE,
                 force_refresh=force_refresh,
-                use_materialized_works=use_materialized_works
+                use_materialized_works=use_materialized_works,
+                stream=stream
             )
             return cached
 
@@ -476,9 +540,12 @@ class AcquisitionFeed(OPDSFeed):
             annotator.lanes_by_work[work].append(v)
             all_works.append(work)
 
-        feed = AcquisitionFeed(
-            _db, title, url, all_works, annotator,
-        )
+        if stream:
+            feed = AcquisitionFeed(_db, title, url, [], annotator)
+        else:
+            feed = AcquisitionFeed(
+                _db, title, url, all_works, annotator,
+            )
 
         # Render a 'start' link and an 'up' link.
         top_level_title = annotator.top_level_title() or "Collection Home"
@@ -496,6 +563,9 @@ class AcquisitionFeed(OPDSFeed):
         
         annotator.annotate_feed(feed, lane)
 
+        if stream:
+            return feed.stream_entries(cached, url, all_works)
+
         content = unicode(feed)
         cached.update(content)
         return cached
@@ -504,9 +574,13 @@ class AcquisitionFeed(OPDSFeed):
     def page(cls, _db, title, url, lane, annotator=None,
              facets=None, pagination=None,
              cache_type=None, force_refresh=False,
-             use_materialized_works=True
+             use_materialized_works=True, stream=False
     ):
-        """Create a feed representing one page of works from a given lane."""
+        """Create a feed representing one page of works from a given lane.
+
+        :param stream: If True, return a generator of serialized
+        chunks instead of a CachedFeed. See groups().
+        """
         facets = facets or Facets.default()
         pagination = pagination or Pagination.default()
         cache_type = cache_type or CachedFeed.PAGE_TYPE
@@ -522,7 +596,7 @@ class AcquisitionFeed(OPDSFeed):
             force_refresh=force_refresh
         )
         if usable:
-            return cached
+            return cls._cached_chunks(cached, stream)
 
         if use_materialized_works:
             works_q = lane.materialized_works(facets, pagination)
@@ -533,14 +607,18 @@ class AcquisitionFeed(OPDSFeed):
             works = []
         else:
             works = works_q.all()
-        feed = cls(_db, title, url, works, annotator)
+        pagination.page_loaded(works)
+        if stream:
+            feed = cls(_db, title, url, [], annotator)
+        else:
+            feed = cls(_db, title, url, works, annotator)
 
         # Add URLs to change faceted views of the collection.
         for args in cls.facet_links(annotator, facets):
             OPDSFeed.add_link_to_feed(feed=feed.feed, **args)
 
-        if len(works) > 0:
-            # There are works in this list. Add a 'next' link.
+        if len(works) > 0 and pagination.has_next_page:
+            # There are more works after these. Add a 'next' link.
             OPDSFeed.add_link_to_feed(feed=feed.feed, rel="next", href=annotator.feed_url(lane, facets, pagination.next_page))
 
         if pagination.offset > 0:
@@ -566,10 +644,20 @@ class AcquisitionFeed(OPDSFeed):
         
         annotator.annotate_feed(feed, lane)
 
+        if stream:
+            return feed.stream_entries(cached, url, works)
+
         content = unicode(feed)
         cached.update(content)
         return cached
 
+    @classmethod
+    def _cached_chunks(cls, cached, stream):
+        """Return a usable CachedFeed the way the caller asked for it."""
+        if stream:
+            return iter([cached.content])
+        return cached
+
     @classmethod
     def search(cls, _db, title, url, lane, search_engine, query, pagination=None,
                annotator=None
@@ -645,6 +733,10 @@ class AcquisitionFeed(OPDSFeed):
 
         super(AcquisitionFeed, self).__init__(title, url)
 
+        # The Works loaded by the latest call to preload(). Holding on
+        # to them keeps them in the session's identity map.
+        self._preloaded = []
+        self.preload(works)
         lane_link = dict(rel="collection", href=url)
         for work in works:
             self.add_entry(work, lane_link)
@@ -655,6 +747,65 @@ class AcquisitionFeed(OPDSFeed):
                 entry = entry.tag
             self.feed.append(entry)
 
+    def preload(self, works):
+        """Load everything the annotator needs to build entries for
+        `works` with a fixed number of queries, rather than a few
+        queries for every work.
+
+        The objects end up in the session's identity map, so entries
+        built afterwards don't have to go back to the database. For a
+        MaterializedWork, that means the Work it was made from, whose
+        license pools are the ones the MaterializedWork points to.
+        The identity map only holds weak references, so the feed
+        keeps the loaded Works for as long as it lives.
+        """
+        works_by_id = dict()
+        for work in works:
+            if isinstance(work, tuple):
+                # LookupAcquisitionFeed deals in (identifier, work) tuples.
+                work = work[-1]
+            if isinstance(work, Work) and work.id:
+                works_by_id[work.id] = work
+            elif isinstance(work, BaseMaterializedWork) and work.works_id:
+                works_by_id[work.works_id] = work
+        if not works_by_id:
+            return
+        options = self.annotator.preload_options()
+        _db = Session.object_session(works_by_id.values()[0])
+        if not options or not _db:
+            return
+        self._preloaded = _db.query(Work).filter(
+            Work.id.in_(works_by_id.keys())
+        ).options(*options).all()
+
+    def entries(self, works, lane_link):
+        """Generate an <entry> (or a message) for each work that can be
+        turned into one, without adding any of them to the feed.
+
+        Cached entries are generated as strings with their annotations
+        spliced in, so they can go into the output without being parsed.
+        """
+        for work in works:
+            entry = self.create_entry(work, lane_link, serialized=True)
+            if entry is not None:
+                yield entry
+
+    def stream_entries(self, cached, url, works):
+        """Serialize this feed followed by an entry for each of `works`,
+        storing the result in `cached` once it's complete.
+
+        Everything the entries need is preloaded before this method
+        returns, and each entry is built as its chunk is asked for.
+        See CachedFeed.update_from_chunks() for what that means for
+        the session.
+
+        :return: A generator of serialized chunks.
+        """
+        self.preload(works)
+        lane_link = dict(rel="collection", href=url)
+        chunks = self.chunks(self.entries(works, lane_link))
+        return cached.update_from_chunks(chunks)
+
     def add_entry(self, work, lane_link):
         """Attempt to create an OPDS <entry>. If successful, append it to
         the feed.
@@ -667,8 +818,12 @@ class AcquisitionFeed(OPDSFeed):
         return entry
 
     def create_entry(self, work, lane_link, even_if_no_license_pool=False,
-                     force_create=False, use_cache=True):
-        """Turn a work into an entry for an acquisition feed."""
+                     force_create=False, use_cache=True, serialized=False):
+        """Turn a work into an entry for an acquisition feed.
+
+        :param serialized: If True, a cached entry may be returned as a
+        string, without being parsed. See _create_entry().
+        """
         identifier = None
         if isinstance(work, Edition):
             active_edition = work
@@ -716,7 +871,7 @@ class AcquisitionFeed(OPDSFeed):
         try:
             return self._create_entry(work, active_license_pool, active_edition,
                                       identifier, lane_link, force_create, 
-                                      use_cache)
+                                      use_cache, serialized)
         except UnfulfillableWork, e:
             logging.info(
                 "Work %r is not fulfillable, refusing to create an <entry>.",
@@ -735,7 +890,7 @@ class AcquisitionFeed(OPDSFeed):
             return None
 
     def _create_entry(self, work, license_pool, edition, identifier, lane_link,
-                      force_create=False, use_cache=True):
+                      force_create=False, use_cache=True, serialized=False):
 
         xml = None
         cache_hit = False
@@ -743,6 +898,16 @@ class AcquisitionFeed(OPDSFeed):
         if field and work and not force_create and use_cache:
             xml = getattr(work, field)
 
+        if (xml and serialized and self.annotator.splice_cached_entries
+            and self.ENTRY_END_TAG in xml):
+            # Annotate an empty <entry> and splice its contents into
+            # the cached entry, rather than parsing the cached entry.
+            annotations = AtomFeed.entry()
+            self._annotate_entry(
+                work, license_pool, edition, identifier, annotations
+            )
+            return self._splice(xml, annotations)
+
         if xml:
             cache_hit = True
             xml = etree.fromstring(xml)
@@ -756,6 +921,11 @@ class AcquisitionFeed(OPDSFeed):
             if field and use_cache:
                 setattr(work, field, data)
 
+        self._annotate_entry(work, license_pool, edition, identifier, xml)
+        return xml
+
+    def _annotate_entry(self, work, license_pool, edition, identifier, xml):
+        """Add the parts of an entry that aren't cached."""
         self.annotator.annotate_work_entry(
             work, license_pool, edition, identifier, self, xml)
 
@@ -766,7 +936,20 @@ class AcquisitionFeed(OPDSFeed):
                 xml, rel=OPDSFeed.GROUP_REL, href=group_uri,
                 title=group_title)
 
-        return xml
+    ENTRY_END_TAG = "</entry>"
+
+    @classmethod
+    def _splice(cls, xml, annotations):
+        """Insert the children of `annotations` at the end of the
+        serialized entry `xml`.
+        """
+        if not len(annotations):
+            return xml
+        index = xml.rindex(cls.ENTRY_END_TAG)
+        added = "".join(
+            etree.tostring(x, encoding=unicode) for x in annotations
+        )
+        return xml[:index] + added + xml[index:]
 
     def _make_entry_xml(self, work, license_pool, edition, identifier,
                         lane_link):
@@ -1126,7 +1309,7 @@ class LookupAcquisitionFeed(AcquisitionFeed):
     default LicensePool.
     """
 
-    def create_entry(self, work, lane_link):
+    def create_entry(self, work, lane_link, serialized=False):
         """Turn an Identifier and a Work into an entry for an acquisition
         feed.
         """
@@ -1163,7 +1346,7 @@ class LookupAcquisitionFeed(AcquisitionFeed):
         try:
             return self._create_entry(
                 work, active_licensepool, edition, identifier, lane_link,
-                use_cache=use_cache
+                use_cache=use_cache, serialized=serialized
             )
         except UnfulfillableWork, e:
             logging.info(
@@ -1180,6 +1363,8 @@ class LookupAcquisitionFeed(AcquisitionFeed):
 
 class TestAnnotator(Annotator):
 
+    splice_cached_entries = True
+
     @classmethod
     def lane_url(cls, lane):
         if lane and lane.has_visible_sublane():
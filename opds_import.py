@@ -5,14 +5,30 @@ from collections import (
     Counter,
 )
 import datetime
+from dateutil.parser import parse as parse_datetime
+from dateutil.tz import tzutc
 import feedparser
+try:
+    from feedparser import _sanitizeHTML as _feedparser_sanitize_html
+except ImportError, e:
+    _feedparser_sanitize_html = None
 import logging
+from multiprocessing.pool import ThreadPool
+import os
+import cPickle as pickle
+import tempfile
 import traceback
 import urllib
 from urlparse import urlparse, urljoin
 from sqlalchemy.orm.session import Session
 
 from lxml import builder, etree
+import lxml.html
+try:
+    from lxml.html.clean import Cleaner
+except ImportError, e:
+    # Newer releases of lxml ship this as a separate package.
+    Cleaner = None
 
 from monitor import Monitor
 from util import LanguageCodes
@@ -30,6 +46,7 @@ from metadata_layer import (
     MeasurementData,
     SubjectData,
     ReplacementPolicy,
+    ThumbnailBatch,
 )
 from model import (
     get_one,
@@ -41,17 +58,47 @@ from model import (
     Identifier,
     LicensePool,
     Measurement,
+    Representation,
     Subject,
     RightsStatus,
 )
 from coverage import CoverageFailure
-from util.http import HTTP
+from util.http import (
+    ConcurrentFetcher,
+    HTTP,
+)
 from util.opds_writer import (
     OPDSFeed,
     OPDSMessage,
 )
 from s3 import S3Uploader
 
+if Cleaner:
+    _html_cleaner = Cleaner(page_structure=False)
+else:
+    _html_cleaner = None
+
+
+def sanitize_html(value, media_type):
+    """Clean up HTML the way feedparser would, so that descriptions
+    found by the single-pass parser match the ones feedparser finds.
+
+    feedparser's sanitizer isn't part of its public API, so if it
+    can't be found, lxml's is used instead. If neither is available,
+    only the text of the HTML is kept.
+    """
+    if _feedparser_sanitize_html:
+        return _feedparser_sanitize_html(value, 'utf-8', media_type)
+    if not value.strip():
+        return value
+    if _html_cleaner:
+        return _html_cleaner.clean_html(value)
+    html = lxml.html.fromstring(value)
+    for tag in html.xpath('//script|//style'):
+        tag.drop_tree()
+    return html.text_content()
+
+
 class AccessNotAuthenticated(Exception):
     """No authentication is configured for this service"""
     pass
@@ -180,9 +227,38 @@ class OPDSXMLParser(XMLParser):
                    "opds": "http://opds-spec.org/2010/catalog",
                    "schema" : "http://schema.org/",
                    "atom" : "http://www.w3.org/2005/Atom",
+                   "bibframe" : "http://bibframe.org/vocab/",
     }
 
 
+class ParsedOPDSFeed(object):
+    """Everything that's needed from one page of an OPDS feed, found
+    in a single walk through the document by OPDSImporter.parse_page.
+
+    Nothing here comes from the database, so a page can be parsed in
+    any thread, and a ParsedOPDSFeed can be pickled.
+    """
+
+    def __init__(self, feed_url=None):
+        # The URL that relative links in the feed are relative to.
+        self.feed_url = feed_url
+
+        self.next_links = []
+
+        # An (identifier, last update date) 2-tuple for each <entry>.
+        self.last_update_dates = []
+
+        # A 4-tuple for each <entry>: the feedparser-style dictionary
+        # made from it, its identifier, the data found by
+        # OPDSImporter._detail_for_elementtree_entry, and the
+        # traceback of the exception raised while finding that data,
+        # if any.
+        self.entries = []
+
+        # An OPDSMessage for each <simplified:message>.
+        self.messages = []
+
+
 class OPDSImporter(object):
     """ Imports editions and license pools from an OPDS feed.
     Creates Edition, LicensePool and Work rows in the database, if those 
@@ -198,6 +274,16 @@ class OPDSImporter(object):
 
     COULD_NOT_CREATE_LICENSE_POOL = (
         "No existing license pool for this identifier and no way of creating one.")
+
+    ENTRY_TAG = '{%s}entry' % OPDSXMLParser.NAMESPACES['atom']
+    LINK_TAG = '{%s}link' % OPDSXMLParser.NAMESPACES['atom']
+    MESSAGE_TAG = '{%s}message' % OPDSXMLParser.NAMESPACES['simplified']
+
+    # When mirroring, the links in a feed are downloaded this many at
+    # a time, and no more than MIRROR_FETCHES_PER_HOST at a time from
+    # any one host.
+    MIRROR_FETCH_THREADS = 5
+    MIRROR_FETCHES_PER_HOST = 2
    
     def __init__(self, _db, data_source_name=DataSource.METADATA_WRANGLER,
                  identifier_mapping=None, mirror=None, http_get=None):
@@ -208,6 +294,8 @@ class OPDSImporter(object):
         self.metadata_client = SimplifiedOPDSLookup.from_config()
         self.mirror = mirror
         self.http_get = http_get
+        self.prefetched = None
+        self.thumbnail_batch = None
 
 
     def import_from_feed(self, feed, even_if_no_author=False, 
@@ -226,35 +314,61 @@ class OPDSImporter(object):
         # moving on. Let the exception propagate.
         metadata_objs, failures = self.extract_feed_data(feed, feed_url)
 
-        # make editions.  if have problem, make sure associated pool and work aren't created.
-        for key, metadata in metadata_objs.iteritems():
-            # key is identifier.urn here
+        # Start downloading everything that will be mirrored.
+        self.prefetched = self.prefetch_mirrored_links(
+            [x for key, x in metadata_objs.items() if key not in failures]
+        )
+        if self.mirror and Representation.thumbnail_pool():
+            # Cover thumbnails will be made all at once, by the
+            # thumbnailing processes, before any works are calculated.
+            self.thumbnail_batch = ThumbnailBatch()
 
-            # If there's a status message about this item, don't try to import it.
-            if key in failures.keys():
-                continue
+        try:
+            # make editions.  if have problem, make sure associated pool and work aren't created.
+            for key, metadata in metadata_objs.iteritems():
+                # key is identifier.urn here
 
-            try:
-                # Create an edition. This will also create a pool if there's circulation data.
-                edition = self.import_edition_from_metadata(
-                    metadata, even_if_no_author, immediately_presentation_ready
-                )
-                if edition:
-                    imported_editions[key] = edition
-            except Exception, e:
-                # Rather than scratch the whole import, treat this as a failure that only applies
-                # to this item.
-                self.log.error("Error importing an OPDS item", exc_info=e)
-                identifier, ignore = Identifier.parse_urn(self._db, key)
-                data_source = DataSource.lookup(self._db, self.data_source_name)
-                failure = CoverageFailure(identifier, traceback.format_exc(), data_source=data_source, transient=False)
-                failures[key] = failure
-                # clean up any edition might have created
-                if key in imported_editions:
-                    del imported_editions[key]
-                # Move on to the next item, don't create a work.
+                # If there's a status message about this item, don't try to import it.
+                if key in failures.keys():
+                    continue
+
+                try:
+                    # Create an edition. This will also create a pool if there's circulation data.
+                    edition = self.import_edition_from_metadata(
+                        metadata, even_if_no_author, immediately_presentation_ready
+                    )
+                    if edition:
+                        imported_editions[key] = edition
+                except Exception, e:
+                    # Rather than scratch the whole import, treat this as a failure that only applies
+                    # to this item.
+                    self.log.error("Error importing an OPDS item", exc_info=e)
+                    identifier, ignore = Identifier.parse_urn(self._db, key)
+                    data_source = DataSource.lookup(self._db, self.data_source_name)
+                    failure = CoverageFailure(identifier, traceback.format_exc(), data_source=data_source, transient=False)
+                    failures[key] = failure
+                    # clean up any edition might have created
+                    if key in imported_editions:
+                        del imported_editions[key]
+
+        finally:
+            self.finish_prefetching()
+
+        # An edition whose cover thumbnail couldn't be made is treated
+        # like one that couldn't be imported.
+        thumbnail_failures = self.make_thumbnails()
+        for key, edition in imported_editions.items():
+            identifier = edition.primary_identifier
+            if identifier not in thumbnail_failures:
                 continue
+            data_source = DataSource.lookup(self._db, self.data_source_name)
+            failures[key] = CoverageFailure(
+                identifier, thumbnail_failures[identifier],
+                data_source=data_source, transient=False
+            )
+            del imported_editions[key]
 
+        for key, edition in imported_editions.items():
             try:
                 pool, work = self.update_work_for_edition(
                     edition, even_if_no_author, immediately_presentation_ready
@@ -272,17 +386,88 @@ class OPDSImporter(object):
         return imported_editions.values(), pools.values(), works.values(), failures
 
 
-    def import_edition_from_metadata(
-            self, metadata, even_if_no_author, immediately_presentation_ready
-    ):
-        """ For the passed-in Metadata object, see if can find or create an Edition 
-            in the database.  Do not set the edition's pool or work, yet.
+    def prefetch_mirrored_links(self, metadatas):
+        """Start downloading every link in `metadatas` that will be
+        mirrored, several at a time.
+
+        :return: A ConcurrentFetcher whose get() method will hand out
+        the responses, or None if nothing is being downloaded.
         """
+        if not self.mirror or self.http_get or self.MIRROR_FETCH_THREADS < 2:
+            # A custom http_get function (such as a test's) might
+            # not be thread-safe.
+            return None
 
-        # Locate or create an Edition for this book.
-        edition, is_new_edition = metadata.edition(self._db)
+        links = []
+        for metadata in metadatas:
+            links.extend(metadata.links or [])
+            if metadata.circulation:
+                links.extend(metadata.circulation.links or [])
+        links = [x for x in links if x.rel in Hyperlink.MIRRORED and x.href]
+        if not links:
+            return None
 
-        policy = ReplacementPolicy(
+        # Don't download anything mirror_link won't ask for, and send
+        # the same conditional request headers Representation.get
+        # will send.
+        link_content = self.replacement_policy().link_content
+        urls = set(x.href for x in links)
+        headers = {}
+        for representation in self._db.query(Representation).filter(
+                Representation.url.in_(urls)):
+            if not representation.is_usable:
+                continue
+            if not link_content:
+                # mirror_link will use the representation we have.
+                urls.discard(representation.url)
+            else:
+                headers[representation.url] = (
+                    representation.conditional_request_headers
+                )
+        links = [x for x in links if x.href in urls]
+        if not links:
+            return None
+
+        # A book that wasn't prefetched still needs to be written to
+        # disk rather than read into memory.
+        fetcher = ConcurrentFetcher(
+            Representation.streaming_http_get, self.MIRROR_FETCH_THREADS,
+            self.MIRROR_FETCHES_PER_HOST
+        )
+        for link in links:
+            do_get = None
+            if link.rel != Hyperlink.OPEN_ACCESS_DOWNLOAD:
+                do_get = Representation.simple_http_get
+            fetcher.prefetch(link.href, headers.get(link.href, {}), do_get)
+        return fetcher
+
+    def finish_prefetching(self):
+        """Shut down the downloads started by prefetch_mirrored_links,
+        deleting any downloaded files that weren't used.
+        """
+        if not self.prefetched:
+            return
+        for status_code, headers, content in self.prefetched.close():
+            if isinstance(content, file) and os.path.exists(content.name):
+                os.remove(content.name)
+        self.prefetched = None
+
+    def make_thumbnails(self):
+        """Scale the cover images gathered while importing editions.
+
+        :return: A dictionary mapping the Identifier of each cover
+        whose thumbnail couldn't be made to a traceback.
+        """
+        if not self.thumbnail_batch:
+            return {}
+        try:
+            return self.thumbnail_batch.run()
+        finally:
+            self.thumbnail_batch = None
+
+    def replacement_policy(self):
+        """The ReplacementPolicy used when importing an edition."""
+        return ReplacementPolicy(
             subjects=True,
             links=True,
             contributions=True,
@@ -292,6 +477,21 @@ class OPDSImporter(object):
             mirror=self.mirror,
             http_get=self.http_get,
         )
+
+    def import_edition_from_metadata(
+            self, metadata, even_if_no_author, immediately_presentation_ready
+    ):
+        """ For the passed-in Metadata object, see if can find or create an Edition 
+            in the database.  Do not set the edition's pool or work, yet.
+        """
+
+        # Locate or create an Edition for this book.
+        edition, is_new_edition = metadata.edition(self._db)
+
+        policy = self.replacement_policy()
+        if self.prefetched:
+            policy.http_get = self.prefetched.get
+        policy.thumbnail_batch = self.thumbnail_batch
         metadata.apply(
             edition, self.metadata_client, replace=policy
         )
@@ -322,41 +522,110 @@ class OPDSImporter(object):
         return pool, work
 
     @classmethod
-    def extract_next_links(self, feed):
-        parsed = feedparser.parse(feed)
-        feed = parsed['feed']
+    def extract_next_links(cls, feed):
+        if isinstance(feed, ParsedOPDSFeed):
+            return feed.next_links
         next_links = []
-        if feed and 'links' in feed:
-            next_links = [
-                link['href'] for link in feed['links'] 
-                if link['rel'] == 'next'
-            ]
+        for tag in cls.parse_feed(feed):
+            if (tag.tag == cls.LINK_TAG and tag.get('rel') == 'next'
+                and tag.get('href')):
+                next_links.append(tag.get('href'))
         return next_links
-        
 
     @classmethod
     def extract_last_update_dates(cls, feed):
-        parsed_feed = feedparser.parse(feed)
-        return [
-            cls.last_update_date_for_feedparser_entry(entry)
-            for entry in parsed_feed['entries']
-        ]
+        if isinstance(feed, ParsedOPDSFeed):
+            return feed.last_update_dates
+        parser = OPDSXMLParser()
+        dates = []
+        for tag in cls.parse_feed(feed):
+            if tag.tag != cls.ENTRY_TAG:
+                continue
+            identifier = cls._text_of_subtag(parser, tag, 'atom:id')
+            updated = cls._datetime(
+                dict(updated_parsed=cls._updated_parsed(parser, tag)),
+                'updated_parsed'
+            )
+            dates.append((identifier, updated))
+        return dates
+
+    @classmethod
+    def parse_feed(cls, feed):
+        """Parse an OPDS feed in a single pass, yielding each child of
+        the <feed> tag (<entry>, <link>, <simplified:message> and so
+        on) as soon as it's complete.
 
+        Each tag is discarded once the caller is done with it, so
+        only one entry at a time is held in memory.
+        """
+        if isinstance(feed, unicode):
+            feed = feed.encode("utf8")
+        for event, tag in etree.iterparse(StringIO(feed)):
+            parent = tag.getparent()
+            if parent is None or parent.getparent() is not None:
+                continue
+            yield tag
+            tag.clear()
+            while tag.getprevious() is not None:
+                del parent[0]
+
+    @classmethod
+    def parse_page(cls, feed, feed_url=None):
+        """Walk through an OPDS feed once, finding everything that
+        OPDSImportMonitor and extract_feed_data need from it.
+
+        :param feed: The feed document.
+        :param feed_url: The URL that relative links in the feed are
+        relative to. If this isn't given, the feed's self link is
+        used, if it comes before the entries, as it normally does.
+
+        :return: A ParsedOPDSFeed.
+        """
+        parsed = ParsedOPDSFeed(feed_url)
+        parser = OPDSXMLParser()
+        for tag in cls.parse_feed(feed):
+            if tag.tag == cls.LINK_TAG:
+                rel = tag.get('rel')
+                href = tag.get('href')
+                if rel == 'self' and not parsed.feed_url:
+                    parsed.feed_url = href
+                elif rel == 'next' and href:
+                    parsed.next_links.append(href)
+
+            elif tag.tag == cls.MESSAGE_TAG:
+                parsed.messages.append(cls.extract_message(parser, tag))
+
+            elif tag.tag == cls.ENTRY_TAG:
+                entry = cls._feedparser_style_entry(parser, tag)
+                parsed.last_update_dates.append(
+                    (entry.get('id'), cls._datetime(entry, 'updated_parsed'))
+                )
+                identifier = cls._text_of_subtag(parser, tag, 'atom:id')
+                detail = failure = None
+                if identifier:
+                    try:
+                        detail = cls._detail_for_elementtree_entry(
+                            parser, tag, parsed.feed_url
+                        )
+                    except Exception, e:
+                        failure = traceback.format_exc()
+                parsed.entries.append((entry, identifier, detail, failure))
+        return parsed
 
     def extract_feed_data(self, feed, feed_url=None):
         """Turn an OPDS feed into lists of Metadata and CirculationData objects, 
         with associated messages and next_links.
+
+        :param feed: The feed document, or a ParsedOPDSFeed made from it.
         """
         data_source = DataSource.lookup(self._db, self.data_source_name)
-        fp_metadata, fp_failures = self.extract_data_from_feedparser(feed=feed, data_source=data_source)
-        # gets: medium, measurements, links, contributors, etc.
-        xml_data_meta, xml_failures = self.extract_metadata_from_elementtree(
+        fp_metadata, xml_data_meta, failures = self.extract_data_in_one_pass(
             feed, data_source=data_source, feed_url=feed_url
         )
 
         # translate the id in failures to identifier.urn
         identified_failures = {}
-        for id, failure in fp_failures.items() + xml_failures.items():
+        for id, failure in failures.items():
             external_identifier, ignore = Identifier.parse_urn(self._db, id)
             if self.identifier_mapping:
                 internal_identifier = self.identifier_mapping.get(
@@ -446,6 +715,159 @@ class OPDSImporter(object):
         return new_dict
 
 
+    @classmethod
+    def extract_data_in_one_pass(cls, feed, data_source, feed_url=None):
+        """Parse an OPDS feed once, extracting everything that
+        extract_data_from_feedparser and extract_metadata_from_elementtree
+        would extract between them.
+
+        :param feed: The feed document, or a ParsedOPDSFeed made from
+        it by parse_page, in which case `feed_url` is ignored.
+
+        :return: A 3-tuple (feedparser-style values, elementtree values,
+        failures). The first two are dictionaries mapping IDs to
+        dictionaries that can be used as keyword arguments to the
+        Metadata constructor.
+        """
+        if isinstance(feed, ParsedOPDSFeed):
+            parsed = feed
+        else:
+            parsed = cls.parse_page(feed, feed_url)
+        fp_values = {}
+        xml_values = {}
+        failures = {}
+        _db = Session.object_session(data_source)
+
+        for entry, identifier, detail, error in parsed.entries:
+            fp_identifier, fp_detail, failure = cls.data_detail_for_feedparser_entry(
+                entry=entry, data_source=data_source
+            )
+            if fp_identifier:
+                if failure:
+                    failures[fp_identifier] = failure
+                elif fp_detail:
+                    fp_values[fp_identifier] = fp_detail
+            else:
+                logging.error(
+                    "Tried to parse an element without a valid identifier.  feed_url=%s" % parsed.feed_url
+                )
+
+            if identifier:
+                if error:
+                    identifier_obj, ignore = Identifier.parse_urn(
+                        _db, identifier
+                    )
+                    failures[identifier] = CoverageFailure(
+                        identifier_obj, error, data_source,
+                        transient=True
+                    )
+                if detail:
+                    xml_values[identifier] = detail
+
+        for message in parsed.messages:
+            failure = cls.coveragefailure_from_message(data_source, message)
+            # A failure found in an <entry> tag takes precedence.
+            if failure and failure.obj.urn not in failures:
+                failures[failure.obj.urn] = failure
+
+        return fp_values, xml_values, failures
+
+    @classmethod
+    def _text_of_subtag(cls, parser, tag, path):
+        subtag = parser._xpath1(tag, path)
+        if subtag is None or subtag.text is None:
+            return None
+        return subtag.text.strip()
+
+    @classmethod
+    def _updated_parsed(cls, parser, entry_tag):
+        """Find an entry's last update date, as feedparser's
+        'updated_parsed' would. Like feedparser, fall back to the
+        publication date.
+        """
+        return (
+            cls._parsed_date(cls._text_of_subtag(parser, entry_tag, 'atom:updated'))
+            or cls._parsed_date(cls._text_of_subtag(parser, entry_tag, 'atom:published'))
+        )
+
+    @classmethod
+    def _parsed_date(cls, value):
+        """Turn a date string into a UTC time tuple, as feedparser does."""
+        if not value:
+            return None
+        try:
+            value = parse_datetime(value)
+        except (ValueError, OverflowError):
+            return None
+        if value.tzinfo:
+            value = value.astimezone(tzutc()).replace(tzinfo=None)
+        return value.timetuple()
+
+    @classmethod
+    def _feedparser_style_text(cls, tag):
+        """Turn an Atom text construct (such as <summary>) into the
+        dictionary feedparser would have made from it.
+        """
+        type = tag.get('type', 'text')
+        if type == 'xhtml':
+            media_type = 'application/xhtml+xml'
+            div = tag[0] if len(tag) else tag
+            value = (div.text or '') + ''.join(
+                etree.tostring(child, encoding=unicode) for child in div
+            )
+        else:
+            media_type = dict(text='text/plain', html='text/html').get(type, type)
+            value = (tag.text or '').strip()
+        if media_type in ('text/html', 'application/xhtml+xml'):
+            value = sanitize_html(value, media_type)
+        return dict(type=media_type, value=value)
+
+    @classmethod
+    def _feedparser_style_entry(cls, parser, entry_tag):
+        """Gather the information in an <atom:entry> tag that
+        data_detail_for_feedparser_entry needs, in the form feedparser
+        would have presented it.
+        """
+        entry = dict()
+        for key, paths in (
+                ('id', ['atom:id']),
+                ('title', ['atom:title']),
+                ('schema_alternativeheadline', ['schema:alternativeHeadline']),
+                ('publisher', ['dc:publisher', 'dcterms:publisher']),
+                ('language', ['dc:language', 'dcterms:language']),
+                ('rights', ['atom:rights', 'dc:rights']),
+        ):
+            for path in paths:
+                value = cls._text_of_subtag(parser, entry_tag, path)
+                if value is not None:
+                    entry[key] = value
+                    break
+
+        entry['updated_parsed'] = cls._updated_parsed(parser, entry_tag)
+        entry['published_parsed'] = cls._parsed_date(
+            cls._text_of_subtag(parser, entry_tag, 'atom:published')
+        )
+
+        distribution = parser._xpath1(entry_tag, 'bibframe:distribution')
+        if distribution is not None:
+            entry['bibframe_distribution'] = dict(
+                ('bibframe:' + etree.QName(k).localname.lower(), v)
+                for k, v in distribution.attrib.items()
+            )
+
+        entry['content'] = [
+            cls._feedparser_style_text(tag)
+            for tag in parser._xpath(entry_tag, 'atom:content')
+        ]
+        summary = parser._xpath1(entry_tag, 'atom:summary')
+        if summary is not None:
+            entry['summary_detail'] = cls._feedparser_style_text(summary)
+        elif entry['content']:
+            # Feedparser uses the content as the summary if there is
+            # no summary.
+            entry['summary_detail'] = dict(entry['content'][0])
+        return entry
+
     @classmethod
     def extract_data_from_feedparser(cls, feed, data_source):
         feedparser_parsed = feedparser.parse(feed)
@@ -667,33 +1089,37 @@ class OPDSImporter(object):
         """
         path = '/atom:feed/simplified:message'
         for message_tag in parser._xpath(feed_tag, path):
+            yield cls.extract_message(parser, message_tag)
 
-            # First thing to do is determine which Identifier we're
-            # talking about.
-            identifier_tag = parser._xpath1(message_tag, 'atom:id')
-            if identifier_tag is None:
-                urn = None
-            else:
-                urn = identifier_tag.text
+    @classmethod
+    def extract_message(cls, parser, message_tag):
+        """Convert a <simplified:message> tag into an OPDSMessage object."""
+        # First thing to do is determine which Identifier we're
+        # talking about.
+        identifier_tag = parser._xpath1(message_tag, 'atom:id')
+        if identifier_tag is None:
+            urn = None
+        else:
+            urn = identifier_tag.text
 
-            # What status code is associated with the message?
-            status_code_tag = parser._xpath1(message_tag, 'simplified:status_code')
-            if status_code_tag is None:
+        # What status code is associated with the message?
+        status_code_tag = parser._xpath1(message_tag, 'simplified:status_code')
+        if status_code_tag is None:
+            status_code = None
+        else:
+            try:
+                status_code = int(status_code_tag.text)
+            except ValueError:
                 status_code = None
-            else:
-                try:
-                    status_code = int(status_code_tag.text)
-                except ValueError:
-                    status_code = None
-
-            # What is the human-readable message?
-            description_tag = parser._xpath1(message_tag, 'schema:description')
-            if description_tag is None:
-                description = ''
-            else:
-                description = description_tag.text
-        
-            yield OPDSMessage(urn, status_code, description)
+
+        # What is the human-readable message?
+        description_tag = parser._xpath1(message_tag, 'schema:description')
+        if description_tag is None:
+            description = ''
+        else:
+            description = description_tag.text
+
+        return OPDSMessage(urn, status_code, description)
     
     @classmethod
     def coveragefailures_from_messages(cls, data_source, parser, feed_tag):
@@ -1010,6 +1436,12 @@ class OPDSImportMonitor(Monitor):
     """Periodically monitor an OPDS archive feed and import every edition
     it mentions.
     """
+
+    # If this is True, the next page is fetched and parsed in a
+    # background thread while the current page is checked for new
+    # data, and the next page to import is read back from disk while
+    # the current one is imported.
+    LOOK_AHEAD = True
     
     def __init__(self, _db, feed_url, default_data_source, import_class, 
                  interval_seconds=0, keep_timestamp=False,
@@ -1046,6 +1478,8 @@ class OPDSImportMonitor(Monitor):
         """Check if the feed contains any entries that haven't been imported
         yet. If force_import is set, every entry in the feed is
         treated as new.
+
+        :param feed: The feed document, or a ParsedOPDSFeed made from it.
         """
 
         # If force_reimport is set, we don't even need to check. Always
@@ -1055,17 +1489,34 @@ class OPDSImportMonitor(Monitor):
 
         last_update_dates = self.importer.extract_last_update_dates(feed)
 
+        # Look up the Identifiers and their CoverageRecords for the
+        # whole page at once.
+        identifiers_by_urn, ignore = Identifier.parse_urns(
+            self._db, [urn for urn, remote_updated in last_update_dates],
+            autocreate=False
+        )
+        data_source = DataSource.lookup(self._db, self.importer.data_source_name)
+        records_by_identifier_id = {}
+        if identifiers_by_urn:
+            identifier_ids = [x.id for x in identifiers_by_urn.values()]
+            records = self._db.query(CoverageRecord).filter(
+                CoverageRecord.identifier_id.in_(identifier_ids)
+            ).filter(
+                CoverageRecord.data_source==data_source
+            ).filter(
+                CoverageRecord.operation==CoverageRecord.IMPORT_OPERATION
+            )
+            for record in records:
+                records_by_identifier_id[record.identifier_id] = record
+
         new_data = False
-        for identifier, remote_updated in last_update_dates:
+        for urn, remote_updated in last_update_dates:
 
-            identifier, ignore = Identifier.parse_urn(self._db, identifier)
-            data_source = DataSource.lookup(self._db, self.importer.data_source_name)
+            identifier = identifiers_by_urn.get(urn)
             record = None
 
             if identifier:
-                record = CoverageRecord.lookup(
-                    identifier, data_source, operation=CoverageRecord.IMPORT_OPERATION
-                )
+                record = records_by_identifier_id.get(identifier.id)
 
             # If there was a transient failure last time we tried to
             # import this book, try again regardless of whether the
@@ -1110,16 +1561,38 @@ class OPDSImportMonitor(Monitor):
                 # There's no record of an attempt to import this book.
                 self.log.info(
                     "Counting %s as new because it has no CoverageRecord.", 
-                    identifier
+                    urn
                 )
                 new_data = True
                 break
         return new_data
 
-    def follow_one_link(self, link, do_get=None):
+    def follow_one_link(self, link, do_get=None, look_ahead=None):
         self.log.info("Following next link: %s", link)
         get = do_get or self._get
         status_code, content_type, feed = get(link, None)
+        return self.follow_fetched_link(link, feed, look_ahead)
+
+    def follow_fetched_link(self, link, feed, look_ahead=None):
+        """Decide whether to import a page that's been fetched, and
+        whether to go on to the next page.
+
+        The page is parsed once, and the result is used to check for
+        new data, to find the next links, and later to import it.
+
+        :param feed: The page, or a ParsedOPDSFeed made from it.
+        :param look_ahead: A function that's passed the page's next
+        links before the page is checked for new data.
+
+        :return: A 2-tuple (next links, ParsedOPDSFeed). If there's
+        nothing new on the page, there are no next links and no
+        ParsedOPDSFeed.
+        """
+        if not isinstance(feed, ParsedOPDSFeed):
+            feed = self.importer.parse_page(feed, link)
+
+        if look_ahead:
+            look_ahead(self.importer.extract_next_links(feed))
 
         new_data = self.check_for_new_data(feed)
 
@@ -1158,29 +1631,97 @@ class OPDSImportMonitor(Monitor):
         feeds = []
         queue = [self.feed_url]
         seen_links = set([])
-        
+        pool = None
+        if self.LOOK_AHEAD:
+            pool = ThreadPool(1)
+
+        # Pages being fetched and parsed ahead of time, by URL.
+        ahead = {}
+
+        def look_ahead(next_links):
+            # Start on the next page while this one is checked. If
+            # it turns out there's nothing new on this one, that
+            # request is wasted, but only one page is ever fetched
+            # ahead.
+            if not pool or ahead:
+                return
+            for next_link in next_links:
+                if next_link not in seen_links:
+                    ahead[next_link] = pool.apply_async(
+                        self._fetch_page, (next_link,)
+                    )
+                    break
+
+        def get(link, headers):
+            result = ahead.pop(link, None)
+            if result is None:
+                return self._get(link, headers)
+            return result.get()
+
         # First, follow the feed's next links until we reach a page with
         # nothing new. If any link raises an exception, nothing will be imported.
-        while queue:
-            new_queue = []
-
-            for link in queue:
-                if link in seen_links:
-                    continue
-                next_links, feed = self.follow_one_link(link)
-                new_queue.extend(next_links)
-                if feed:
-                    feeds.append((link, feed))
-                seen_links.add(link)
-
-            queue = new_queue
-
-        # Start importing at the end. If something fails, it will be easier to
-        # pick up where we left off.
-        for link, feed in reversed(feeds):
-            self.log.info("Importing next feed: %s", link)
-            self.import_one_feed(feed, link)
-            self._db.commit()
+        # Pages with new data are written to temporary files rather
+        # than kept in memory.
+        try:
+            while queue:
+                new_queue = []
+
+                for link in queue:
+                    if link in seen_links:
+                        continue
+                    next_links, feed = self.follow_one_link(
+                        link, do_get=get, look_ahead=look_ahead
+                    )
+                    new_queue.extend(next_links)
+                    if feed:
+                        feeds.append((link, self._spill(feed)))
+                    seen_links.add(link)
+
+                queue = new_queue
+
+            # Start importing at the end. If something fails, it will be easier to
+            # pick up where we left off.
+            to_import = list(reversed(feeds))
+            loading = None
+            for i, (link, spilled) in enumerate(to_import):
+                if loading:
+                    feed = loading.get()
+                else:
+                    feed = self._unspill(spilled)
+                loading = None
+                if pool and i+1 < len(to_import):
+                    # Read the next page back while this one is imported.
+                    loading = pool.apply_async(
+                        self._unspill, (to_import[i+1][1],)
+                    )
+                self.log.info("Importing next feed: %s", link)
+                self.import_one_feed(feed, link)
+                self._db.commit()
+        finally:
+            if pool:
+                pool.terminate()
+            for link, spilled in feeds:
+                spilled.close()
+
+    def _fetch_page(self, link):
+        """Fetch a page and parse it, as a background thread can."""
+        status_code, content_type, feed = self._get(link, None)
+        return status_code, content_type, self.importer.parse_page(feed, link)
+
+    def _spill(self, feed):
+        """Write a parsed page to a temporary file, which will be
+        deleted when it's closed.
+        """
+        spilled = tempfile.TemporaryFile()
+        pickle.dump(feed, spilled, pickle.HIGHEST_PROTOCOL)
+        return spilled
+
+    def _unspill(self, spilled):
+        """Read back a page written by _spill, and delete the file."""
+        spilled.seek(0)
+        feed = pickle.load(spilled)
+        spilled.close()
+        return feed
 
 
 class OPDSImporterWithS3Mirror(OPDSImporter):
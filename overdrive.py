@@ -8,6 +8,9 @@ import logging
 import urlparse
 import urllib
 import sys
+import threading
+
+from sqlalchemy.orm.session import Session
 
 from config import (
     temp_config, 
@@ -52,6 +55,7 @@ from util.http import (
     HTTP,
     BadResponseException,
 )
+from rate_limit import RateLimiter
 
 
 class OverdriveAPI(object):
@@ -77,6 +81,10 @@ class OverdriveAPI(object):
 
     MAX_CREDENTIAL_AGE = 50 * 60
 
+    # Metadata lookups may happen in several threads at once, but
+    # only one of them should refresh the credential.
+    credential_lock = threading.RLock()
+
     PAGE_SIZE_LIMIT = 300
     EVENT_SOURCE = "Overdrive"
 
@@ -101,6 +109,12 @@ class OverdriveAPI(object):
     def __init__(self, _db, testing=False):
         self._db = _db
 
+        # Only this thread may use self._db. See check_creds().
+        self.session_thread = threading.current_thread()
+        self.rate_limiter = RateLimiter.for_integration(
+            Configuration.OVERDRIVE_INTEGRATION
+        )
+
         # Set some stuff from environment variables
         self.testing = testing
         if not testing:
@@ -148,24 +162,47 @@ class OverdriveAPI(object):
     def source(self):
         return DataSource.lookup(self._db, DataSource.OVERDRIVE)
 
-    def check_creds(self, force_refresh=False):
-        """If the Bearer Token has expired, update it."""
+    def check_creds(self, force_refresh=False, rejected_token=None):
+        """If the Bearer Token has expired, update it.
+
+        get() may call this from a metadata lookup thread, which
+        mustn't use the session belonging to the thread that created
+        this object. Such a thread gets a session of its own.
+
+        :param rejected_token: The token the API just rejected. If
+        another thread has replaced it by the time this one gets the
+        lock, there's no need to refresh it again.
+        """
         if force_refresh:
             refresh_on_lookup = lambda x: x
         else:
             refresh_on_lookup = self.refresh_creds
 
-        credential = self.credential_object(refresh_on_lookup)
-        if force_refresh:
-            self.refresh_creds(credential)
-        self.token = credential.credential
-
-    def credential_object(self, refresh):
+        with self.credential_lock:
+            if (force_refresh and rejected_token is not None
+                and self.token != rejected_token):
+                return
+            if threading.current_thread() is self.session_thread:
+                _db = self._db
+            else:
+                _db = Session(bind=self._db.get_bind())
+            try:
+                credential = self.credential_object(refresh_on_lookup, _db)
+                if force_refresh:
+                    self.refresh_creds(credential)
+                self.token = credential.credential
+                if _db is not self._db:
+                    _db.commit()
+            finally:
+                if _db is not self._db:
+                    _db.close()
+
+    def credential_object(self, refresh, _db=None):
         """Look up the Credential object that allows us to use
         the Overdrive API.
         """
         return Credential.lookup(
-            self._db, DataSource.OVERDRIVE, None, None, refresh
+            _db or self._db, DataSource.OVERDRIVE, None, None, refresh
         )
 
     def refresh_creds(self, credential):
@@ -181,7 +218,8 @@ class OverdriveAPI(object):
 
     def get(self, url, extra_headers, exception_on_401=False):
         """Make an HTTP GET request using the active Bearer Token."""
-        headers = dict(Authorization="Bearer %s" % self.token)
+        token = self.token
+        headers = dict(Authorization="Bearer %s" % token)
         headers.update(extra_headers)
         status_code, headers, content = self._do_get(url, headers)
         if status_code == 401:
@@ -194,7 +232,7 @@ class OverdriveAPI(object):
                 )
             else:
                 # Refresh the token and try again.
-                self.check_creds(True)
+                self.check_creds(True, rejected_token=token)
                 return self.get(url, extra_headers, True)
         else:
             return status_code, headers, content
@@ -327,12 +365,15 @@ class OverdriveAPI(object):
     def _do_get(self, url, headers):
         """This method is overridden in MockOverdriveAPI."""
         return Representation.simple_http_get(
-            url, headers
+            url, headers, rate_limiter=self.rate_limiter
         )
 
     def _do_post(self, url, payload, headers, **kwargs):
         """This method is overridden in MockOverdriveAPI."""
-        return HTTP.post_with_timeout(url, payload, headers=headers, **kwargs)
+        return HTTP.post_with_timeout(
+            url, payload, headers=headers, rate_limiter=self.rate_limiter,
+            **kwargs
+        )
 
 
 class MockOverdriveAPI(OverdriveAPI):
@@ -870,6 +911,8 @@ class OverdriveRepresentationExtractor(object):
 class OverdriveBibliographicCoverageProvider(BibliographicCoverageProvider):
     """Fill in bibliographic metadata for Overdrive records."""
 
+    INTEGRATION = Configuration.OVERDRIVE_INTEGRATION
+
     def __init__(self, _db, input_identifier_types=None,
                  metadata_replacement_policy=None, overdrive_api=None,
                  **kwargs
@@ -883,8 +926,10 @@ class OverdriveBibliographicCoverageProvider(BibliographicCoverageProvider):
             batch_size=10, metadata_replacement_policy=metadata_replacement_policy, **kwargs
         )
 
-    def process_item(self, identifier):
-        info = self.api.metadata_lookup(identifier)
+    def fetch(self, identifier):
+        return self.api.metadata_lookup(identifier)
+
+    def process_fetched(self, identifier, info):
         error = None
         if info.get('errorCode') == 'NotFound':
             error = "ID not recognized by Overdrive: %s" % identifier.identifier
@@ -0,0 +1,255 @@
+"""Keep the rate of requests to a vendor's API within its limits."""
+import email.utils
+import fcntl
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+
+import flask
+from nose.tools import set_trace
+from flask.ext.babel import lazy_gettext as _
+
+from config import Configuration
+from util.http import RequestNetworkException
+
+
+class RateLimitExceeded(RequestNetworkException):
+    """A request wasn't made because it would have had to wait too long
+    for the rate limiter. It can be tried again later.
+    """
+    title = _("Too many requests to third-party service")
+    detail = _("The server is making too many requests to %(service)s. Try again later.")
+    internal_message = "Too many requests to %s: %s"
+
+    def __init__(self, service, wait):
+        super(RateLimitExceeded, self).__init__(
+            service, "Would have had to wait %.1f seconds." % wait
+        )
+        self.retry_after = wait
+
+
+class RateLimiter(object):
+    """A token bucket for requests to one integration's API.
+
+    Tokens are added to the bucket at `max_rate` per second, and the
+    bucket holds at most `burst` tokens. Every request takes a token,
+    waiting for one if the bucket is empty.
+
+    The state of the bucket is kept in a file, which is locked while
+    it's used, so every process on the host that talks to the API
+    shares one bucket.
+
+    When the API says it's getting too many requests, the rate is
+    halved and no requests are made until the time given in any
+    Retry-After header. Each successful request then brings the rate
+    a little closer to `max_rate`.
+
+    By default a request waits as long as it has to. Scripts and
+    monitors would rather be slow than fail. But a request made while
+    handling a web request waits at most REQUEST_MAX_WAIT seconds,
+    so the patron isn't held up for minutes. A request that would
+    have to wait longer than that, or longer than `max_wait` if it's
+    set, raises RateLimitExceeded instead of waiting.
+    """
+
+    log = logging.getLogger("Rate limiter")
+
+    # These status codes mean we should slow down.
+    THROTTLE_STATUS_CODES = (429, 503)
+
+    # If we're told to slow down but not for how long, stop making
+    # requests for this many seconds.
+    DEFAULT_RETRY_AFTER = 1
+
+    # Never stop making requests for longer than this, whatever the
+    # Retry-After header says.
+    MAX_RETRY_AFTER = 600
+
+    # Unless told otherwise, a request made while handling a web
+    # request waits at most this many seconds for its turn.
+    REQUEST_MAX_WAIT = 10
+
+    # The rate never drops below this fraction of `max_rate`.
+    MIN_RATE_FRACTION = 0.05
+
+    # Each successful request raises the rate by this fraction of
+    # `max_rate`.
+    RECOVERY_FRACTION = 0.01
+
+    def __init__(self, name, max_rate, burst=1, directory=None,
+                 max_wait=None):
+        self.name = name
+        self.max_rate = float(max_rate)
+        self.burst = max(burst, 1)
+        self.max_wait = max_wait
+        directory = directory or tempfile.gettempdir()
+        filename = "rate-limit-" + re.sub("[^A-Za-z0-9]", "_", name)
+        self.path = os.path.join(directory, filename)
+        self.rate = self.max_rate
+
+    @classmethod
+    def for_integration(cls, integration_name, default_rate=None,
+                        max_wait=None):
+        """Create a RateLimiter for the API configured by an integration.
+
+        :param default_rate: The rate to use if the integration doesn't
+        set one.
+
+        :param max_wait: The longest a request may wait for its turn.
+        If this isn't given, the integration's setting is used. If
+        that isn't set either, requests wait as long as they have to,
+        except while handling a web request.
+
+        :return: A RateLimiter, or None if requests to the API shouldn't
+        be limited.
+        """
+        integration = Configuration.integration(integration_name)
+        rate = integration.get(
+            Configuration.MAX_REQUESTS_PER_SECOND, default_rate
+        )
+        if not rate:
+            return None
+        burst = int(integration.get(Configuration.REQUEST_BURST, 1))
+        if max_wait is None:
+            max_wait = integration.get(Configuration.RATE_LIMIT_MAX_WAIT)
+            if max_wait is not None:
+                max_wait = float(max_wait)
+        return cls(
+            integration_name, float(rate), burst,
+            Configuration.data_directory(), max_wait
+        )
+
+    def acquire(self):
+        """Wait until a request may be made, and take a token for it.
+
+        :raise RateLimitExceeded: If that would mean waiting longer
+        than `max_wait_now` says we may.
+        """
+        max_wait = self.max_wait_now()
+        while True:
+            wait = self._update(self._take_token)
+            if not wait:
+                return
+            if max_wait is not None and wait > max_wait:
+                raise RateLimitExceeded(self.name, wait)
+            self._sleep(wait)
+
+    def max_wait_now(self):
+        """The longest the current request may wait for its turn.
+
+        :return: A number of seconds, or None if it may wait as long
+        as it has to.
+        """
+        if self.max_wait is not None:
+            return self.max_wait
+        if flask.has_request_context():
+            return self.REQUEST_MAX_WAIT
+        return None
+
+    def update(self, status_code, headers=None):
+        """Adjust the rate according to the response to a request."""
+        if status_code in self.THROTTLE_STATUS_CODES:
+            retry_after = self.retry_after(headers)
+            self.log.warn(
+                "%s responded with status code %s. Waiting %.1f seconds.",
+                self.name, status_code, retry_after
+            )
+            self._update(
+                lambda state, now: self._throttle(state, now, retry_after)
+            )
+        elif self.rate < self.max_rate:
+            self._update(self._recover)
+
+    def retry_after(self, headers):
+        """How long the Retry-After header says to wait, in seconds."""
+        value = None
+        for k, v in (headers or {}).items():
+            if k.lower() == 'retry-after':
+                value = v
+        if not value:
+            return self.DEFAULT_RETRY_AFTER
+        try:
+            seconds = float(value)
+        except ValueError, e:
+            # The header may be a date rather than a number of seconds.
+            parsed = email.utils.parsedate_tz(value)
+            if not parsed:
+                return self.DEFAULT_RETRY_AFTER
+            seconds = email.utils.mktime_tz(parsed) - self._now()
+        return min(max(seconds, 0), self.MAX_RETRY_AFTER)
+
+    def _take_token(self, state, now):
+        """Take a token from the bucket.
+
+        :return: How long to wait before trying again, or 0 if a token
+        was taken.
+        """
+        if state['blocked_until'] > now:
+            return state['blocked_until'] - now
+        if state['tokens'] >= 1:
+            state['tokens'] -= 1
+            return 0
+        return (1 - state['tokens']) / state['rate']
+
+    def _throttle(self, state, now, retry_after):
+        state['rate'] = max(
+            state['rate'] / 2, self.max_rate * self.MIN_RATE_FRACTION
+        )
+        state['tokens'] = 0
+        state['blocked_until'] = max(
+            state['blocked_until'], now + retry_after
+        )
+
+    def _recover(self, state, now):
+        state['rate'] = min(
+            state['rate'] + self.max_rate * self.RECOVERY_FRACTION,
+            self.max_rate
+        )
+
+    def _update(self, change):
+        """Lock the bucket, top it up, and call `change` on its state.
+
+        :return: Whatever `change` returns.
+        """
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0644)
+        fh = os.fdopen(fd, "r+")
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            now = self._now()
+            try:
+                state = json.loads(fh.read())
+            except ValueError, e:
+                # This is a new bucket.
+                state = dict(
+                    tokens=self.burst, rate=self.max_rate, updated=now,
+                    blocked_until=0
+                )
+            # The maximum rate may have been changed since the bucket
+            # was last used.
+            state['rate'] = min(state['rate'], self.max_rate)
+            elapsed = max(now - state['updated'], 0)
+            state['tokens'] = min(
+                state['tokens'] + elapsed * state['rate'], self.burst
+            )
+            state['updated'] = now
+
+            result = change(state, now)
+
+            fh.seek(0)
+            fh.truncate()
+            fh.write(json.dumps(state))
+            fh.flush()
+            self.rate = state['rate']
+            return result
+        finally:
+            # This also releases the lock.
+            fh.close()
+
+    def _now(self):
+        return time.time()
+
+    def _sleep(self, seconds):
+        time.sleep(seconds)
@@ -126,8 +126,29 @@ class S3Uploader(MirrorUploader):
         """Mirror a single representation."""
         return self.mirror_batch([representation])
 
+    # No more than this many files are uploaded (and open) at once.
+    MAX_OPEN_FILES = 10
+
+    # If the connection to S3 fails, uploads that didn't finish are
+    # tried again, up to this many times in all.
+    UPLOAD_ATTEMPTS = 3
+
     def mirror_batch(self, representations):
         """Mirror a bunch of Representations at once."""
+        representations = list(representations)
+        for i in range(0, len(representations), self.MAX_OPEN_FILES):
+            unfinished = representations[i:i+self.MAX_OPEN_FILES]
+            for attempt in range(self.UPLOAD_ATTEMPTS):
+                unfinished = self._mirror_some(unfinished)
+                if not unfinished:
+                    break
+
+    def _mirror_some(self, representations):
+        """Upload some Representations at once.
+
+        :return: A list of the Representations whose uploads were
+        interrupted by a transient error.
+        """
         filehandles = []
         requests = []
         representations_by_response_url = dict()
@@ -154,7 +175,7 @@ class S3Uploader(MirrorUploader):
         # Do the upload.
 
         def process_response(response):
-            representation = representations_by_response_url[response.url]
+            representation = representations_by_response_url.pop(response.url)
             if response.status_code == 200:
                 source = representation.local_content_path
                 if representation.url != representation.mirror_url:
@@ -170,22 +191,24 @@ class S3Uploader(MirrorUploader):
                 representation.mirror_exception = "Status code %d: %s" % (
                     response.status_code, response.content)
 
+        unfinished = []
         try:
             for response in self.pool.as_completed(requests):
                 process_response(response)
         except ConnectionError, e:
             # This is a transient error; we can just try again.
             logging.error("S3 connection error: %r", e, exc_info=e)
-            pass
+            unfinished = representations_by_response_url.values()
         except HTTPError, e:
             # Probably also a transient error. In any case
             # there's nothing we can do about it but try again.
             logging.error("S3 HTTP error: %r", e, exc_info=e)
-            pass
-
-        # Close the filehandles
-        for fh in filehandles:
-            fh.close()
+            unfinished = representations_by_response_url.values()
+        finally:
+            # Close the filehandles
+            for fh in filehandles:
+                fh.close()
+        return unfinished
 
 class DummyS3Uploader(S3Uploader):
     """A dummy uploader for use in tests."""
@@ -27,10 +27,14 @@ from model import (
     production_session,
     CustomList,
     DataSource,
+    DeletedWork,
     Edition,
     Identifier,
     LicensePool,
+    PresentationBatch,
     PresentationCalculationPolicy,
+    Representation,
+    SessionManager,
     Subject,
     Timestamp,
     Work,
@@ -45,6 +49,11 @@ from opds_import import OPDSImportMonitor
 from util.opds_writer import OPDSFeed
 
 from monitor import SubjectAssignmentMonitor
+from util.sharding import (
+    id_ranges,
+    run_in_processes,
+    session_for_new_process,
+)
 
 from overdrive import (
     OverdriveBibliographicCoverageProvider,
@@ -121,6 +130,8 @@ class Script(object):
                 exc_info=e
             )
             raise e
+        finally:
+            Representation.close_thumbnail_pool()
 
     def load_configuration(self):
         if not Configuration.instance:
@@ -509,6 +520,14 @@ class WorkProcessingScript(IdentifierInputScript):
 
     name = "Work processing script"
 
+    # When the work is split among several processes, each process
+    # handles a range of values of this column.
+    ID_COLUMN = Work.id
+
+    # The work is only split among Configuration.sweep_processes()
+    # processes if this is True.
+    SHARDABLE = False
+
     def __init__(self, force=False, batch_size=10):
         args = self.parse_command_line(self._db)
         self.identifier_type = args.identifier_type
@@ -549,16 +568,60 @@ class WorkProcessingScript(IdentifierInputScript):
         return query.order_by(Work.id)
 
     def do_run(self):
+        processes = 1
+        if self.SHARDABLE:
+            processes = Configuration.sweep_processes()
+        if processes > 1:
+            self.run_sharded(processes)
+        else:
+            self.process_query(self.query)
+
+    def run_sharded(self, processes):
+        """Split the ID space into ranges and process each range in a
+        separate process.
+        """
+        [highest_id] = self._db.query(func.max(self.ID_COLUMN)).one()
+        shards = id_ranges(highest_id or 0, processes)
+        exit_codes = run_in_processes(self._run_shard, shards)
+        failed = [x for x in exit_codes if x]
+        if failed:
+            self.log.error(
+                "%d of %d shards did not finish.", len(failed), len(shards)
+            )
+
+    def _run_shard(self, start, end):
+        """Process the items whose IDs are greater than `start` and no
+        greater than `end`. This runs in its own process.
+        """
+        # Hold on to the parent process's session so that it's not
+        # garbage collected, which would close the connection that
+        # the parent is still using.
+        self._parent_db = self._db
+        self._session = session_for_new_process(self._parent_db)
+        query = self.make_query(
+            self._db, self.identifier_type, self.identifiers
+        )
+        query = query.filter(self.ID_COLUMN > start).filter(
+            self.ID_COLUMN <= end
+        )
+        self.log.info("Processing IDs %d-%d.", start+1, end)
+        self.process_query(query)
+        self.log.info("Finished processing IDs %d-%d.", start+1, end)
+
+    def process_query(self, query):
         works = True
         offset = 0
         while works:
-            works = self.query.offset(offset).limit(self.batch_size).all()
-            for work in works:
-                self.process_work(work)
+            works = query.offset(offset).limit(self.batch_size).all()
+            self.process_batch(works)
             offset += self.batch_size
             self._db.commit()
         self._db.commit()
 
+    def process_batch(self, works):
+        for work in works:
+            self.process_work(work)
+
     def process_work(self, work):
         raise NotImplementedError()      
 
@@ -575,6 +638,8 @@ class WorkConsolidationScript(WorkProcessingScript):
 
     name = "Work consolidation script"
 
+    ID_COLUMN = LicensePool.id
+
     def make_query(self, _db, identifier_type, identifiers, log=None):
         # We actually process LicensePools, not Works.
         qu = _db.query(LicensePool).join(LicensePool.identifier)
@@ -608,11 +673,20 @@ class WorkConsolidationScript(WorkProcessingScript):
 class WorkPresentationScript(WorkProcessingScript):
     """Calculate the presentation for Work objects."""
 
+    SHARDABLE = True
+
     # Do a complete recalculation of the presentation.
     policy = PresentationCalculationPolicy()
 
-    def process_work(self, work):
-        work.calculate_presentation(policy=self.policy)
+    def process_batch(self, works):
+        # Load everything the whole batch needs up front, rather than
+        # querying for it once per work.
+        batch = PresentationBatch(self._db, works, self.policy)
+        for work in batch.works:
+            self.process_work(work, batch)
+
+    def process_work(self, work, batch=None):
+        work.calculate_presentation(policy=self.policy, batch=batch)
 
 
 class WorkClassificationScript(WorkPresentationScript):
@@ -705,6 +779,13 @@ class OPDSImportScript(Script):
         self.importer_class = importer_class
         self.immediately_presentation_ready = immediately_presentation_ready
 
+    def run(self):
+        # Start the thumbnailing processes before there are any
+        # database connections for them to inherit.
+        self.load_configuration()
+        Representation.thumbnail_pool()
+        super(OPDSImportScript, self).run()
+
     def do_run(self):
         monitor = OPDSImportMonitor(
             self._db, self.feed_url, self.opds_data_source, 
@@ -747,6 +828,23 @@ class NYTBestSellerListsScript(Script):
 class RefreshMaterializedViewsScript(Script):
     """Refresh all materialized views."""
 
+    SERVICE_NAME = "Refresh Materialized Views"
+
+    # When finding works that changed since the last refresh, look
+    # back a little further than that, in case a transaction that
+    # started before the refresh committed after it.
+    INCREMENTAL_OVERLAP = datetime.timedelta(minutes=5)
+
+    # Not every change that affects a work's rows can be detected, so
+    # --incremental does a full refresh anyway if the last one was
+    # this long ago.
+    FULL_REFRESH_INTERVAL = datetime.timedelta(days=1)
+
+    @property
+    def full_refresh_service_name(self):
+        """The name of the Timestamp that records the last full refresh."""
+        return "%s (full)" % self.SERVICE_NAME
+
     @classmethod
     def arg_parser(cls):
         parser = argparse.ArgumentParser()
@@ -755,10 +853,18 @@ class RefreshMaterializedViewsScript(Script):
             help="Provide this argument if you're on an older version of Postgres and can't refresh materialized views concurrently.",
             action='store_true',
         )
+        parser.add_argument(
+            '--incremental',
+            help="Only update the works that have changed since the last refresh. A full refresh is done if that's not possible, or if the last full refresh was more than a day ago.",
+            action='store_true',
+        )
         return parser
 
     def do_run(self):
         args = self.parse_command_line()
+        if args.incremental and self.do_incremental_refresh():
+            return
+
         if args.blocking_refresh:
             concurrently = ''
         else:
@@ -769,12 +875,24 @@ class RefreshMaterializedViewsScript(Script):
             MaterializedWorkWithGenre,
         )
         db = self._db
+        start = datetime.datetime.utcnow()
         for i in (MaterializedWork, MaterializedWorkWithGenre):
             view_name = i.__table__.name
             a = time.time()
-            db.execute("REFRESH MATERIALIZED VIEW %s %s" % (concurrently, view_name))
+            if SessionManager.is_materialized_view(db, view_name):
+                db.execute("REFRESH MATERIALIZED VIEW %s %s" % (concurrently, view_name))
+            else:
+                SessionManager.rebuild_materialized_view(db, view_name)
             b = time.time()
             print "%s refreshed in %.2f sec." % (view_name, b-a)
+        self.stamp(start)
+        self.stamp(start, self.full_refresh_service_name)
+
+        # Deletions from before this refresh are reflected in the
+        # views, and an incremental refresh will never look for them.
+        self._db.query(DeletedWork).filter(
+            DeletedWork.timestamp < start - self.INCREMENTAL_OVERLAP
+        ).delete(synchronize_session=False)
 
         # Close out this session because we're about to create another one.
         db.commit()
@@ -784,11 +902,89 @@ class RefreshMaterializedViewsScript(Script):
         # time) wraps everything in a big transaction, but VACUUM
         # can't be executed within a transaction block. So create a
         # separate connection that uses autocommit.
+        self.vacuum("VACUUM (VERBOSE, ANALYZE)")
+
+    def do_incremental_refresh(self):
+        """Update the rows for works that have changed since the last
+        refresh.
+
+        :return: False if a full refresh is needed instead.
+        """
+        stamp = get_one(self._db, Timestamp, service=self.SERVICE_NAME)
+        if not stamp or not stamp.timestamp:
+            # We don't know what's changed since the views were created.
+            return False
+        start = datetime.datetime.utcnow()
+        full_refresh = get_one(
+            self._db, Timestamp, service=self.full_refresh_service_name
+        )
+        if (not full_refresh or not full_refresh.timestamp
+            or full_refresh.timestamp < start - self.FULL_REFRESH_INTERVAL):
+            # Pick up any changes we've missed.
+            return False
+        work_ids = self.changed_work_ids(
+            stamp.timestamp - self.INCREMENTAL_OVERLAP
+        )
+        a = time.time()
+        if not SessionManager.update_materialized_views(self._db, work_ids):
+            return False
+        b = time.time()
+        print "%d changed works updated in %.2f sec." % (len(work_ids), b-a)
+        self.stamp(start)
+        self._db.commit()
+
+        # Only the tables we changed need to be vacuumed.
+        self.vacuum(*[
+            "VACUUM ANALYZE %s" % view_name
+            for view_name in SessionManager.MATERIALIZED_VIEWS.keys()
+        ])
+        return True
+
+    def changed_work_ids(self, since):
+        """Find the IDs of works whose materialized view rows may have
+        changed since the given time.
+
+        A work counts as changed if its data changed (which is tracked
+        by Work.last_update_time), if some operation was performed
+        on it, such as regenerating its OPDS entries (which is tracked
+        by WorkCoverageRecord), or if the availability of one of its
+        license pools was checked (which is tracked by
+        LicensePool.last_checked). A work that was deleted (which is
+        tracked by DeletedWork) also counts, so that its rows are
+        removed.
+
+        A change that doesn't show up in any of these places is only
+        picked up by the next full refresh.
+        """
+        updated = self._db.query(Work.id).filter(
+            Work.last_update_time >= since
+        )
+        covered = self._db.query(WorkCoverageRecord.work_id).filter(
+            WorkCoverageRecord.timestamp >= since
+        )
+        checked = self._db.query(LicensePool.work_id).filter(
+            LicensePool.last_checked >= since
+        )
+        deleted = self._db.query(DeletedWork.work_id).filter(
+            DeletedWork.timestamp >= since
+        )
+        return set(
+            work_id for [work_id] in updated.union(covered, checked, deleted)
+            if work_id
+        )
+
+    def stamp(self, start, service=None):
+        """Record that the views reflect every change made before `start`."""
+        stamp = Timestamp.stamp(self._db, service or self.SERVICE_NAME)
+        stamp.timestamp = start
+
+    def vacuum(self, *statements):
         url = Configuration.database_url()
         engine = create_engine(url, isolation_level="AUTOCOMMIT")
         engine.autocommit = True
         a = time.time()
-        engine.execute("VACUUM (VERBOSE, ANALYZE)")
+        for statement in statements:
+            engine.execute(statement)
         b = time.time()
         print "Vacuumed in %.2f sec." % (b-a)
 
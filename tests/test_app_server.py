@@ -246,6 +246,17 @@ class TestLoadMethods(object):
             pagination = load_pagination_from_request()
             eq_(100, pagination.size)
 
+        key = Pagination.encode_key([u"Title", 10])
+        with self.app.test_request_context('/?size=10&after=10&key=%s' % key):
+            pagination = load_pagination_from_request()
+            eq_([u"Title", 10], pagination.key)
+            eq_(10, pagination.offset)
+
+        with self.app.test_request_context('/?key=string'):
+            pagination = load_pagination_from_request()
+            eq_(INVALID_INPUT.uri, pagination.uri)
+            eq_("Invalid pagination key: string", str(pagination.detail))
+
     def test_load_pagination_from_request_default_size(self):
         with self.app.test_request_context('/?size=50&after=10'):
             pagination = load_pagination_from_request(default_size=10)
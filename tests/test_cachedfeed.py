@@ -28,6 +28,7 @@ from . import (
 class TestCachedFeed(DatabaseTest):
 
     def test_lifecycle(self):
+        CachedFeed._uncounted_requests.clear()
         facets = Facets.default()
         pagination = Pagination.default()
         lane = Lane(self._db, "My Lane", languages=['eng', 'chi'])
@@ -60,6 +61,24 @@ class TestCachedFeed(DatabaseTest):
         eq_("The content", feed.content)
         eq_(True, fresh)
 
+        # The first request for a new feed is written to the database
+        # right away. Later requests are counted in memory until
+        # there are enough of them to be worth an UPDATE.
+        self._db.flush()
+        eq_(1, feed.request_count)
+        key = feed.memory_cache_key
+        eq_(2, CachedFeed._uncounted_requests[key])
+
+        old_batch_size = CachedFeed.REQUEST_COUNT_BATCH_SIZE
+        CachedFeed.REQUEST_COUNT_BATCH_SIZE = 3
+        try:
+            feed, fresh = CachedFeed.fetch(*args, max_age=1000)
+        finally:
+            CachedFeed.REQUEST_COUNT_BATCH_SIZE = old_batch_size
+        self._db.flush()
+        eq_(4, feed.request_count)
+        assert key not in CachedFeed._uncounted_requests
+
     def test_refusal_to_create_expensive_feed(self):
         
         facets = Facets.default()
@@ -93,3 +112,69 @@ class TestCachedFeed(DatabaseTest):
             *args, max_age=Configuration.CACHE_FOREVER
         )
         eq_("Cache this forever!", feed.content)
+
+    def test_memory_cache(self):
+        facets = Facets.default()
+        pagination = Pagination.default()
+        lane = Lane(self._db, "My Lane", languages=['eng', 'chi'])
+        args = (self._db, lane, CachedFeed.PAGE_TYPE, facets, pagination, None)
+
+        # The in-process cache is disabled by default.
+        eq_(None, CachedFeed.memory_cache())
+
+        with temp_config() as config:
+            config[Configuration.POLICIES] = {
+                Configuration.FEED_MEMORY_CACHE_SIZE_POLICY : 1000
+            }
+            CachedFeed._memory_cache = None
+            cache = CachedFeed.memory_cache()
+            eq_(1000, cache.max_size)
+
+            # A feed with no content doesn't go into the cache.
+            feed, fresh = CachedFeed.fetch(*args, max_age=1000)
+            eq_(False, fresh)
+            eq_(0, len(cache))
+
+            feed.update("The content")
+            self._db.commit()
+
+            # Once the feed is usable, it goes into the cache.
+            feed, fresh = CachedFeed.fetch(*args, max_age=1000)
+            eq_(True, fresh)
+            eq_(1, len(cache))
+            [(key, (content, timestamp, cached_at))] = cache._items.items()
+            eq_(feed.memory_cache_key, key)
+            eq_("The content", content)
+            eq_(len("The content"), cache.size)
+
+            # The next fetch is served from the cache, without touching
+            # the database.
+            self._db.delete(feed)
+            self._db.commit()
+            from_memory, fresh = CachedFeed.fetch(*args, max_age=1000)
+            eq_(True, fresh)
+            eq_("The content", from_memory.content)
+            eq_(None, from_memory.id)
+            assert from_memory not in self._db
+
+            # The cache respects max_age.
+            feed, fresh = CachedFeed.fetch(*args, max_age=0)
+            eq_(False, fresh)
+            eq_(None, feed.content)
+
+            # Updating a feed invalidates its entry in the cache.
+            feed.update("New content")
+            feed, fresh = CachedFeed.fetch(*args, max_age=1000)
+            cache.set(feed.memory_cache_key, ("Old content", None, None))
+            feed.update("Newer content")
+            eq_(0, len(cache))
+
+            # force_refresh bypasses the cache.
+            cache.set(feed.memory_cache_key, (
+                "Old content", feed.timestamp, feed.timestamp
+            ))
+            feed, fresh = CachedFeed.fetch(
+                *args, max_age=1000, force_refresh=True
+            )
+            eq_(False, fresh)
+            eq_("Newer content", feed.content)
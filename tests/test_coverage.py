@@ -1,4 +1,5 @@
 import datetime
+import threading
 from nose.tools import (
     set_trace,
     eq_,
@@ -6,6 +7,10 @@ from nose.tools import (
 from . import (
     DatabaseTest
 )
+from config import (
+    Configuration,
+    temp_config,
+)
 from testing import (
     AlwaysSuccessfulCoverageProvider,
     AlwaysSuccessfulWorkCoverageProvider,
@@ -335,6 +340,31 @@ class TestCoverageProvider(DatabaseTest):
         # attempted, then we process identifiers with transient failures.
         eq_([no_coverage, self.identifier], provider.attempts)
 
+    def test_run_once_pages_by_id(self):
+        # Two identifiers need coverage, and will keep needing it,
+        # since the provider only ever fails transiently.
+        other_identifier = self._identifier()
+        provider = TransientFailureCoverageProvider(
+            "Transient failure", self.input_identifier_types,
+            self.output_source, batch_size=1
+        )
+        qu = provider.items_that_need_coverage(
+            count_as_covered=CoverageRecord.DEFAULT_COUNT_AS_COVERED
+        )
+        eq_(True, provider.pages_by_id(qu))
+
+        # Each batch picks up after the ID of the last item processed,
+        # so each item is only processed once.
+        first, second = sorted(
+            [self.identifier, other_identifier], key=lambda x: x.id
+        )
+        offset = provider.run_once(0)
+        eq_(first.id, offset)
+        offset = provider.run_once(offset)
+        eq_(second.id, offset)
+        eq_(None, provider.run_once(offset))
+        eq_([first, second], provider.attempts)
+
     def test_never_successful(self):
 
         # We start with no CoverageRecords and no Timestamp.
@@ -621,6 +651,32 @@ class MockBibliographicCoverageProvider(BibliographicCoverageProvider):
     def process_item(self, identifier):
         return identifier
 
+class MockFetchingBibliographicCoverageProvider(
+        MockBibliographicCoverageProvider):
+    """Simulates a BibliographicCoverageProvider that separates its
+    network requests from its database work.
+    """
+    INTEGRATION = "Mock integration"
+
+    def __init__(self, _db, **kwargs):
+        super(MockFetchingBibliographicCoverageProvider, self).__init__(
+            _db, **kwargs
+        )
+        self.fetch_threads = []
+        self.processed = []
+
+    def fetch(self, identifier):
+        self.fetch_threads.append(threading.current_thread().name)
+        return identifier.identifier
+
+    def process_fetched(self, identifier, data):
+        self.processed.append((identifier, data))
+        return identifier
+
+    def process_item(self, identifier):
+        # Don't use MockBibliographicCoverageProvider's implementation.
+        return BibliographicCoverageProvider.process_item(self, identifier)
+
 class TestWorkCoverageProvider(DatabaseTest):
 
     def setup(self):
@@ -942,6 +998,53 @@ class TestBibliographicCoverageProvider(DatabaseTest):
         assert isinstance(result, CoverageFailure)
         eq_(False, work.presentation_ready)
 
+    def test_process_batch_fetches_concurrently(self):
+        identifiers = [self._identifier() for i in range(4)]
+        provider = MockFetchingBibliographicCoverageProvider(self._db)
+
+        # By default, lookups happen one at a time, in the main thread.
+        results = provider.process_batch(identifiers)
+        eq_(identifiers, results)
+        eq_(set([threading.current_thread().name]),
+            set(provider.fetch_threads))
+
+        # With a concurrency limit configured for the integration,
+        # the lookups happen in other threads...
+        provider.fetch_threads = []
+        provider.processed = []
+        with temp_config() as config:
+            config[Configuration.INTEGRATIONS][provider.INTEGRATION] = {
+                Configuration.MAX_CONCURRENT_REQUESTS : 3
+            }
+            results = provider.process_batch(identifiers)
+        assert threading.current_thread().name not in provider.fetch_threads
+        eq_(4, len(provider.fetch_threads))
+
+        # ...but the results are processed in order.
+        eq_(identifiers, results)
+        eq_([(x, x.identifier) for x in identifiers], provider.processed)
+
+        # A lookup that fails becomes a CoverageFailure for its own
+        # identifier, and doesn't affect the others.
+        class BrokenFetch(MockFetchingBibliographicCoverageProvider):
+            def fetch(self, identifier):
+                if identifier == identifiers[1]:
+                    raise Exception("Nope")
+                return super(BrokenFetch, self).fetch(identifier)
+        provider = BrokenFetch(self._db)
+        with temp_config() as config:
+            config[Configuration.INTEGRATIONS][provider.INTEGRATION] = {
+                Configuration.MAX_CONCURRENT_REQUESTS : 3
+            }
+            results = provider.process_batch(identifiers)
+        eq_(identifiers[0], results[0])
+        failure = results[1]
+        assert isinstance(failure, CoverageFailure)
+        eq_(identifiers[1], failure.obj)
+        eq_(True, failure.transient)
+        assert "Nope" in failure.exception
+        eq_(identifiers[2:], results[2:])
+
 
 class TestCoverageFailure(DatabaseTest):
 
@@ -1,4 +1,8 @@
+import base64
 import datetime
+import threading
+import time
+from decimal import Decimal
 
 from nose.tools import (
     eq_,
@@ -7,6 +11,8 @@ from nose.tools import (
 )
 
 from psycopg2.extras import NumericRange
+from sqlalchemy import or_
+from sqlalchemy.orm import sessionmaker
 
 from . import (
     DatabaseTest,
@@ -289,6 +295,40 @@ class TestLane(DatabaseTest):
         eq_(0, parent.depth)
         eq_(1, child.depth)
 
+    def test_randomized_sample_works(self):
+        works = []
+        for value in (0.1, 0.3, 0.5, 0.7):
+            work = self._work(with_open_access_download=True)
+            work.random = value
+            works.append(work)
+        SessionManager.refresh_materialized_views(self._db)
+        lane = Lane(self._db, "Everything")
+        facets = Facets(Facets.COLLECTION_FULL, Facets.AVAILABLE_ALL,
+                        Facets.ORDER_RANDOM)
+
+        with temp_config() as config:
+            config['policies'] = {Configuration.FEATURED_LANE_SIZE : 3}
+            for query, work_id in (
+                    (lane.works(facets), lambda x: x.id),
+                    (lane.materialized_works(facets), lambda x: x.works_id),
+            ):
+                # Every sample is three works that are next to each
+                # other in random order, wrapping around at the end.
+                ids = [x.id for x in works]
+                runs = set(
+                    tuple(sorted((ids + ids)[i:i+3])) for i in range(4)
+                )
+                for i in range(20):
+                    sample = lane.randomized_sample_works(query)
+                    assert tuple(sorted(map(work_id, sample))) in runs
+
+            # If there aren't enough works, the lane is ignored unless
+            # a smaller sample is acceptable.
+            config['policies'] = {Configuration.FEATURED_LANE_SIZE : 5}
+            query = lane.materialized_works(facets)
+            eq_([], lane.randomized_sample_works(query))
+            eq_(4, len(lane.randomized_sample_works(query, use_min_size=True)))
+
     def test_includes_language(self):
         english_lane = Lane(self._db, self._str, languages=['eng'])
         eq_(True, english_lane.includes_language('eng'))
@@ -587,6 +627,99 @@ class TestLanes(DatabaseTest):
         assert visible_grandchild in lane.visible_sublanes
 
 
+    def test_sublane_samples_concurrently(self):
+        work1 = self._work()
+        work2 = self._work()
+        work3 = self._work()
+
+        class FakeSession(object):
+            closed = 0
+            def close(self):
+                FakeSession.closed += 1
+
+        class SampledLane(Lane):
+            def featured_works(self, use_materialized_works=True):
+                # Each sublane is sampled in its own session, and the
+                # slowest sublane finishes last.
+                assert isinstance(self._db, FakeSession)
+                time.sleep(self.delay)
+                return self.sample
+
+            def _sampling_sessionmaker(self):
+                return FakeSession
+
+        sublanes = []
+        for delay, sample in ((0.2, [work1, work2]), (0, []), (0, [work3])):
+            sublane = SampledLane(self._db, self._str)
+            sublane.delay = delay
+            sublane.sample = sample
+            sublanes.append(sublane)
+        lane = SampledLane(self._db, self._str, sublanes=sublanes)
+
+        with temp_config() as config:
+            config['policies'] = {Configuration.SUBLANE_SAMPLING_THREADS : 3}
+            samples = lane.sublane_samples()
+
+        # The results come back in lane order, in the lane's session.
+        eq_([(work1, sublanes[0]), (work2, sublanes[0]), (work3, sublanes[2])],
+            samples)
+        eq_(3, FakeSession.closed)
+        for sublane in sublanes:
+            eq_(self._db, sublane._db)
+
+        # Our test session is bound to a single connection, so it
+        # can't be shared out between threads.
+        eq_(None, Lane(self._db, self._str)._sampling_sessionmaker())
+
+    def test_sublane_samples_concurrently_from_database(self):
+        english = self._work(with_license_pool=True, language="eng")
+        spanish = self._work(with_license_pool=True, language="spa")
+        SessionManager.refresh_materialized_views(self._db)
+
+        # The test data is only visible through the test connection,
+        # so the sampling sessions have to share it. A connection
+        # can't be used by two threads at once, so the queries take
+        # turns, but everything else happens in the worker threads.
+        connection = self.connection
+        lock = threading.Lock()
+        sessions = []
+
+        class DatabaseLane(Lane):
+            def featured_works(self, use_materialized_works=True):
+                sessions.append(self._db)
+                with lock:
+                    return super(DatabaseLane, self).featured_works(
+                        use_materialized_works=use_materialized_works
+                    )
+
+            def _sampling_sessionmaker(self):
+                return sessionmaker(bind=connection)
+
+        sublanes = [
+            DatabaseLane(self._db, "English", languages=["eng"]),
+            DatabaseLane(self._db, "Spanish", languages=["spa"]),
+        ]
+        lane = DatabaseLane(self._db, "Everything", sublanes=sublanes)
+
+        with temp_config() as config:
+            config['policies'] = {Configuration.SUBLANE_SAMPLING_THREADS : 2}
+            samples = lane.sublane_samples()
+
+        eq_([english.id, spanish.id], [work.works_id for work, l in samples])
+        eq_(sublanes, [l for work, l in samples])
+
+        # The works were merged into the lane's session.
+        for work, l in samples:
+            assert work in self._db
+
+        # Each sublane was sampled in a session of its own, and the
+        # shared sublanes themselves were never pointed at it.
+        eq_(2, len(set(sessions)))
+        assert self._db not in sessions
+        for sublane in sublanes:
+            eq_(self._db, sublane._db)
+
+
 class TestLanesQuery(DatabaseTest):
 
     def setup(self):
@@ -1083,3 +1216,93 @@ class TestPagination(DatabaseTest):
         # Even when the query ends at the same size as a page, all is well.
         pagination.offset = 2
         eq_(False, pagination.has_next_page)
+
+        # Once a page has been loaded, pagination knows exactly where
+        # it ended.
+        for offset, expect in ((2, True), (4, False)):
+            pagination = Pagination(offset=offset, size=2)
+            page = pagination.apply(query).all()
+            pagination.page_loaded(page)
+            eq_(expect, pagination.has_next_page)
+
+    def test_encode_key(self):
+        key = [u"A title", None, 12, Decimal("0.123"),
+               datetime.datetime(2016, 1, 1, 12, 30, 0, 5)]
+        encoded = Pagination.encode_key(key)
+        assert "=" not in encoded
+        eq_(key, Pagination.decode_key(encoded))
+
+        assert_raises(ValueError, Pagination.decode_key, "not a key")
+        assert_raises(ValueError, Pagination.decode_key,
+                      Pagination.encode_key([])[:-1] + "!!")
+
+        # Values of the wrong type are also rejected.
+        for bad in ('[{"datetime":5}]', '[{"decimal":"nope"}]',
+                    '["a",["b"]]', '[{}]', '[{"decimal":5}]',
+                    '[{"datetime":"2016-01-01T00:00:00.0","x":1}]'):
+            encoded = base64.urlsafe_b64encode(bad)
+            assert_raises(ValueError, Pagination.decode_key, encoded)
+
+    def test_seek_clause(self):
+        columns = [Edition.sort_title, Work.id]
+
+        # The clause begins with a range condition on the first column
+        # that an index can satisfy.
+        clause = Pagination.seek_clause(columns, True, [u"A", 5])
+        eq_(str(or_(Edition.sort_title >= u"A", Edition.sort_title == None)),
+            str(clause.clauses[0]))
+        clause = Pagination.seek_clause(columns, False, [u"A", 5])
+        eq_(str(Edition.sort_title <= u"A"), str(clause.clauses[0]))
+
+        # When the key's first value is NULL in ascending order, only
+        # other NULLs can come after it.
+        clause = Pagination.seek_clause(columns, True, [None, 5])
+        eq_(str(Edition.sort_title == None), str(clause.clauses[0]))
+
+    def test_keyset_pagination(self):
+        now = datetime.datetime.utcnow()
+        times = [now, now, None, now - datetime.timedelta(days=1), None]
+        for i, last_update in enumerate(times):
+            work = self._work(
+                title="Title %d" % (i % 2), with_open_access_download=True
+            )
+            work.last_update_time = last_update
+        SessionManager.refresh_materialized_views(self._db)
+        lane = Lane(self._db, "Everything")
+
+        def all_pages(facets, materialized):
+            """Page through the lane using keys, two works at a time."""
+            results = []
+            pagination = Pagination(size=2)
+            while True:
+                if materialized:
+                    works = lane.materialized_works(facets, pagination).all()
+                    results.extend(x.works_id for x in works)
+                else:
+                    works = lane.works(facets, pagination).all()
+                    results.extend(x.id for x in works)
+                pagination.page_loaded(works)
+                if pagination.key is not None:
+                    # Only a full page can have a page after it.
+                    eq_(len(works) == 2, pagination.has_next_page)
+                if not works:
+                    break
+                pagination = pagination.next_page
+                assert pagination.key is not None
+            return results
+
+        for order, ascending in (
+                (Facets.ORDER_TITLE, Facets.ORDER_ASCENDING),
+                (Facets.ORDER_LAST_UPDATE, Facets.ORDER_DESCENDING),
+        ):
+            facets = Facets(Facets.COLLECTION_FULL, Facets.AVAILABLE_ALL,
+                            order, order_ascending=ascending)
+            expect = [x.id for x in lane.works(facets).all()]
+            eq_(5, len(expect))
+            eq_(expect, all_pages(facets, False))
+            eq_(expect, all_pages(facets, True))
+
+        # A key that doesn't match the sort order is ignored.
+        facets = Facets.default()
+        pagination = Pagination(size=2, key=[1])
+        eq_(2, len(lane.works(facets, pagination).all()))
@@ -21,6 +21,7 @@ from metadata_layer import (
     ReplacementPolicy,
     SubjectData,
     ContributorData,
+    ThumbnailBatch,
 )
 
 import os
@@ -234,6 +235,52 @@ class TestMetadataImporter(DatabaseTest):
         assert thumbnail.mirror_url.startswith('http://s3.amazonaws.com/test.cover.bucket/scaled/300/')
         assert thumbnail.mirror_url.endswith('cover.png')
 
+    def test_image_scale_in_batch(self):
+        mirror = DummyS3Uploader()
+        edition, pool = self._edition(with_license_pool=True)
+        content = open(self.sample_cover_path("test-book-cover.png")).read()
+        l1 = LinkData(
+            rel=Hyperlink.IMAGE, href="http://example.com/",
+            media_type=Representation.PNG_MEDIA_TYPE,
+            content=content
+        )
+
+        # When the policy has a ThumbnailBatch, the image is mirrored
+        # but its thumbnail isn't made yet.
+        batch = ThumbnailBatch()
+        policy = ReplacementPolicy(mirror=mirror, thumbnail_batch=batch)
+        metadata = Metadata(links=[l1], data_source=edition.data_source)
+        metadata.apply(edition, replace=policy)
+        [image] = mirror.uploaded
+        eq_([], image.thumbnails)
+        eq_([image], batch.jobs.keys())
+
+        # Running the batch makes the thumbnail and mirrors it.
+        batch.run()
+        [image, thumbnail] = mirror.uploaded
+        eq_(image, thumbnail.thumbnail_of)
+        eq_(600, image.image_height)
+        eq_(Edition.MAX_THUMBNAIL_HEIGHT, thumbnail.image_height)
+        eq_(Edition.MAX_THUMBNAIL_WIDTH, thumbnail.image_width)
+        assert thumbnail.mirror_url.startswith('http://s3.amazonaws.com/test.cover.bucket/scaled/300/')
+        eq_({}, batch.jobs)
+
+        # If a thumbnail can't be mirrored, the batch says which
+        # identifier's cover it was, and carries on with the others.
+        class BrokenMirror(DummyS3Uploader):
+            def mirror_one(self, representation):
+                raise Exception("Mirror is down")
+
+        image2, ignore = self._representation(
+            media_type=Representation.PNG_MEDIA_TYPE, content=content
+        )
+        batch.add(image, self._url, BrokenMirror(), edition.primary_identifier)
+        batch.add(image2, self._url, mirror)
+        failures = batch.run()
+        eq_([edition.primary_identifier], failures.keys())
+        assert "Mirror is down" in failures[edition.primary_identifier]
+        eq_(image2, mirror.uploaded[-1].thumbnail_of)
+
 
     def test_mirror_open_access_link_fetch_failure(self):
         edition, pool = self._edition(with_license_pool=True)
@@ -310,6 +357,45 @@ class TestMetadataImporter(DatabaseTest):
         eq_(None, link_obj.resource.representation.mirror_url)
         eq_([], mirror.uploaded)
 
+    def test_downloaded_content_removed_when_not_mirrored(self):
+        directory = os.path.join(
+            self.tmp_data_dir, Representation.DOWNLOAD_DIRECTORY
+        )
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, "not_a_book.html")
+        fh = open(path, "w")
+        fh.write("<html>Not a book</html>")
+        fh.close()
+
+        def do_get(url, headers):
+            return 200, {'content-type' : 'text/html'}, fh
+
+        mirror = DummyS3Uploader()
+        policy = ReplacementPolicy(mirror=mirror, http_get=do_get)
+        edition, pool = self._edition(with_license_pool=True)
+        data_source = DataSource.lookup(self._db, DataSource.GUTENBERG)
+        link = LinkData(
+            rel=Hyperlink.OPEN_ACCESS_DOWNLOAD,
+            media_type=Representation.EPUB_MEDIA_TYPE,
+            href=self._url,
+        )
+        link_obj, ignore = edition.primary_identifier.add_link(
+            rel=link.rel, href=link.href, data_source=data_source,
+            license_pool=pool, media_type=link.media_type,
+        )
+
+        m = Metadata(data_source=data_source)
+        m.mirror_link(edition, data_source, link, link_obj, policy)
+
+        # The download wasn't a book, so it wasn't mirrored, and once
+        # that's committed it isn't left on disk either.
+        eq_([], mirror.uploaded)
+        eq_(None, link_obj.resource.representation.local_content_path)
+        eq_(True, os.path.exists(path))
+        self._db.commit()
+        eq_(False, os.path.exists(path))
+
     def test_mirror_open_access_link_mirror_failure(self):
         edition, pool = self._edition(with_license_pool=True)
 
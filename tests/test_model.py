@@ -15,8 +15,11 @@ from nose.tools import (
     set_trace,
 )
 
+from nose.plugins.skip import SkipTest
+
 from psycopg2.extras import NumericRange
 
+from sqlalchemy import inspect
 from sqlalchemy.orm.exc import (
     NoResultFound,
 )
@@ -38,6 +41,7 @@ from model import (
     Credential,
     CustomListEntry,
     DataSource,
+    DeletedWork,
     DeliveryMechanism,
     Genre,
     Hold,
@@ -45,6 +49,10 @@ from model import (
     LicensePool,
     Measurement,
     Patron,
+    PresentationBatch,
+    PresentationCalculationPolicy,
+    RecursiveEquivalent,
+    RecursiveEquivalentUpdate,
     Representation,
     Resource,
     RightsStatus,
@@ -59,6 +67,7 @@ from model import (
     create,
     get_one,
     get_one_or_create,
+    keep_downloads_after_rollback,
 )
 from external_search import (
     DummyExternalSearchIndex,
@@ -100,6 +109,42 @@ class TestDataSource(DatabaseTest):
         eq_(None, DataSource.lookup(
             self._db, "No such data source " + self._str))
 
+    def test_lookup_is_cached(self):
+        DataSource.reset_lookup_cache()
+        gutenberg = DataSource.lookup(self._db, DataSource.GUTENBERG)
+        eq_(gutenberg, DataSource.from_lookup_cache(
+            self._db, DataSource.GUTENBERG))
+
+        # A lookup that finds nothing isn't cached.
+        name = "No such data source " + self._str
+        eq_(None, DataSource.lookup(self._db, name))
+        eq_(None, DataSource.from_lookup_cache(self._db, name))
+
+        # If the cached row goes away, the cache forgets about it.
+        source, ignore = create(self._db, DataSource, name=name)
+        eq_(source, DataSource.lookup(self._db, name))
+        self._db.delete(source)
+        self._db.flush()
+        eq_(None, DataSource.from_lookup_cache(self._db, name))
+        eq_(None, DataSource.lookup(self._db, name))
+
+        # The cache can be reset explicitly.
+        DataSource.reset_lookup_cache()
+        eq_(None, DataSource.from_lookup_cache(
+            self._db, DataSource.GUTENBERG))
+        eq_(gutenberg, DataSource.lookup(self._db, DataSource.GUTENBERG))
+
+        # An ID cached for some other database isn't used for this one.
+        DataSource.reset_lookup_cache()
+        DataSource._lookup_cache_ids["postgres://elsewhere/db"] = {
+            DataSource.GUTENBERG : gutenberg.id + 1
+        }
+        eq_(None, DataSource.from_lookup_cache(
+            self._db, DataSource.GUTENBERG))
+        eq_(gutenberg, DataSource.lookup(self._db, DataSource.GUTENBERG))
+        eq_(gutenberg, DataSource.from_lookup_cache(
+            self._db, DataSource.GUTENBERG))
+
     def test_metadata_sources_for(self):
         content_cafe = DataSource.lookup(self._db, DataSource.CONTENT_CAFE)
         isbn_metadata_sources = DataSource.metadata_sources_for(
@@ -251,6 +296,34 @@ class TestIdentifier(DatabaseTest):
 
         # Pass in None and you get None.
         eq_(None, Identifier.parse_urn(self._db, None))
+
+    def test_parse_urns(self):
+        identifier = self._identifier()
+        overdrive, ignore = Identifier.for_foreign_id(
+            self._db, Identifier.OVERDRIVE_ID, "abcdef"
+        )
+        # Overdrive IDs are case-insensitive.
+        overdrive_urn = Identifier.URN_SCHEME_PREFIX + "Overdrive%20ID/ABCDEF"
+        new_urn = Identifier.URN_SCHEME_PREFIX + "Overdrive%20ID/NOSUCHBOOK"
+        urns = [identifier.urn, overdrive_urn, new_urn,
+                "ftp://example.com", None]
+
+        # Identifiers that don't exist aren't created if autocreate is
+        # False. URNs that can't be parsed are reported as failures.
+        results, failures = Identifier.parse_urns(
+            self._db, urns, autocreate=False
+        )
+        eq_(identifier, results[identifier.urn])
+        eq_(overdrive, results[overdrive_urn])
+        assert new_urn not in results
+        eq_(["ftp://example.com", None], failures)
+
+        # With autocreate, the missing Identifier is created.
+        results, failures = Identifier.parse_urns(self._db, urns)
+        new_identifier = results[new_urn]
+        eq_(Identifier.OVERDRIVE_ID, new_identifier.type)
+        eq_("nosuchbook", new_identifier.identifier)
+        eq_(identifier, results[identifier.urn])
         
     def parse_urn_must_support_license_pools(self):
         # We have no way of associating ISBNs with license pools.
@@ -389,8 +462,9 @@ class TestIdentifier(DatabaseTest):
                  level_3_equivalent.id]),
             set(equivs[level_3_equivalent.id]))
 
-        # The query uses the same db function, but returns equivalents
-        # for all identifiers together so it can be used as a subquery.
+        # The query looks up the same RecursiveEquivalents, but returns
+        # equivalents for all identifiers together so it can be used
+        # as a subquery.
         query = Identifier.recursively_equivalent_identifier_ids_query(
             Identifier.id, levels=5, threshold=0.1)
         query = query.where(Identifier.id==identifier.id)
@@ -415,6 +489,119 @@ class TestIdentifier(DatabaseTest):
                  level_3_equivalent.id]),
             set(equivalent_ids))
 
+    def test_recursive_equivalents_are_maintained(self):
+        data_source = DataSource.lookup(self._db, DataSource.MANUAL)
+        a = self._identifier()
+        b = self._identifier()
+        c = self._identifier()
+
+        def equivalents(identifier):
+            self._db.flush()
+            return sorted(
+                (x.equivalent_id, x.depth, round(x.strength, 3))
+                for x in self._db.query(RecursiveEquivalent).filter(
+                    RecursiveEquivalent.identifier_id==identifier.id
+                )
+            )
+
+        # A new Identifier is equivalent to itself.
+        eq_([(a.id, 0, 1)], equivalents(a))
+
+        ab = a.equivalent_to(data_source, b, 0.9)
+        bc = b.equivalent_to(data_source, c, 0.5)
+        eq_([(a.id, 0, 1), (b.id, 1, 0.9), (c.id, 2, 0.45)], equivalents(a))
+        eq_([(a.id, 2, 0.45), (b.id, 1, 0.5), (c.id, 0, 1)], equivalents(c))
+
+        # A longer chain that's stronger than a shorter one gets its
+        # own row.
+        a.equivalent_to(data_source, c, 0.3)
+        eq_([(a.id, 0, 1), (b.id, 1, 0.9), (c.id, 1, 0.3), (c.id, 2, 0.45)],
+            equivalents(a))
+
+        # Changing the strength of an Equivalency changes the
+        # equivalents of everything nearby.
+        ab.strength = 0.2
+        eq_([(a.id, 0, 1), (b.id, 1, 0.2), (c.id, 1, 0.3)], equivalents(a))
+
+        # So does deleting an Equivalency.
+        self._db.delete(bc)
+        eq_([(a.id, 1, 0.2), (b.id, 0, 1), (c.id, 2, 0.06)], equivalents(b))
+
+        # A change that affects too many Identifiers is queued
+        # instead of being handled during the flush.
+        old_limit = RecursiveEquivalent.SYNCHRONOUS_UPDATE_LIMIT
+        RecursiveEquivalent.SYNCHRONOUS_UPDATE_LIMIT = 1
+        try:
+            bc = b.equivalent_to(data_source, c, 0.5)
+            eq_([(a.id, 1, 0.2), (b.id, 0, 1), (c.id, 2, 0.06)],
+                equivalents(b))
+        finally:
+            RecursiveEquivalent.SYNCHRONOUS_UPDATE_LIMIT = old_limit
+        eq_(sorted([b.id, c.id]), sorted(
+            x.identifier_id for x in self._db.query(RecursiveEquivalentUpdate)
+        ))
+
+        # Processing the queue brings everything up to date.
+        eq_(2, RecursiveEquivalentUpdate.process(self._db))
+        eq_([(a.id, 1, 0.2), (b.id, 0, 1), (c.id, 1, 0.5)], equivalents(b))
+        eq_(0, self._db.query(RecursiveEquivalentUpdate).count())
+
+        # Rebuilding from scratch gives the same results.
+        before = [equivalents(x) for x in (a, b, c)]
+        RecursiveEquivalent.rebuild(self._db)
+        eq_(before, [equivalents(x) for x in (a, b, c)])
+
+        # An Identifier inserted without going through the ORM is
+        # also equivalent to itself.
+        [(raw_id,)] = self._db.execute(
+            Identifier.__table__.insert().values(
+                type=Identifier.GUTENBERG_ID,
+                identifier=self._str
+            ).returning(Identifier.id)
+        )
+        eq_([(raw_id, 0, 1)], sorted(
+            (x.equivalent_id, x.depth, x.strength)
+            for x in self._db.query(RecursiveEquivalent).filter(
+                RecursiveEquivalent.identifier_id==raw_id
+            )
+        ))
+
+    def test_recursive_equivalents_are_recalculated_under_a_lock(self):
+        data_source = DataSource.lookup(self._db, DataSource.MANUAL)
+        a = self._identifier()
+        b = self._identifier()
+        c = self._identifier()
+
+        def advisory_locks():
+            return sorted(self._db.execute(
+                "select classid, objid from pg_locks "
+                "where locktype='advisory' and pid=pg_backend_pid() "
+                "and granted"
+            ).fetchall())
+        eq_([], advisory_locks())
+
+        # A change that's queued rather than handled during the flush
+        # doesn't lock anything.
+        old_limit = RecursiveEquivalent.SYNCHRONOUS_UPDATE_LIMIT
+        RecursiveEquivalent.SYNCHRONOUS_UPDATE_LIMIT = 1
+        try:
+            b.equivalent_to(data_source, c, 0.5)
+            self._db.flush()
+        finally:
+            RecursiveEquivalent.SYNCHRONOUS_UPDATE_LIMIT = old_limit
+        eq_([], advisory_locks())
+
+        # Flushing a new Equivalency locks the Identifiers whose
+        # recursive equivalents are recalculated, until the
+        # transaction ends. Identifiers elsewhere in the graph aren't
+        # locked.
+        a.equivalent_to(data_source, b, 0.9)
+        self._db.flush()
+        buckets = set(
+            x.id % RecursiveEquivalent.LOCK_BUCKETS for x in (a, b, c)
+        )
+        eq_([(RecursiveEquivalent.LOCK_CLASS, x) for x in sorted(buckets)],
+            advisory_locks())
 
     def test_missing_coverage_from(self):
         gutenberg = DataSource.lookup(self._db, DataSource.GUTENBERG)
@@ -1536,6 +1723,87 @@ class TestWork(DatabaseTest):
         eq_(set([lp.identifier.id, lp2.identifier.id, identifier.id]),
             set(all_identifier_ids))
 
+    def test_all_identifier_ids_for(self):
+        work1 = self._work(with_license_pool=True)
+        work2 = self._work(with_license_pool=True)
+        [lp1] = work1.license_pools
+        [lp2] = work2.license_pools
+        identifier = self._identifier()
+        data_source = DataSource.lookup(self._db, DataSource.OCLC)
+        identifier.equivalent_to(data_source, lp1.identifier, 1)
+
+        by_work = Work.all_identifier_ids_for([work1, work2])
+        eq_(set([lp1.identifier.id, identifier.id]), by_work[work1.id])
+        eq_(set([lp2.identifier.id]), by_work[work2.id])
+
+        # The batch results are what all_identifier_ids() finds for
+        # each work individually.
+        eq_(work1.all_identifier_ids(), by_work[work1.id])
+        eq_(work2.all_identifier_ids(), by_work[work2.id])
+
+        # The license pools are found without loading them for each
+        # Work.
+        self._db.expire_all()
+        eq_(by_work, Work.all_identifier_ids_for([work1, work2]))
+        for work in (work1, work2):
+            assert 'license_pools' in inspect(work).unloaded
+
+        eq_({}, Work.all_identifier_ids_for([]))
+
+    def test_calculate_presentation_with_batch(self):
+        oclc = DataSource.lookup(self._db, DataSource.OCLC)
+        overdrive = DataSource.lookup(self._db, DataSource.OVERDRIVE)
+
+        def make_work():
+            work = self._work(with_license_pool=True)
+            [pool] = work.license_pools
+            identifier = self._identifier()
+            identifier.equivalent_to(oclc, pool.identifier, 1)
+            identifier.classify(
+                oclc, Subject.THREEM, "FICTION/Science Fiction/Time Travel"
+            )
+            identifier.add_measurement(oclc, Measurement.POPULARITY, 100)
+            pool.add_link(Hyperlink.DESCRIPTION, None, overdrive,
+                          "text/plain", u"A book about spaceships.")
+            return work
+        batched = [make_work(), make_work()]
+        unbatched = make_work()
+        for work in batched + [unbatched]:
+            work.quality = 0
+            work.fiction = None
+        self._db.commit()
+
+        policy = PresentationCalculationPolicy(choose_edition=False)
+        batch = PresentationBatch(self._db, batched, policy)
+        eq_(set([w.id for w in batched]), set([w.id for w in batch.works]))
+        for work in batch.works:
+            [classification] = batch.classifications_for(work)
+            [measurement] = batch.measurements_for(work)
+            [hyperlink] = batch.descriptions_for(work)
+            work.calculate_presentation(policy=policy, batch=batch)
+        unbatched.calculate_presentation(policy=policy)
+
+        # The batch gave the same results as looking everything up
+        # for each work.
+        for work in batched:
+            eq_(u"A book about spaceships.", work.summary_text)
+            eq_(unbatched.quality, work.quality)
+            eq_(unbatched.fiction, work.fiction)
+            eq_(sorted([x.genre.name for x in unbatched.work_genres]),
+                sorted([x.genre.name for x in work.work_genres]))
+            operations = set([x.operation for x in work.coverage_records])
+            for operation in (WorkCoverageRecord.CLASSIFY_OPERATION,
+                              WorkCoverageRecord.SUMMARY_OPERATION,
+                              WorkCoverageRecord.QUALITY_OPERATION):
+                assert operation in operations
+        assert unbatched.quality > 0
+        eq_(True, unbatched.fiction)
+        assert len(unbatched.work_genres) > 0
+
+        # The new WorkGenres and WorkCoverageRecords are written to
+        # the database without trouble.
+        self._db.commit()
+
     def test_from_identifiers(self):
         # Prep a work to be identified and a work to be ignored.
         work = self._work(with_license_pool=True, with_open_access_download=True)
@@ -1787,6 +2055,19 @@ class TestWork(DatabaseTest):
         after = sorted((x.genre.name, x.affinity) for x in work.work_genres)
         eq_([(u'Romance', 0.25), (u'Science Fiction', 0.75)], after)
 
+        # Outside of a PresentationBatch, the database is checked even
+        # if the Work's WorkGenres have been loaded, since the loaded
+        # collection might be out of date.
+        fantasy, ignore = Genre.lookup(self._db, Fantasy.name)
+        elsewhere = WorkGenre(work_id=work.id, genre=fantasy, affinity=0)
+        self._db.add(elsewhere)
+        self._db.flush()
+        work.assign_genres_from_weights({Fantasy : 1})
+        self._db.commit()
+        eq_(1, self._db.query(WorkGenre).filter(
+            WorkGenre.work_id==work.id).filter(
+                WorkGenre.genre==fantasy).count())
+
     def test_classifications_with_genre(self):
         work = self._work(with_open_access_download=True)
         identifier = work.presentation_edition.primary_identifier
@@ -3462,6 +3743,146 @@ class TestRepresentation(DatabaseTest):
         fh = representation.content_fh()
         eq_("some text", fh.read())
 
+    def test_get_content_written_to_disk(self):
+        # streaming_http_get writes content to a file in the
+        # download directory and returns the closed file.
+        directory = os.path.join(
+            self.tmp_data_dir, Representation.DOWNLOAD_DIRECTORY
+        )
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, "book.epub")
+        fh = open(path, "w")
+        fh.write("a big book")
+        fh.close()
+
+        def do_get(url, headers):
+            return 200, {'content-type' : Representation.EPUB_MEDIA_TYPE}, fh
+
+        representation, cached = Representation.get(
+            self._db, self._url, do_get=do_get
+        )
+        eq_(None, representation.content)
+        eq_(os.path.join(Representation.DOWNLOAD_DIRECTORY, "book.epub"),
+            representation.local_content_path)
+        eq_("a big book", representation.content_fh().read())
+
+        # When the content is downloaded again, the old file is
+        # deleted once the change has been committed.
+        old_path = path
+        path = os.path.join(directory, "book2.epub")
+        fh = open(path, "w")
+        fh.write("a bigger book")
+        fh.close()
+        representation, cached = Representation.get(
+            self._db, self._url, do_get=do_get, max_age=0
+        )
+        eq_(os.path.join(Representation.DOWNLOAD_DIRECTORY, "book2.epub"),
+            representation.local_content_path)
+        eq_("a bigger book", representation.content_fh().read())
+        eq_(True, os.path.exists(old_path))
+        self._db.commit()
+        eq_(False, os.path.exists(old_path))
+
+        # If the transaction is rolled back, the file is still in use
+        # and it's kept.
+        representation.remove_downloaded_content()
+        eq_(None, representation.local_content_path)
+        keep_downloads_after_rollback(self._db)
+        self._db.commit()
+        eq_(True, os.path.exists(path))
+
+        # Once the content isn't needed anymore, it can be deleted.
+        representation.local_content_path = os.path.join(
+            Representation.DOWNLOAD_DIRECTORY, "book2.epub"
+        )
+        representation.remove_downloaded_content()
+        eq_(None, representation.local_content_path)
+        self._db.commit()
+        eq_(False, os.path.exists(path))
+
+        # Content stored on disk by some other means isn't deleted.
+        filename = "not_downloaded.txt"
+        path = os.path.join(self.tmp_data_dir, filename)
+        open(path, "w").write("some text")
+        representation.set_fetched_content(None, filename)
+        representation.remove_downloaded_content()
+        eq_(filename, representation.local_content_path)
+        eq_(True, os.path.exists(path))
+
+    def test_large_content_kept_in_blob_store(self):
+        def do_get(media_type, content):
+            def _do_get(url, headers):
+                return 200, {'content-type' : media_type}, content
+            return _do_get
+
+        base_path = os.path.split(__file__)[0]
+        cover = open(os.path.join(
+            base_path, "files", "covers", "tiny-image-cover.png"
+        )).read()
+
+        with temp_config() as config:
+            # By default, everything is kept in the database.
+            representation, cached = Representation.get(
+                self._db, self._url,
+                do_get=do_get(Representation.PNG_MEDIA_TYPE, cover)
+            )
+            eq_(cover, representation.content)
+            eq_(None, representation.local_content_path)
+
+            config[Configuration.POLICIES] = {
+                Configuration.REPRESENTATION_BLOB_THRESHOLD : 5
+            }
+
+            # Content at least as big as the threshold goes into the
+            # blob store, and is read back from there.
+            representation, cached = Representation.get(
+                self._db, self._url,
+                do_get=do_get(Representation.PNG_MEDIA_TYPE, cover)
+            )
+            eq_(None, representation._content)
+            eq_(cover, representation.content)
+            eq_(True, representation.in_blob_store)
+            eq_(True, representation.has_content)
+            eq_(cover, representation.content_fh().read())
+            assert representation.image_width > 0
+            path = representation.local_path
+
+            # Another image with the same content shares the file.
+            representation2, cached = Representation.get(
+                self._db, self._url,
+                do_get=do_get(Representation.PNG_MEDIA_TYPE, cover)
+            )
+            eq_(representation.local_content_path,
+                representation2.local_content_path)
+
+            # A smaller document is kept in the database, and the blob
+            # is left for BlobCollectionMonitor.
+            representation.set_fetched_content("tiny")
+            eq_("tiny", representation.content)
+            eq_(None, representation.local_content_path)
+            eq_(True, os.path.exists(path))
+
+            # Big content of any kind goes into the blob store.
+            book, cached = Representation.get(
+                self._db, self._url,
+                do_get=do_get(Representation.EPUB_MEDIA_TYPE, "a big book")
+            )
+            eq_(True, book.in_blob_store)
+            eq_("a big book", book.content)
+
+            # Setting .content directly keeps it in the database, and
+            # the representation stops pointing at the blob.
+            book.content = None
+            eq_(None, book.content)
+            eq_(None, book.local_content_path)
+
+            # Without a data directory, a representation that points
+            # into it doesn't have any content.
+            config[Configuration.DATA_DIRECTORY] = None
+            eq_(False, representation2.has_content)
+            eq_(None, representation2.content)
+
     def test_unicode_content_utf8_default(self):
         unicode_content = u"It’s complicated."
 
@@ -3870,6 +4291,60 @@ class TestCoverResource(DatabaseTest):
         eq_(None, thumbnail.thumbnail_of)
         assert thumbnail.url != url
 
+    def test_scale_many(self):
+        cover = self.sample_cover_representation("test-book-cover.png")
+        tiny = self.sample_cover_representation("tiny-image-cover.png")
+        not_an_image, ignore = self._representation(
+            media_type="text/plain", content="foo"
+        )
+        url1 = self._url
+        url2 = self._url
+        url3 = self._url
+
+        # One image can be scaled to several sizes at once.
+        results = Representation.scale_many([
+            (cover, [(300, 600, url1, "image/png"),
+                     (150, 300, url2, "image/jpeg")]),
+            (tiny, [(300, 600, url3, "image/png")]),
+            (not_an_image, [(300, 600, self._url, "image/png")]),
+        ])
+
+        [(thumbnail1, is_new1), (thumbnail2, is_new2)] = results[cover]
+        eq_(True, is_new1)
+        eq_(url1, thumbnail1.url)
+        eq_(url1, thumbnail1.mirror_url)
+        eq_(cover, thumbnail1.thumbnail_of)
+        eq_((200, 300), (thumbnail1.image_width, thumbnail1.image_height))
+        eq_(True, is_new2)
+        eq_("image/jpeg", thumbnail2.media_type)
+        eq_((100, 150), (thumbnail2.image_width, thumbnail2.image_height))
+        eq_(set([thumbnail1, thumbnail2]), set(cover.thumbnails))
+        eq_((400, 600), (cover.image_width, cover.image_height))
+
+        # An image that's already small enough isn't scaled.
+        eq_([(tiny, False)], results[tiny])
+        eq_([], tiny.thumbnails)
+
+        # A problem with one image doesn't affect the others.
+        eq_([(not_an_image, False)], results[not_an_image])
+        assert ("Cannot load non-image representation as image"
+                in not_an_image.scale_exception)
+
+        # Thumbnails that already exist are left alone unless
+        # they're forced.
+        old_content = thumbnail1.content
+        [(thumbnail, is_new)] = Representation.scale_many(
+            [(cover, [(400, 700, url1, "image/png")])]
+        )[cover]
+        eq_((thumbnail1, False), (thumbnail, is_new))
+        eq_(old_content, thumbnail1.content)
+
+        [(thumbnail, is_new)] = Representation.scale_many(
+            [(cover, [(400, 700, url1, "image/png")])], force=True
+        )[cover]
+        eq_((thumbnail1, True), (thumbnail, is_new))
+        eq_(400, thumbnail1.image_height)
+
     def test_best_covers_among(self):
         # Here's a book with a thumbnail image.
         edition, pool = self._edition(with_license_pool=True)
@@ -4446,6 +4921,17 @@ class TestWorkCoverageRecord(DatabaseTest):
         eq_(record5, record)
         eq_(WorkCoverageRecord.PERSISTENT_FAILURE, record.status)
 
+        # Outside of a PresentationBatch, the database is checked even
+        # if the Work's coverage records have been loaded, since the
+        # loaded collection might be out of date.
+        work.coverage_records
+        elsewhere = WorkCoverageRecord(work_id=work.id, operation="bar")
+        self._db.add(elsewhere)
+        self._db.flush()
+        record6, is_new = WorkCoverageRecord.add_for(work, "bar")
+        eq_(False, is_new)
+        eq_(elsewhere, record6)
+
 class TestComplaint(DatabaseTest):
 
     def setup(self):
@@ -4776,3 +5262,60 @@ class TestMaterializedViews(DatabaseTest):
         # to be the data source ID of the presentation edition.
         eq_(presentation_edition.data_source.id, mw.data_source_id)
         eq_(presentation_edition.data_source.id, mwg.data_source_id)
+
+    def test_update_materialized_views(self):
+        from model import MaterializedWork as mwc
+
+        def make_work(title):
+            work = self._work(title=title, with_license_pool=True)
+            work.presentation_ready = True
+            work.simple_opds_entry = '<entry>'
+            return work
+        work1 = make_work(u"Title 1")
+        work2 = make_work(u"Title 2")
+        SessionManager.refresh_materialized_views(self._db)
+
+        if SessionManager.is_materialized_view(self._db, mwc.__table__.name):
+            # A real materialized view can't be updated one row at a
+            # time; the caller has to fall back to a full refresh.
+            eq_(False, SessionManager.update_materialized_views(
+                self._db, [work1.id]))
+            raise SkipTest(
+                "The test database uses real materialized views."
+            )
+
+        def titles():
+            self._db.expire_all()
+            return sorted(
+                (x.works_id, x.sort_title) for x in self._db.query(mwc)
+            )
+
+        work1.presentation_edition.sort_title = u"New title 1"
+        work2.presentation_edition.sort_title = u"New title 2"
+        work3 = make_work(u"Title 3")
+        self._db.flush()
+
+        # Only the works we ask about are updated.
+        eq_(True, SessionManager.update_materialized_views(
+            self._db, [work1.id, work3.id]))
+        eq_([(work1.id, u"New title 1"), (work2.id, u"Title 2"),
+             (work3.id, u"Title 3")], titles())
+
+        # A work that's no longer presentation-ready is removed.
+        work1.presentation_ready = False
+        self._db.flush()
+        SessionManager.update_materialized_views(self._db, [work1.id])
+        eq_([(work2.id, u"Title 2"), (work3.id, u"Title 3")], titles())
+
+        # A deleted work is recorded, and its rows are removed once
+        # its ID is passed in.
+        work3_id = work3.id
+        self._db.delete(work3)
+        self._db.flush()
+        eq_([work3_id], [x.work_id for x in self._db.query(DeletedWork)])
+        SessionManager.update_materialized_views(self._db, [work3_id])
+        eq_([(work2.id, u"Title 2")], titles())
+
+        # A full refresh brings everything up to date.
+        SessionManager.refresh_materialized_views(self._db)
+        eq_([(work2.id, u"New title 2")], titles())
@@ -4,6 +4,9 @@ from nose.tools import (
     assert_raises_regexp,
 )
 import datetime
+import os
+import time
+from mock import patch
 
 from . import DatabaseTest
 
@@ -13,19 +16,47 @@ from testing import (
     BrokenCoverageProvider,
 )
 
+from classifier import (
+    Epic_Fantasy,
+    Fantasy,
+)
+
+from config import (
+    Configuration,
+    temp_config,
+)
+
+from lane import (
+    Facets,
+    Lane,
+)
+
 from model import (
+    CachedFeed,
     DataSource,
     Identifier,
+    RecursiveEquivalent,
+    RecursiveEquivalentUpdate,
+    Representation,
     Subject,
     Timestamp,
+    get_one,
+    get_one_or_create,
 )
 
 from monitor import (
+    BlobCollectionMonitor,
+    CachedFeedWarmingMonitor,
     Monitor,
     PresentationReadyMonitor,
+    RecursiveEquivalentUpdateMonitor,
     SubjectSweepMonitor,
+    WorkSweepMonitor,
 )
 
+from opds import TestAnnotatorWithGroup
+from util.blob_store import LocalBlobStore
+
 class DummyMonitor(Monitor):
 
     def __init__(self, _db):
@@ -103,6 +134,39 @@ class TestPresentationReadyMonitor(DatabaseTest):
             "Provider(s) failed: Provider 2",
             self.work.presentation_ready_exception)
 
+    def test_equivalencies_added_by_prepare_are_used(self):
+        work2 = self._work(DataSource.GUTENBERG, with_license_pool=True)
+        work2.presentation_ready = False
+        new_identifier = self._identifier()
+
+        class Monitor(PresentationReadyMonitor):
+            def prepare(self, work):
+                if work == work2:
+                    # A coverage provider discovers an equivalency
+                    # for the second work in the batch.
+                    work.presentation_edition.primary_identifier.equivalent_to(
+                        self.oclc, new_identifier, 1
+                    )
+                return []
+
+        calls = {}
+        def recorder(work):
+            def calculate_presentation(*args, **kwargs):
+                calls[work] = kwargs['identifier_ids']
+            return calculate_presentation
+        for work in (self.work, work2):
+            work.calculate_presentation = recorder(work)
+
+        monitor = Monitor(self._db, [])
+        monitor.oclc = self.oclc
+        monitor.process_batch([self.work, work2])
+
+        # The second work's new equivalent identifier was taken into
+        # account, even though the first work was handled first.
+        assert new_identifier.id in calls[work2]
+        assert new_identifier.id not in calls[self.work]
+        eq_(True, work2.presentation_ready)
+
     def test_prepare_returns_failing_providers(self):
 
         success = AlwaysSuccessfulCoverageProvider(
@@ -161,4 +225,258 @@ class TestSubjectSweepMonitor(DatabaseTest):
             self._db, "Test Monitor", Subject.TAG, "Years"
         )
         eq_([s2], specific_tag_monitor.subject_query().all())
-        
+
+
+class DummyWorkSweepMonitor(WorkSweepMonitor):
+
+    def __init__(self, _db):
+        super(DummyWorkSweepMonitor, self).__init__(
+            _db, "Dummy work sweep monitor", batch_size=2
+        )
+        self.processed = []
+
+    def process_work(self, work):
+        self.processed.append(work)
+
+
+class TestWorkSweepMonitor(DatabaseTest):
+
+    def test_sweep_one_shard(self):
+        works = sorted([self._work() for i in range(5)], key=lambda x: x.id)
+        monitor = DummyWorkSweepMonitor(self._db)
+
+        # Sweep through the IDs after the first work, up to and
+        # including the fourth.
+        monitor.shard_end = works[3].id
+        monitor.sweep("Dummy shard", works[0].id)
+        eq_(works[1:4], monitor.processed)
+
+        # The shard's Timestamp shows that it's finished.
+        timestamp = get_one(self._db, Timestamp, service="Dummy shard")
+        eq_(works[3].id, timestamp.counter)
+
+        # Sweeping it again does nothing.
+        monitor.processed = []
+        monitor.stop_running = False
+        monitor.sweep("Dummy shard", works[0].id)
+        eq_([], monitor.processed)
+
+    def test_shard_service_name(self):
+        monitor = DummyWorkSweepMonitor(self._db)
+        eq_("Dummy work sweep monitor (shard 2 of 4)",
+            monitor.shard_service_name(1, 4))
+
+    def test_sharding_is_opt_in(self):
+        works = sorted([self._work() for i in range(3)], key=lambda x: x.id)
+        sharded = []
+        with temp_config() as config:
+            config[Configuration.POLICIES] = {
+                Configuration.SWEEP_PROCESSES : 4
+            }
+
+            # This monitor hasn't said it can be sharded, so it does
+            # the whole sweep itself.
+            monitor = DummyWorkSweepMonitor(self._db)
+            monitor.run_sharded = sharded.append
+            monitor.run()
+            eq_([], sharded)
+            eq_(works, monitor.processed)
+
+            monitor = DummyWorkSweepMonitor(self._db)
+            monitor.SHARDABLE = True
+            monitor.run_sharded = sharded.append
+            monitor.run()
+            eq_([4], sharded)
+
+    def test_sharded_sweep_keeps_own_timestamp(self):
+        monitor = DummyWorkSweepMonitor(self._db)
+        eq_("Dummy work sweep monitor (shards)", monitor.shards_service_name)
+
+        # A sharded sweep that's interrupted leaves the unsharded
+        # sweep's Timestamp alone.
+        work = self._work()
+        monitor.SHARDABLE = True
+        with patch("monitor.run_in_processes", return_value=[1]):
+            monitor.run_sharded(2)
+
+        shards = get_one(
+            self._db, Timestamp, service=monitor.shards_service_name
+        )
+        eq_(work.id, shards.counter)
+        eq_(None, get_one(
+            self._db, Timestamp, service=monitor.service_name
+        ))
+
+
+class TestRecursiveEquivalentUpdateMonitor(DatabaseTest):
+
+    def test_run(self):
+        data_source = DataSource.lookup(self._db, DataSource.MANUAL)
+        a = self._identifier()
+        b = self._identifier()
+        c = self._identifier()
+
+        def equivalent_ids(identifier):
+            return sorted(
+                x.equivalent_id for x in self._db.query(RecursiveEquivalent).filter(
+                    RecursiveEquivalent.identifier_id==identifier.id
+                )
+            )
+
+        # Pretend these Equivalencies involve Identifiers with so many
+        # equivalents that they can't be handled during the flush.
+        old_limit = RecursiveEquivalent.SYNCHRONOUS_UPDATE_LIMIT
+        RecursiveEquivalent.SYNCHRONOUS_UPDATE_LIMIT = 0
+        try:
+            a.equivalent_to(data_source, b, 1)
+            b.equivalent_to(data_source, c, 1)
+            self._db.flush()
+        finally:
+            RecursiveEquivalent.SYNCHRONOUS_UPDATE_LIMIT = old_limit
+        eq_([a.id], equivalent_ids(a))
+
+        # The queue is worked through in batches until it's empty.
+        monitor = RecursiveEquivalentUpdateMonitor(self._db, batch_size=1)
+        monitor.run()
+        eq_(0, self._db.query(RecursiveEquivalentUpdate).count())
+        eq_(sorted([a.id, b.id, c.id]), equivalent_ids(a))
+
+
+class TestBlobCollectionMonitor(DatabaseTest):
+
+    def test_run_once(self):
+        store = LocalBlobStore(
+            os.path.join(self.tmp_data_dir, Representation.BLOB_DIRECTORY)
+        )
+        representation, ignore = self._representation()
+        in_use = store.put("in use")
+        representation.local_content_path = os.path.join(
+            Representation.BLOB_DIRECTORY, in_use
+        )
+        self._db.flush()
+        unused = store.put("unused")
+        recent = store.put("recent")
+
+        # Make all but one of the blobs look old.
+        an_hour_ago = time.time() - 3600
+        for key in (in_use, unused):
+            os.utime(store.path(key), (an_hour_ago, an_hour_ago))
+
+        monitor = BlobCollectionMonitor(
+            self._db, grace_period=datetime.timedelta(minutes=1)
+        )
+        monitor.run_once(None, None)
+
+        # Only the old blob that no representation points to is
+        # removed.
+        eq_(True, store.exists(in_use))
+        eq_(False, store.exists(unused))
+        eq_(True, store.exists(recent))
+
+
+class TestCachedFeedWarmingMonitor(DatabaseTest):
+
+    def setup(self):
+        super(TestCachedFeedWarmingMonitor, self).setup()
+        self.fantasy = Lane(self._db, "Fantasy", genres=[Fantasy])
+        [self.epic] = [x for x in self.fantasy.sublanes
+                       if x.name == Epic_Fantasy.name]
+        self.monitor = CachedFeedWarmingMonitor(
+            self._db, self.fantasy, TestAnnotatorWithGroup(),
+            use_materialized_works=False
+        )
+
+    def cached_feed(self, lane, type, facets=None, **kwargs):
+        key = CachedFeedWarmingMonitor.cache_key(lane, type, facets)
+        lane_name, languages, type, facets, pagination = key
+        feed, ignore = get_one_or_create(
+            self._db, CachedFeed, lane_name=lane_name, languages=languages,
+            type=type, facets=facets, pagination=pagination
+        )
+        for k, v in kwargs.items():
+            setattr(feed, k, v)
+        return feed
+
+    def test_all_lanes(self):
+        lanes = list(self.monitor.all_lanes())
+        eq_(self.fantasy, lanes[0])
+        assert self.epic in lanes
+        eq_(len(self.fantasy.sublanes) + 1, len(lanes))
+
+    def test_feeds_to_warm(self):
+        default = Facets.default()
+
+        # With nothing cached, the groups feed and the default page
+        # feed for every lane need to be generated, in lane order.
+        feeds = self.monitor.feeds_to_warm()
+        eq_((self.fantasy, CachedFeed.GROUPS_TYPE, None), feeds[0])
+        eq_(self.fantasy, feeds[1][0])
+        eq_(CachedFeed.PAGE_TYPE, feeds[1][1])
+        eq_(len(self.fantasy.sublanes) + 2, len(feeds))
+        for lane, type, facets in feeds[1:]:
+            eq_(default.query_string, facets.query_string)
+
+        # A feed with other facets is warmed once someone has asked
+        # for it, and popular feeds are warmed first.
+        popular_facets = Facets(
+            collection=Facets.COLLECTION_FULL,
+            availability=Facets.AVAILABLE_NOW,
+            order=Facets.ORDER_TITLE
+        )
+        self.cached_feed(self.epic, CachedFeed.PAGE_TYPE, popular_facets,
+                         request_count=10)
+
+        # A fresh feed doesn't need to be regenerated.
+        now = datetime.datetime.utcnow()
+        self.cached_feed(self.fantasy, CachedFeed.GROUPS_TYPE,
+                         content=u"groups", timestamp=now, request_count=100)
+
+        feeds = self.monitor.feeds_to_warm(now)
+        lane, type, facets = feeds[0]
+        eq_(self.epic, lane)
+        eq_(popular_facets.query_string, facets.query_string)
+        assert (self.fantasy, CachedFeed.GROUPS_TYPE, None) not in feeds
+        eq_(len(self.fantasy.sublanes) + 2, len(feeds))
+
+    def test_needs_refresh(self):
+        now = datetime.datetime.utcnow()
+        m = self.monitor.needs_refresh
+        eq_(True, m(None, self.epic, CachedFeed.PAGE_TYPE, now))
+
+        feed = self.cached_feed(self.epic, CachedFeed.PAGE_TYPE,
+                                Facets.default())
+        eq_(True, m(feed, self.epic, CachedFeed.PAGE_TYPE, now))
+
+        # A page feed that will go stale before the next run is
+        # regenerated now.
+        max_age = Configuration.page_max_age()
+        feed.timestamp = now - max_age + datetime.timedelta(seconds=1)
+        eq_(True, m(feed, self.epic, CachedFeed.PAGE_TYPE, now))
+        feed.timestamp = now
+        eq_(False, m(feed, self.epic, CachedFeed.PAGE_TYPE, now))
+
+        # A groups feed that's cached forever is regenerated once
+        # it's old enough.
+        feed.timestamp = now - self.monitor.forever_refresh_age
+        eq_(True, m(feed, self.fantasy, CachedFeed.GROUPS_TYPE, now))
+        feed.timestamp = now
+        eq_(False, m(feed, self.fantasy, CachedFeed.GROUPS_TYPE, now))
+
+    def test_run_once(self):
+        work = self._work(genre=Epic_Fantasy, with_open_access_download=True)
+        monitor = CachedFeedWarmingMonitor(
+            self._db, self.epic, TestAnnotatorWithGroup(),
+            use_materialized_works=False
+        )
+        monitor.run_once(None, None)
+
+        [cached] = self._db.query(CachedFeed).all()
+        eq_(self.epic.name, cached.lane_name)
+        eq_(CachedFeed.PAGE_TYPE, cached.type)
+        assert work.title in cached.content
+
+        # Regenerating a feed doesn't count as a request for it.
+        eq_(0, cached.request_count)
+
+        # Now that the feed is fresh, there's nothing to do.
+        eq_([], monitor.feeds_to_warm())
@@ -23,6 +23,7 @@ from model import (
     DataSource,
     DeliveryMechanism,
     Genre,
+    MaterializedWork,
     Measurement,
     Representation,
     SessionManager,
@@ -66,6 +67,10 @@ from classifier import (
 
 from external_search import DummyExternalSearchIndex
 import xml.etree.ElementTree as ET
+from sqlalchemy import (
+    event,
+    inspect,
+)
 from flask.ext.babel import lazy_gettext as _
 
 class TestBaseAnnotator(DatabaseTest):
@@ -825,6 +830,105 @@ class TestOPDS(DatabaseTest):
             eq_(lane.display_name, links[i+1].get("title"))
             eq_(TestAnnotator.lane_url(lane), links[i+1].get("href"))
 
+    def test_page_feed_streaming(self):
+        fantasy_lane = self.lanes.by_languages['']['Epic Fantasy']
+        work1 = self._work(genre=Epic_Fantasy, with_open_access_download=True)
+        work2 = self._work(genre=Epic_Fantasy, with_open_access_download=True)
+
+        def make_page(force_refresh=False):
+            return AcquisitionFeed.page(
+                self._db, "test", self._url, fantasy_lane, TestAnnotator,
+                use_materialized_works=False, stream=True,
+                force_refresh=force_refresh
+            )
+
+        # Nothing is cached until the stream has been consumed.
+        chunks = make_page()
+        [cached] = self._db.query(CachedFeed).all()
+        eq_(None, cached.content)
+
+        chunks = list(chunks)
+        assert len(chunks) > 2
+        parsed = feedparser.parse("".join(chunks))
+        eq_(set([work1.title, work2.title]),
+            set([x['title'] for x in parsed['entries']]))
+        [start] = self.links(parsed, 'start')
+
+        # Both works fit on the first page, so there's no next page.
+        eq_([], self.links(parsed, 'next'))
+
+        # Now the whole document has been cached, in the session that
+        # generated it, and it's saved when that session is committed.
+        eq_("".join(chunks), cached.content)
+        assert cached in self._db.dirty
+        self._db.commit()
+        eq_("".join(chunks), cached.content)
+
+        # Next time, the cached document is streamed as-is.
+        eq_([cached.content], list(make_page()))
+
+    def test_page_feed_streaming_needs_its_session(self):
+        fantasy_lane = self.lanes.by_languages['']['Epic Fantasy']
+        works = [
+            self._work(genre=Epic_Fantasy, with_open_access_download=True)
+        ]
+
+        def make_page():
+            return AcquisitionFeed.page(
+                self._db, "test", self._url, fantasy_lane, TestAnnotator,
+                use_materialized_works=False, stream=True,
+                force_refresh=True
+            )
+
+        def statements_while_consuming(chunks):
+            statements = []
+            def count(conn, cursor, statement, *args):
+                statements.append(statement)
+            event.listen(self.connection, 'before_cursor_execute', count)
+            try:
+                "".join(chunks)
+            finally:
+                event.remove(self.connection, 'before_cursor_execute', count)
+            return statements
+
+        # Build the feed once so that every work has a cached entry.
+        "".join(make_page())
+
+        # The entries are built as the stream is consumed, but
+        # everything they need was loaded beforehand, so consuming
+        # a stream doesn't take more queries for more works.
+        one_work = statements_while_consuming(make_page())
+        works.append(
+            self._work(genre=Epic_Fantasy, with_open_access_download=True)
+        )
+        works.append(
+            self._work(genre=Epic_Fantasy, with_open_access_download=True)
+        )
+        "".join(make_page())
+        eq_(len(one_work), len(statements_while_consuming(make_page())))
+
+        # The CachedFeed's row can be locked by the request's own
+        # session while the stream is consumed, since nothing else
+        # writes to it.
+        chunks = make_page()
+        [cached] = self._db.query(CachedFeed).all()
+        self._db.execute(
+            "update cachedfeeds set request_count = "
+            "coalesce(request_count, 0) + 1 where id = %d" % cached.id
+        )
+        content = "".join(chunks)
+        eq_(content, cached.content)
+        parsed = feedparser.parse(content)
+        eq_(set([x.title for x in works]),
+            set([x['title'] for x in parsed['entries']]))
+
+        # If the session is committed before the stream is consumed,
+        # consuming it raises an exception rather than reloading every
+        # work from the database.
+        chunks = make_page()
+        self._db.commit()
+        assert_raises(Exception, list, chunks)
+
     def test_groups_feed(self):
         """Test the ability to create a grouped feed of recommended works for
         a given lane.
@@ -1126,6 +1230,99 @@ class TestAcquisitionFeed(DatabaseTest):
         assert entry_string != tiny_entry
         eq_(entry_string, work.simple_opds_entry)
 
+    def test_create_entry_splices_cached_entry(self):
+        class GroupAnnotator(VerboseAnnotator):
+            opds_cache_field = Work.simple_opds_entry.name
+            @classmethod
+            def group_uri(cls, work, license_pool, identifier):
+                return "http://group/", "Group"
+
+        def contents(entry):
+            return [(x.tag, dict(x.attrib), x.text) for x in entry.iter()]
+
+        work = self._work(with_open_access_download=True)
+        work.quality = 0.5
+        feed = AcquisitionFeed(
+            self._db, self._str, self._url, [], annotator=GroupAnnotator
+        )
+
+        # Normally a cached entry is parsed and annotated.
+        parsed = feed.create_entry(work, self._url)
+
+        # With serialized=True, the annotations are spliced into the
+        # cached entry as a string.
+        spliced = feed.create_entry(work, self._url, serialized=True)
+        assert isinstance(spliced, basestring)
+        assert spliced.startswith(work.simple_opds_entry[:-len("</entry>")])
+        eq_(contents(parsed), contents(etree.fromstring(spliced)))
+        assert 'href="http://group/"' in spliced
+        assert 'schema:Rating' in spliced
+
+        # An annotator that needs to see the whole entry gets a parsed one.
+        GroupAnnotator.splice_cached_entries = False
+        entry = feed.create_entry(work, self._url, serialized=True)
+        eq_(contents(parsed), contents(entry))
+
+        # So does an annotator that doesn't say it only adds tags.
+        class UnknownAnnotator(Annotator):
+            opds_cache_field = Work.simple_opds_entry.name
+        feed.annotator = UnknownAnnotator
+        entry = feed.create_entry(work, self._url, serialized=True)
+        assert not isinstance(entry, basestring)
+
+    def test_preload(self):
+        work1 = self._work(genre=Epic_Fantasy, with_open_access_download=True)
+        work2 = self._work(genre=Mystery, with_open_access_download=True)
+        self._db.commit()
+
+        # Start with Works that have none of their relationships loaded.
+        self._db.expire_all()
+        works = self._db.query(Work).filter(
+            Work.id.in_([work1.id, work2.id])
+        ).order_by(Work.id).all()
+        for work in works:
+            assert 'work_genres' in inspect(work).unloaded
+
+        feed = AcquisitionFeed(
+            self._db, self._str, self._url, [], annotator=VerboseAnnotator
+        )
+        eq_([], feed._preloaded)
+        feed.preload(works)
+
+        # Everything the annotator needs has been loaded.
+        for work in works:
+            eq_(set(), set(['work_genres', 'presentation_edition', 'summary'])
+                & inspect(work).unloaded)
+            edition = work.presentation_edition
+            assert 'contributions' not in inspect(edition).unloaded
+            [pool] = work.license_pools
+            assert 'delivery_mechanisms' not in inspect(pool).unloaded
+        eq_(["Epic Fantasy"], [x.genre.name for x in works[0].work_genres])
+
+        # Lookup feeds use (identifier, work) tuples, and anything
+        # that isn't a Work is ignored.
+        feed.preload([(None, works[0]), None, "not a work"])
+
+        # A MaterializedWork's license pool is preloaded through the
+        # Work it was made from, which the feed holds on to.
+        SessionManager.refresh_materialized_views(self._db)
+        [materialized] = self._db.query(MaterializedWork).filter(
+            MaterializedWork.works_id==work1.id
+        ).all()
+        self._db.expire_all()
+        feed.preload([materialized])
+        eq_([work1.id], [x.id for x in feed._preloaded])
+        pool = materialized.license_pool
+        assert 'delivery_mechanisms' not in inspect(pool).unloaded
+        assert 'identifier' not in inspect(pool).unloaded
+
+        # Constructing a feed preloads its works.
+        feed = AcquisitionFeed(
+            self._db, self._str, self._url, works, annotator=VerboseAnnotator
+        )
+        parsed = feedparser.parse(unicode(feed))
+        eq_([work1.title, work2.title], [x['title'] for x in parsed['entries']])
+
     def test_exception_during_entry_creation_is_not_reraised(self):
         # This feed will raise an exception whenever it's asked
         # to create an entry.
@@ -8,6 +8,7 @@ from nose.tools import (
     assert_raises
 )
 import feedparser
+from mock import patch
 
 from lxml import etree
 import pkgutil
@@ -26,10 +27,13 @@ from opds_import import (
     OPDSImporterWithS3Mirror,
     OPDSImportMonitor,
     OPDSXMLParser,
+    ParsedOPDSFeed,
+    sanitize_html,
 )
 from util.opds_writer import OPDSMessage
 from metadata_layer import (
-    LinkData
+    LinkData,
+    Metadata,
 )
 from model import (
     Contributor,
@@ -153,6 +157,30 @@ class TestOPDSImporter(OPDSImporterTest):
         eq_(datetime.datetime(2015, 1, 2, 16, 56, 40), updated2)
 
 
+    def test_parse_page(self):
+        feed = self.content_server_mini_feed
+        parsed = OPDSImporter.parse_page(feed)
+
+        # One walk through the feed finds everything the other
+        # methods find separately.
+        eq_(OPDSImporter.extract_next_links(feed), parsed.next_links)
+        eq_(OPDSImporter.extract_last_update_dates(feed),
+            parsed.last_update_dates)
+        eq_(parsed.next_links, OPDSImporter.extract_next_links(parsed))
+        eq_(parsed.last_update_dates,
+            OPDSImporter.extract_last_update_dates(parsed))
+        eq_(2, len(parsed.entries))
+        eq_(1, len(parsed.messages))
+
+        # The result can be turned into the same data as the feed.
+        data_source = DataSource.lookup(self._db, DataSource.OA_CONTENT_SERVER)
+        from_feed = OPDSImporter.extract_data_in_one_pass(feed, data_source)
+        from_parsed = OPDSImporter.extract_data_in_one_pass(
+            parsed, data_source
+        )
+        for old, new in zip(from_feed, from_parsed):
+            eq_(sorted(old.keys()), sorted(new.keys()))
+
     def test_extract_metadata(self):
         importer = OPDSImporter(self._db, DataSource.NYT)
         metadata, failures = importer.extract_feed_data(
@@ -434,6 +462,48 @@ class TestOPDSImporter(OPDSImporterTest):
         eq_(True, failure.transient)
         assert "Utter failure!" in failure.exception
 
+    def test_extract_data_in_one_pass(self):
+        data_source = DataSource.lookup(self._db, DataSource.OA_CONTENT_SERVER)
+        feed = self.content_server_feed
+
+        fp_values, xml_values, failures = OPDSImporter.extract_data_in_one_pass(
+            feed, data_source
+        )
+
+        # We got the same information as we would by parsing the feed
+        # with both feedparser and lxml.
+        old_fp_values, old_fp_failures = OPDSImporter.extract_data_from_feedparser(
+            feed, data_source
+        )
+        old_xml_values, old_xml_failures = OPDSImporter.extract_metadata_from_elementtree(
+            feed, data_source
+        )
+        eq_(set(old_fp_failures.keys() + old_xml_failures.keys()),
+            set(failures.keys()))
+
+        eq_(sorted(old_fp_values.keys()), sorted(fp_values.keys()))
+        for id, old in old_fp_values.items():
+            new = fp_values[id]
+            for key in ('title', 'subtitle', 'language', 'publisher',
+                        'data_source_last_updated'):
+                eq_(old[key], new[key])
+            eq_([(x.rel, x.media_type, x.content) for x in old['links']],
+                [(x.rel, x.media_type, x.content) for x in new['links']])
+            old_circulation = old.get('circulation') or {}
+            new_circulation = new.get('circulation') or {}
+            for key in ('data_source', 'default_rights_uri'):
+                eq_(old_circulation.get(key), new_circulation.get(key))
+
+        eq_(sorted(old_xml_values.keys()), sorted(xml_values.keys()))
+        for id, old in old_xml_values.items():
+            new = xml_values[id]
+            eq_(old['medium'], new['medium'])
+            eq_([x.href for x in old['links']], [x.href for x in new['links']])
+            eq_([x.sort_name for x in old['contributors']],
+                [x.sort_name for x in new['contributors']])
+            eq_([x.identifier for x in old['subjects']],
+                [x.identifier for x in new['subjects']])
+
     def test_import_exception_if_unable_to_parse_feed(self):
         feed = "I am not a feed."
         importer = OPDSImporter(self._db)
@@ -958,6 +1028,27 @@ class TestOPDSImporterWithS3Mirror(OPDSImporterTest):
         eq_(svg, s3.content[5])
         eq_("I am a new version of 10557.epub.images", s3.content[7])
 
+    def test_prefetch_skips_links_that_wont_be_fetched(self):
+        class CachingImporter(OPDSImporter):
+            def replacement_policy(self):
+                policy = super(CachingImporter, self).replacement_policy()
+                policy.link_content = False
+                return policy
+
+        importer = CachingImporter(self._db, mirror=DummyS3Uploader())
+        representation, ignore = self._representation(
+            media_type=Representation.PNG_MEDIA_TYPE, content="an image"
+        )
+        representation.status_code = 200
+        metadata = Metadata(
+            DataSource.GUTENBERG,
+            links=[LinkData(rel=Hyperlink.IMAGE, href=representation.url)]
+        )
+
+        # mirror_link will use the image we already have, so there's
+        # nothing to download.
+        eq_(None, importer.prefetch_mirrored_links([metadata]))
+
 
 class TestOPDSImportMonitor(OPDSImporterTest):
 
@@ -1045,7 +1136,12 @@ class TestOPDSImportMonitor(OPDSImporterTest):
         eq_(1, len(next_links))
         eq_("http://localhost:5000/?after=327&size=100", next_links[0])
 
-        eq_(feed, content)
+        # The page was parsed once, and the result will be used to
+        # import it.
+        assert isinstance(content, ParsedOPDSFeed)
+        eq_(next_links, content.next_links)
+        eq_("http://url", content.feed_url)
+        eq_(2, len(content.entries))
 
         # Now import the editions and add coverage records.
         monitor.importer.import_from_feed(feed)
@@ -1132,7 +1228,7 @@ class TestOPDSImportMonitor(OPDSImporterTest):
             def queue_response(self, response):
                 self.responses.append(response)
 
-            def follow_one_link(self, link, cutoff_date=None, do_get=None):
+            def follow_one_link(self, link, **kwargs):
                 return self.responses.pop()
 
             def import_one_feed(self, feed, feed_url):
@@ -1148,3 +1244,113 @@ class TestOPDSImportMonitor(OPDSImporterTest):
 
         # Feeds are imported in reverse order
         eq_(["last page", "second page", "first page"], monitor.imports)
+
+    def test_run_once_looks_ahead(self):
+        class MockOPDSImportMonitor(OPDSImportMonitor):
+            next_links = {
+                "http://url/1" : "http://url/2",
+                "http://url/2" : "http://url/3",
+                "http://url/3" : None,
+            }
+
+            def __init__(self, *args, **kwargs):
+                super(MockOPDSImportMonitor, self).__init__(*args, **kwargs)
+                self.requests = []
+                self.imports = []
+                self.nothing_new = set()
+
+            def _get(self, url, headers):
+                self.requests.append(url)
+                link = ''
+                if self.next_links[url]:
+                    link = '<link rel="next" href="%s"/>' % self.next_links[url]
+                return 200, {}, (
+                    '<feed xmlns="http://www.w3.org/2005/Atom">%s</feed>' % link
+                )
+
+            def check_for_new_data(self, feed):
+                return feed.feed_url not in self.nothing_new
+
+            def import_one_feed(self, feed, feed_url):
+                self.imports.append((feed_url, feed.next_links))
+
+        monitor = MockOPDSImportMonitor(
+            self._db, "http://url/1", DataSource.OA_CONTENT_SERVER,
+            OPDSImporter
+        )
+        monitor.run_once(None, None)
+
+        # Each page was fetched once, whether or not it was fetched
+        # ahead of time, and the parsed pages were imported in
+        # reverse order.
+        eq_(["http://url/1", "http://url/2", "http://url/3"],
+            sorted(monitor.requests))
+        eq_([("http://url/3", []),
+             ("http://url/2", ["http://url/3"]),
+             ("http://url/1", ["http://url/2"])],
+            monitor.imports)
+
+        # If there's nothing new on a page, the page after it may
+        # have been fetched ahead of time, but it isn't imported.
+        monitor = MockOPDSImportMonitor(
+            self._db, "http://url/1", DataSource.OA_CONTENT_SERVER,
+            OPDSImporter
+        )
+        monitor.nothing_new.add("http://url/2")
+        monitor.run_once(None, None)
+        eq_(["http://url/1", "http://url/2"], monitor.requests[:2])
+        assert len(monitor.requests) <= 3
+        eq_([("http://url/1", ["http://url/2"])], monitor.imports)
+
+        # Without looking ahead, the result is the same.
+        monitor = MockOPDSImportMonitor(
+            self._db, "http://url/1", DataSource.OA_CONTENT_SERVER,
+            OPDSImporter
+        )
+        monitor.LOOK_AHEAD = False
+        monitor.run_once(None, None)
+        eq_(["http://url/1", "http://url/2", "http://url/3"],
+            monitor.requests)
+        eq_(["http://url/3", "http://url/2", "http://url/1"],
+            [x[0] for x in monitor.imports])
+
+    def test_spill(self):
+        monitor = OPDSImportMonitor(
+            self._db, "http://url", DataSource.OA_CONTENT_SERVER,
+            OPDSImporter
+        )
+        parsed = OPDSImporter.parse_page(self.content_server_mini_feed)
+
+        # A parsed page can be written to disk and read back.
+        spilled = monitor._spill(parsed)
+        loaded = monitor._unspill(spilled)
+        eq_(True, spilled.closed)
+        eq_(parsed.feed_url, loaded.feed_url)
+        eq_(parsed.next_links, loaded.next_links)
+        eq_(parsed.last_update_dates, loaded.last_update_dates)
+        eq_(parsed.messages, loaded.messages)
+        eq_([x[0] for x in parsed.entries], [x[0] for x in loaded.entries])
+
+        # What's read back can be imported.
+        data_source = DataSource.lookup(self._db, DataSource.OA_CONTENT_SERVER)
+        fp_values, xml_values, failures = OPDSImporter.extract_data_in_one_pass(
+            loaded, data_source
+        )
+        eq_(2, len(fp_values))
+
+
+class TestSanitizeHTML(object):
+
+    def test_sanitize_html(self):
+        html = '<p>Some <b>bold</b> text<script>alert("hi")</script></p>'
+        eq_('<p>Some <b>bold</b> text</p>', sanitize_html(html, 'text/html'))
+
+        # If feedparser's sanitizer isn't available, lxml's is used.
+        with patch("opds_import._feedparser_sanitize_html", None):
+            eq_('<p>Some <b>bold</b> text</p>',
+                sanitize_html(html, 'text/html'))
+            eq_('', sanitize_html('', 'text/html'))
+
+            # If that isn't available either, only the text is kept.
+            with patch("opds_import._html_cleaner", None):
+                eq_('Some bold text', sanitize_html(html, 'text/html'))
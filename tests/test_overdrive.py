@@ -7,6 +7,7 @@ from nose.tools import (
 import os
 import json
 import pkgutil
+import threading
 
 from overdrive import (
     OverdriveAPI,
@@ -110,6 +111,51 @@ class TestOverdriveAPI(OverdriveTest):
         # The bearer token has been updated.
         eq_("new bearer token", self.api.token)
 
+    def test_token_refreshed_once_for_simultaneous_401s(self):
+        self.api.queue_response(
+            200, content=self.api.mock_access_token("new bearer token")
+        )
+
+        # Another thread got a 401 at the same time as this one, and
+        # has already refreshed the token.
+        self.api.token = "token from another thread"
+        self.api.check_creds(True, rejected_token="bearer token")
+
+        # This thread doesn't ask for a new token.
+        eq_(1, len(self.api.responses))
+        eq_("token from another thread", self.api.token)
+
+        # But if the token it was using is still the current one, it
+        # does.
+        self.api.check_creds(True, rejected_token="token from another thread")
+        eq_([], self.api.responses)
+        eq_("new bearer token", self.api.token)
+
+    def test_401_in_another_thread_refreshes_bearer_token(self):
+        # A metadata lookup thread refreshes the token in a database
+        # session of its own.
+        self.api.queue_response(401)
+        self.api.queue_response(
+            200, content=self.api.mock_access_token("new bearer token")
+        )
+        self.api.queue_response(200, content="at last, the content")
+
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(self.api.get(self._url, {}))
+        )
+        thread.start()
+        thread.join()
+
+        [(status_code, headers, content)] = results
+        eq_("at last, the content", content)
+        eq_("new bearer token", self.api.token)
+
+        # The new token made it into the database.
+        self._db.expire_all()
+        credential = self.api.credential_object(lambda x: x)
+        eq_("new bearer token", credential.credential)
+
     def test_credential_refresh_success(self):
         """Verify the process of refreshing the Overdrive bearer token.
         """
@@ -0,0 +1,179 @@
+import shutil
+import tempfile
+
+from flask import Flask
+from nose.tools import (
+    assert_raises,
+    eq_,
+    set_trace,
+)
+
+from config import (
+    Configuration,
+    temp_config,
+)
+from rate_limit import (
+    RateLimiter,
+    RateLimitExceeded,
+)
+
+
+class MockRateLimiter(RateLimiter):
+    """A RateLimiter with a fake clock."""
+
+    def __init__(self, *args, **kwargs):
+        super(MockRateLimiter, self).__init__(*args, **kwargs)
+        self.time = 1000.0
+        self.waits = []
+
+    def _now(self):
+        return self.time
+
+    def _sleep(self, seconds):
+        self.waits.append(seconds)
+        self.time += seconds
+
+
+class TestRateLimiter(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def limiter(self, max_rate=2, burst=2, max_wait=60):
+        return MockRateLimiter(
+            "Some API", max_rate, burst, directory=self.directory,
+            max_wait=max_wait
+        )
+
+    def test_acquire(self):
+        limiter = self.limiter()
+
+        # The bucket starts out full, so a burst of requests can be
+        # made at once.
+        limiter.acquire()
+        limiter.acquire()
+        eq_([], limiter.waits)
+
+        # After that, requests have to wait for the bucket to refill.
+        limiter.acquire()
+        eq_([0.5], limiter.waits)
+
+        # Time spent doing something else counts.
+        limiter.time += 10
+        limiter.acquire()
+        limiter.acquire()
+        eq_([0.5], limiter.waits)
+
+    def test_bucket_is_shared(self):
+        # Two limiters for the same API (probably in different
+        # processes) share a bucket.
+        limiter1 = self.limiter()
+        limiter2 = self.limiter()
+        limiter1.acquire()
+        limiter1.acquire()
+        limiter2.acquire()
+        eq_([0.5], limiter2.waits)
+
+        # A limiter for a different API has its own bucket.
+        other = MockRateLimiter(
+            "Other API", 2, 2, directory=self.directory
+        )
+        other.acquire()
+        eq_([], other.waits)
+
+    def test_update(self):
+        limiter = self.limiter()
+
+        # A successful request at full speed changes nothing.
+        limiter.update(200, {})
+        eq_(2, limiter.rate)
+
+        # Being told to slow down halves the rate and stops all
+        # requests until the Retry-After time.
+        limiter.update(429, {"Retry-After": "30"})
+        eq_(1, limiter.rate)
+        limiter.acquire()
+        eq_([30], limiter.waits)
+
+        # Successful requests bring the rate back up, slowly.
+        limiter.update(200, {})
+        eq_(1.02, limiter.rate)
+
+        # A request that would have to wait too long isn't made.
+        limiter.update(429, {"Retry-After": "300"})
+        assert_raises(RateLimitExceeded, limiter.acquire)
+        eq_([30], limiter.waits)
+
+        # The rate never drops too far.
+        for i in range(10):
+            limiter.update(503)
+        eq_(0.1, limiter.rate)
+
+    def test_max_wait(self):
+        limiter = self.limiter(max_wait=None)
+        limiter.update(429, {"Retry-After": "300"})
+
+        # While handling a web request, a request waits only a short
+        # time for its turn.
+        app = Flask(__name__)
+        with app.test_request_context("/"):
+            eq_(RateLimiter.REQUEST_MAX_WAIT, limiter.max_wait_now())
+            assert_raises(RateLimitExceeded, limiter.acquire)
+        eq_([], limiter.waits)
+
+        # Otherwise it waits as long as it has to.
+        eq_(None, limiter.max_wait_now())
+        limiter.acquire()
+        eq_([300], limiter.waits)
+
+        # A limit that was set explicitly applies everywhere.
+        limiter.max_wait = 60
+        eq_(60, limiter.max_wait_now())
+        with app.test_request_context("/"):
+            eq_(60, limiter.max_wait_now())
+
+    def test_retry_after(self):
+        limiter = self.limiter()
+        eq_(RateLimiter.DEFAULT_RETRY_AFTER, limiter.retry_after(None))
+        eq_(RateLimiter.DEFAULT_RETRY_AFTER,
+            limiter.retry_after({"Retry-After": "soon"}))
+        eq_(5, limiter.retry_after({"retry-after": "5"}))
+        eq_(RateLimiter.MAX_RETRY_AFTER,
+            limiter.retry_after({"Retry-After": "1000000"}))
+
+        # Retry-After can be a date.
+        limiter.time = 784111777
+        eq_(20, limiter.retry_after(
+            {"Retry-After": "Sun, 06 Nov 1994 08:49:57 GMT"}
+        ))
+
+    def test_for_integration(self):
+        with temp_config() as config:
+            config[Configuration.DATA_DIRECTORY] = self.directory
+            config[Configuration.INTEGRATIONS] = {"Some API": {}}
+
+            # By default, requests aren't limited.
+            eq_(None, RateLimiter.for_integration("Some API"))
+
+            limiter = RateLimiter.for_integration("Some API", 5)
+            eq_(5, limiter.max_rate)
+            eq_(1, limiter.burst)
+            eq_(None, limiter.max_wait)
+            assert limiter.path.startswith(self.directory)
+
+            # The caller can ask for a shorter wait.
+            limiter = RateLimiter.for_integration("Some API", 5, max_wait=1)
+            eq_(1, limiter.max_wait)
+
+            config[Configuration.INTEGRATIONS]["Some API"] = {
+                Configuration.MAX_REQUESTS_PER_SECOND : 3,
+                Configuration.REQUEST_BURST : 10,
+                Configuration.RATE_LIMIT_MAX_WAIT : 60,
+            }
+            limiter = RateLimiter.for_integration("Some API", 5)
+            eq_(3, limiter.max_rate)
+            eq_(10, limiter.burst)
+            eq_(60, limiter.max_wait)
@@ -22,7 +22,9 @@ from s3 import (
     S3Uploader,
     DummyS3Uploader,
     MockS3Pool,
+    MockS3Response,
 )
+from requests.exceptions import ConnectionError
 
 class TestS3URLGeneration(DatabaseTest):
     
@@ -85,3 +87,48 @@ class TestUpload(DatabaseTest):
         eq_(Representation.PNG_MEDIA_TYPE, media_type)
         assert 'PNG' in data
         assert 'svg' not in data
+
+    def test_mirror_batch_retries_interrupted_uploads(self):
+        class InterruptedS3Pool(MockS3Pool):
+            """A pool whose first batch of uploads is interrupted
+            halfway through.
+            """
+            def __init__(self):
+                super(InterruptedS3Pool, self).__init__()
+                self.interrupted = False
+
+            def upload(self, remote_filename, fh, bucket=None, **kwargs):
+                super(InterruptedS3Pool, self).upload(
+                    remote_filename, fh, bucket, **kwargs
+                )
+                response = MockS3Response(
+                    S3Uploader.url(bucket, remote_filename)
+                )
+                response.status_code = 200
+                return response
+
+            def as_completed(self, requests):
+                for i, response in enumerate(requests):
+                    if i == 1 and not self.interrupted:
+                        self.interrupted = True
+                        raise ConnectionError("S3 went away")
+                    yield response
+
+        representations = []
+        for i in range(3):
+            representation, ignore = self._representation(
+                self._url, "text/plain", content="content %d" % i
+            )
+            representation.mirror_url = "http://s3.amazonaws.com/bucket/%d" % i
+            representations.append(representation)
+
+        s3pool = InterruptedS3Pool()
+        s3 = S3Uploader(pool=s3pool)
+        s3.MAX_OPEN_FILES = 2
+        s3.mirror_batch(representations)
+
+        # The first upload succeeded. The second was interrupted, and
+        # only it was tried again. The third went in a separate batch.
+        eq_(["0", "1", "1", "2"], [x[0] for x in s3pool.uploads])
+        for representation in representations:
+            assert representation.mirrored_at is not None
@@ -17,7 +17,8 @@ from model import (
     CustomList,
     DataSource,
     Identifier,
-    Timestamp
+    Timestamp,
+    WorkCoverageRecord,
 )
 from scripts import (
     Script,
@@ -26,6 +27,7 @@ from scripts import (
     DatabaseMigrationScript,
     IdentifierInputScript,
     AddClassificationScript,
+    RefreshMaterializedViewsScript,
     RunCoverageProviderScript,
     WorkProcessingScript,
     MockStdin,
@@ -533,3 +535,51 @@ class TestAddClassificationScript(DatabaseTest):
         subject = classification.subject
         eq_("some random tag", subject.identifier)
 
+
+class TestRefreshMaterializedViewsScript(DatabaseTest):
+
+    def test_changed_work_ids(self):
+        script = RefreshMaterializedViewsScript(self._db)
+        now = datetime.datetime.utcnow()
+        an_hour_ago = now - datetime.timedelta(hours=1)
+        updated = self._work(with_license_pool=True)
+        checked = self._work(with_license_pool=True)
+        unchanged = self._work(with_license_pool=True)
+        for work in (updated, checked, unchanged):
+            work.last_update_time = an_hour_ago
+            work.license_pools[0].last_checked = an_hour_ago
+        for record in self._db.query(WorkCoverageRecord):
+            record.timestamp = an_hour_ago
+
+        updated.last_update_time = now
+        checked.license_pools[0].last_checked = now
+        since = now - datetime.timedelta(minutes=1)
+        eq_(set([updated.id, checked.id]), script.changed_work_ids(since))
+
+        WorkCoverageRecord.add_for(unchanged, "some operation", now)
+        eq_(set([updated.id, checked.id, unchanged.id]),
+            script.changed_work_ids(since))
+
+        # A deleted work counts as changed, so its rows are removed.
+        deleted = self._work(with_license_pool=True)
+        deleted_id = deleted.id
+        self._db.delete(deleted)
+        self._db.flush()
+        eq_(set([updated.id, checked.id, unchanged.id, deleted_id]),
+            script.changed_work_ids(since))
+
+    def test_incremental_refresh_needs_recent_full_refresh(self):
+        script = RefreshMaterializedViewsScript(self._db)
+        now = datetime.datetime.utcnow()
+
+        # The views have never been refreshed.
+        eq_(False, script.do_incremental_refresh())
+
+        # We don't know when they were last fully refreshed.
+        script.stamp(now)
+        eq_(False, script.do_incremental_refresh())
+
+        # The last full refresh was too long ago.
+        script.stamp(now - script.FULL_REFRESH_INTERVAL * 2,
+                     script.full_refresh_service_name)
+        eq_(False, script.do_incremental_refresh())
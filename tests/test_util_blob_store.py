@@ -0,0 +1,78 @@
+import os
+import shutil
+import tempfile
+import time
+
+from nose.tools import (
+    eq_,
+    set_trace,
+)
+
+from util.blob_store import LocalBlobStore
+
+
+class TestLocalBlobStore(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = LocalBlobStore(self.directory)
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_put(self):
+        key = self.store.put("some content")
+
+        # The key is derived from the content.
+        eq_(self.store.key_for("some content"), key)
+        eq_(True, key.endswith(
+            "290f493c44f5d63d06b374d0a5abd292fae38b92cab2fae5efefe1b0e9347f56"
+        ))
+        eq_(True, self.store.exists(key))
+        eq_("some content", self.store.open(key).read())
+
+        # Storing the same content again doesn't create another file.
+        eq_(key, self.store.put("some content"))
+        files = []
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            files.extend(filenames)
+        eq_(1, len(files))
+
+        # Different content gets a different key.
+        other_key = self.store.put("other content")
+        assert other_key != key
+        eq_("other content", self.store.open(other_key).read())
+
+    def test_put_marks_document_as_recently_stored(self):
+        key = self.store.put("some content")
+        path = self.store.path(key)
+        os.utime(path, (1000, 1000))
+        self.store.put("some content")
+        assert os.path.getmtime(path) > 1000
+
+    def test_remove(self):
+        key = self.store.put("some content")
+
+        # A document stored after the given time isn't removed.
+        eq_(False, self.store.remove(key, time.time() - 60))
+        eq_(True, self.store.exists(key))
+
+        eq_(True, self.store.remove(key))
+        eq_(False, self.store.exists(key))
+
+        # Removing a document that isn't there does nothing.
+        eq_(False, self.store.remove(key))
+
+    def test_keys(self):
+        key = self.store.put("some content")
+        old_key = self.store.put("old content")
+        os.utime(self.store.path(old_key), (1000, 1000))
+
+        # A file that's still being written isn't a document.
+        open(os.path.join(self.directory, "tmpabcdef"), "w").close()
+
+        eq_(sorted([key, old_key]), sorted(self.store.keys()))
+        eq_([old_key], list(self.store.keys(2000)))
+
+    def test_exists(self):
+        eq_(False, self.store.exists(self.store.key_for("not stored")))
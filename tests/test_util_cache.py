@@ -0,0 +1,61 @@
+from nose.tools import (
+    eq_,
+    set_trace,
+)
+
+from util.cache import LRUCache
+
+
+class TestLRUCache(object):
+
+    def test_get_and_set(self):
+        cache = LRUCache(100)
+        eq_(None, cache.get("a"))
+        eq_("default", cache.get("a", "default"))
+
+        cache.set("a", "value")
+        eq_("value", cache.get("a"))
+        assert "a" in cache
+        eq_(5, cache.size)
+
+        # Replacing an item replaces its size.
+        cache.set("a", "longer value")
+        eq_("longer value", cache.get("a"))
+        eq_(1, len(cache))
+        eq_(12, cache.size)
+
+    def test_eviction_by_size(self):
+        cache = LRUCache(10)
+        cache.set("a", "aaaa")
+        cache.set("b", "bbbb")
+
+        # Using 'a' makes 'b' the least recently used item.
+        cache.get("a")
+        cache.set("c", "cccc")
+        eq_(["a", "c"], sorted(cache._items.keys()))
+        eq_(8, cache.size)
+
+        # An item that's bigger than the whole cache is not stored.
+        cache.set("d", "d" * 11)
+        assert "d" not in cache
+        eq_(2, len(cache))
+
+    def test_eviction_by_count(self):
+        cache = LRUCache(100, max_items=2)
+        cache.set("a", "a")
+        cache.set("b", "b")
+        cache.set("c", "c")
+        eq_(["b", "c"], sorted(cache._items.keys()))
+
+    def test_invalidate_and_clear(self):
+        cache = LRUCache(100)
+        cache.set("a", "aa")
+        cache.set("b", "bb")
+        cache.invalidate("a")
+        cache.invalidate("no such key")
+        eq_(["b"], cache._items.keys())
+        eq_(2, cache.size)
+
+        cache.clear()
+        eq_(0, len(cache))
+        eq_(0, cache.size)
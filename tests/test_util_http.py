@@ -1,6 +1,10 @@
 import requests
 import json
+import threading
+import time
+from mock import patch
 from util.http import (
+    ConcurrentFetcher,
     HTTP, 
     BadResponseException,
     RemoteIntegrationException,
@@ -177,6 +181,110 @@ class TestHTTP(object):
             assert isinstance(v, bytes)
         assert isinstance(data, bytes)
 
+    def test_session(self):
+        # Each thread gets its own session, which it keeps using, but
+        # the connection pools are shared by the whole process.
+        session = HTTP.session()
+        eq_(session, HTTP.session())
+
+        other_sessions = []
+        thread = threading.Thread(
+            target=lambda: other_sessions.append(HTTP.session())
+        )
+        thread.start()
+        thread.join()
+        [other_session] = other_sessions
+        assert other_session != session
+        eq_(session.get_adapter("https://foo/"),
+            other_session.get_adapter("https://foo/"))
+
+        # The session retries requests that fail in certain ways.
+        adapter = session.get_adapter("https://foo/")
+        eq_(HTTP.RETRY_STATUS_CODES,
+            adapter.max_retries.status_forcelist)
+        eq_(0, adapter.max_retries.read)
+        eq_(False, adapter.max_retries.respect_retry_after_header)
+
+        # A request whose rate is being limited goes through a session
+        # that leaves it to the rate limiter to deal with responses
+        # like 503.
+        limited_session = HTTP.session(retry_status=False)
+        assert limited_session != session
+        eq_(limited_session, HTTP.session(retry_status=False))
+        adapter = limited_session.get_adapter("https://foo/")
+        eq_([], list(adapter.max_retries.status_forcelist))
+
+        # Cookies set while a request is being made, e.g. during a
+        # redirect, aren't kept for the next request.
+        def request(*args, **kwargs):
+            session.cookies.set("a", "b", domain="foo.com")
+            eq_(1, len(session.cookies))
+            return MockRequestsResponse(200)
+        with patch.object(session, 'request', request):
+            HTTP.get_with_timeout("http://foo.com/")
+        eq_(0, len(session.cookies))
+
+        # Not even if the request fails.
+        def request(*args, **kwargs):
+            session.cookies.set("a", "b", domain="foo.com")
+            raise requests.exceptions.ConnectionError("Connection refused")
+        with patch.object(session, 'request', request):
+            assert_raises_regexp(
+                RequestNetworkException, "Connection refused",
+                HTTP.get_with_timeout, "http://foo.com/"
+            )
+        eq_(0, len(session.cookies))
+
+    def test_rate_limiter(self):
+        class MockRateLimiter(object):
+            def __init__(self):
+                self.calls = []
+
+            def acquire(self):
+                self.calls.append("acquire")
+
+            def update(self, status_code, headers):
+                self.calls.append((status_code, headers))
+
+        def fake_429_response(*args, **kwargs):
+            assert 'rate_limiter' not in kwargs
+            return MockRequestsResponse(429, {"Retry-After": "5"})
+
+        # The rate limiter is consulted before the request is made,
+        # and told about the response afterwards.
+        limiter = MockRateLimiter()
+        HTTP._request_with_timeout(
+            "http://url/", fake_429_response, rate_limiter=limiter
+        )
+        eq_(["acquire", (429, {"Retry-After": "5"})], limiter.calls)
+
+    def test_latency_statistics(self):
+        HTTP.reset_latency_statistics()
+
+        def fake_200_response(*args, **kwargs):
+            return MockRequestsResponse(200, content="Success!")
+
+        def immediately_timeout(*args, **kwargs):
+            raise requests.exceptions.Timeout("I give up")
+
+        HTTP._request_with_timeout("http://foo/1", fake_200_response)
+        HTTP._request_with_timeout("http://foo/2", fake_200_response)
+        assert_raises_regexp(
+            RequestTimedOut, "I give up",
+            HTTP._request_with_timeout, "http://bar/", immediately_timeout
+        )
+
+        stats = HTTP.latency_statistics()
+        eq_(set(["foo", "bar"]), set(stats.keys()))
+        eq_(2, stats["foo"]["requests"])
+        eq_(0, stats["foo"]["errors"])
+        eq_(1, stats["bar"]["requests"])
+        eq_(1, stats["bar"]["errors"])
+        assert stats["foo"]["max_time"] >= stats["foo"]["mean_time"]
+
+        HTTP.reset_latency_statistics()
+        eq_({}, HTTP.latency_statistics())
+
 class TestRemoteIntegrationException(object):
 
     def test_with_service_name(self):
@@ -285,3 +393,53 @@ class TestRequestNetworkException(object):
         document, status_code, headers = standard_detail.response
         eq_(502, status_code)
 
+
+class TestConcurrentFetcher(object):
+
+    def test_prefetch_and_get(self):
+        lock = threading.Lock()
+        requests = []
+        active = dict(count=0, most=0)
+        def do_get(url, headers):
+            with lock:
+                requests.append((url, headers))
+                active['count'] += 1
+                active['most'] = max(active['most'], active['count'])
+            time.sleep(0.05)
+            with lock:
+                active['count'] -= 1
+            if url.endswith("error"):
+                raise IOError("Could not get %s" % url)
+            return 200, {}, "Content of %s" % url
+
+        fetcher = ConcurrentFetcher(do_get, max_workers=4, max_per_host=2)
+        urls = ["http://host/%d" % i for i in range(4)]
+        for url in urls:
+            fetcher.prefetch(url, {"If-None-Match" : "etag"})
+
+        # Responses to prefetched requests are handed out when they're
+        # asked for.
+        for url in urls:
+            eq_((200, {}, "Content of %s" % url),
+                fetcher.get(url, {"If-None-Match" : "etag"}))
+
+        # No more than two requests were made to one host at a time.
+        assert active['most'] <= 2
+
+        # An exception raised by a prefetched request is raised when
+        # its response is asked for.
+        fetcher.prefetch("http://other/error")
+        assert_raises_regexp(
+            IOError, "Could not get", fetcher.get, "http://other/error", {}
+        )
+        eq_(5, len(requests))
+
+        # A request that wasn't prefetched, or was prefetched with
+        # different headers, is made immediately.
+        fetcher.prefetch("http://host/unused")
+        eq_((200, {}, "Content of http://host/unused"),
+            fetcher.get("http://host/unused", {"If-None-Match" : "etag"}))
+        assert ("http://host/unused", {"If-None-Match" : "etag"}) in requests
+
+        # Closing the fetcher returns the responses nobody asked for.
+        eq_([(200, {}, "Content of http://host/unused")], fetcher.close())
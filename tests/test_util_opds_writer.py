@@ -5,6 +5,7 @@ from nose.tools import (
 )
 from lxml import etree
 from util.opds_writer import (
+    AtomFeed,
     OPDSMessage
 )
 
@@ -41,3 +42,38 @@ class TestOPDSMessage(object):
         assert '<simplified:status_code>200</simplified:status_code>' in text
         assert '<schema:description>message</schema:description>' in text
         assert text.endswith('</simplified:message>')
+
+
+class TestAtomFeed(object):
+
+    def test_chunks(self):
+        feed = AtomFeed("Feed title", "http://url/")
+        entries = [
+            AtomFeed.entry(AtomFeed.title("Entry 1")),
+            OPDSMessage("urn", 200, "message"),
+            etree.tostring(AtomFeed.entry(AtomFeed.title("Entry 2"))),
+        ]
+        chunks = list(feed.chunks(entries))
+
+        # The feed is opened, everything already in the feed is
+        # serialized, then the entries, then the feed is closed.
+        assert chunks[0].startswith('<feed ')
+        assert 'xmlns="http://www.w3.org/2005/Atom"' in chunks[0]
+        assert not chunks[0].strip().endswith('/>')
+        eq_(len(feed.feed) + len(entries) + 2, len(chunks))
+        assert '<title>Feed title</title>' in chunks[2]
+        assert 'Entry 1' in chunks[-4]
+        assert '<simplified:message' in chunks[-3]
+        eq_(entries[-1] + "\n", chunks[-2])
+        eq_("</feed>\n", chunks[-1])
+
+        # The entries were not added to the feed itself.
+        eq_(4, len(feed.feed))
+
+        # The chunks make up a well-formed document.
+        parsed = etree.fromstring("".join(chunks))
+        eq_(2, len(parsed.findall("{%s}entry" % AtomFeed.ATOM_NS)))
+        eq_(
+            ["Feed title", "Entry 1", "Entry 2"],
+            [x.text for x in parsed.iter("{%s}title" % AtomFeed.ATOM_NS)]
+        )
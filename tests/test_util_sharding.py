@@ -0,0 +1,40 @@
+from nose.tools import (
+    eq_,
+    set_trace,
+)
+
+from util.sharding import (
+    id_ranges,
+    run_in_processes,
+)
+
+
+def _succeed(value):
+    pass
+
+def _fail(value):
+    raise Exception(value)
+
+
+class TestIDRanges(object):
+
+    def test_id_ranges(self):
+        eq_([(0, 25), (25, 50), (50, 75), (75, 100)], id_ranges(100, 4))
+
+        # The last range may be smaller than the others.
+        eq_([(0, 4), (4, 8), (8, 10)], id_ranges(10, 3))
+
+        # There may be fewer ranges than requested, but never
+        # an empty range.
+        eq_([(0, 1), (1, 2)], id_ranges(2, 5))
+        eq_([], id_ranges(0, 5))
+        eq_([(0, 10)], id_ranges(10, 0))
+
+
+class TestRunInProcesses(object):
+
+    def test_exit_codes(self):
+        eq_([0, 0], run_in_processes(_succeed, [(1,), (2,)]))
+
+        codes = run_in_processes(_fail, [("oops",)])
+        assert codes[0] != 0
@@ -43,6 +43,7 @@ from metadata_layer import (
 
 from util.http import HTTP
 from util.xmlparser import XMLParser
+from rate_limit import RateLimiter
 
 class ThreeMAPI(object):
 
@@ -66,6 +67,9 @@ class ThreeMAPI(object):
         self.version = version
         self.base_url = base_url
         self.item_list_parser = ItemListParser()
+        self.rate_limiter = RateLimiter.for_integration(
+            Configuration.THREEM_INTEGRATION
+        )
 
         if testing:
             return
@@ -197,11 +201,15 @@ class ThreeMAPI(object):
 
     def _request_with_timeout(self, method, url, *args, **kwargs):
         """This will be overridden in MockThreeMAPI."""
-        return HTTP.request_with_timeout(method, url, *args, **kwargs)
+        return HTTP.request_with_timeout(
+            method, url, *args, rate_limiter=self.rate_limiter, **kwargs
+        )
 
     def _simple_http_get(self, url, headers, *args, **kwargs):
         """This will be overridden in MockThreeMAPI."""
-        return Representation.simple_http_get(url, headers, *args, **kwargs)
+        return Representation.simple_http_get(
+            url, headers, *args, rate_limiter=self.rate_limiter, **kwargs
+        )
 
 
 class MockThreeMAPI(ThreeMAPI):
@@ -6,6 +6,7 @@ from collections import (
     Counter,
     defaultdict,
 )
+import json
 import pkgutil
 import os
 import re
@@ -38,6 +39,21 @@ def fast_query_count(query):
     count = query.session.execute(count_q).scalar()
     return count
 
+def estimate_query_count(query):
+    """Ask the database's query planner how many results a query will
+    return, without actually running it.
+
+    This is very fast but can be wildly inaccurate.
+    """
+    connection = query.session.connection()
+    compiled = query.statement.compile(dialect=connection.dialect)
+    [[plan]] = connection.execute(
+        "EXPLAIN (FORMAT JSON) " + unicode(compiled), compiled.params
+    ).fetchall()
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+    return plan[0]['Plan']['Plan Rows']
+
 
 class LanguageCodes(object):
     """Convert between ISO-639-2 and ISO-693-1 language codes.
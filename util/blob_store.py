@@ -0,0 +1,115 @@
+"""Store large documents on disk, named after their contents."""
+import hashlib
+import os
+import re
+import tempfile
+
+from nose.tools import set_trace
+
+
+class LocalBlobStore(object):
+    """Keep large documents in files beneath a directory.
+
+    Each document is stored under a key derived from a hash of its
+    contents, so a document that's stored twice only takes up space
+    once.
+
+    Since a document may be shared, the store doesn't know when it's
+    no longer needed. Whoever keeps track of the keys has to remove
+    the documents nothing refers to.
+    """
+
+    # What key_for's keys look like.
+    KEY = re.compile("^[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}$")
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def key_for(self, content):
+        digest = hashlib.sha256(content).hexdigest()
+        return "%s/%s/%s" % (digest[:2], digest[2:4], digest)
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def put(self, content):
+        """Store a document.
+
+        :return: The key under which the document can be retrieved.
+        """
+        key = self.key_for(content)
+        path = self.path(key)
+        if os.path.exists(path):
+            # We already have this document. Mark it as recently
+            # stored, so it isn't removed as unused before whoever
+            # stored it has had a chance to record the key.
+            os.utime(path, None)
+            return key
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            # The directory already exists.
+            pass
+
+        # Write to a temporary file and rename it, so that no one ever
+        # sees a partially written document.
+        fd, temporary_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                fh.write(content)
+            os.rename(temporary_path, path)
+        except Exception, e:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+        return key
+
+    def open(self, key):
+        """Return an open filehandle to the document stored under `key`."""
+        return open(self.path(key), "rb")
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def remove(self, key, stored_before=None):
+        """Delete the document stored under `key`, if there is one.
+
+        :param stored_before: Only delete the document if it was last
+        stored before this Unix timestamp.
+
+        :return: True if the document was deleted.
+        """
+        path = self.path(key)
+        try:
+            if (stored_before is not None
+                and os.path.getmtime(path) >= stored_before):
+                return False
+            os.remove(path)
+        except OSError, e:
+            # There's no such document.
+            return False
+        return True
+
+    def keys(self, stored_before=None):
+        """Yield the key of every document in the store.
+
+        :param stored_before: Only yield the keys of documents last
+        stored before this Unix timestamp.
+        """
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                key = os.path.relpath(path, self.directory)
+                if not self.KEY.match(key):
+                    # This is a document that's still being written.
+                    continue
+                if stored_before is not None:
+                    try:
+                        stored_at = os.path.getmtime(path)
+                    except OSError, e:
+                        # The document was removed in the meantime.
+                        continue
+                    if stored_at >= stored_before:
+                        continue
+                yield key
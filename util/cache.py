@@ -0,0 +1,69 @@
+"""Simple in-process caches."""
+from collections import OrderedDict
+import threading
+
+from nose.tools import set_trace
+
+
+class LRUCache(object):
+    """A thread-safe cache that discards the least recently used items
+    once it gets too big.
+
+    The cache is bounded by the total size of the items it contains,
+    as measured by `sizeof`, and optionally by the number of items.
+    """
+
+    def __init__(self, max_size, max_items=None, sizeof=len):
+        self.max_size = max_size
+        self.max_items = max_items
+        self.sizeof = sizeof
+        self.size = 0
+        self._items = OrderedDict()
+        self._sizes = dict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        """Look up an item, marking it as the most recently used."""
+        with self._lock:
+            if key not in self._items:
+                return default
+            value = self._items.pop(key)
+            self._items[key] = value
+            return value
+
+    def set(self, key, value):
+        """Store an item, evicting older items if necessary.
+
+        An item that's bigger than the entire cache is not stored.
+        """
+        size = self.sizeof(value)
+        with self._lock:
+            self.invalidate(key)
+            if size > self.max_size:
+                return
+            self._items[key] = value
+            self._sizes[key] = size
+            self.size += size
+            while (self.size > self.max_size
+                   or (self.max_items and len(self._items) > self.max_items)):
+                oldest = next(iter(self._items))
+                self.invalidate(oldest)
+
+    def invalidate(self, key):
+        """Remove an item from the cache, if it's there."""
+        with self._lock:
+            if key in self._items:
+                del self._items[key]
+                self.size -= self._sizes.pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._sizes.clear()
+            self.size = 0
@@ -1,5 +1,12 @@
 from nose.tools import set_trace
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+import os
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+import threading
+import time
 import urlparse
 from flask.ext.babel import lazy_gettext as _
 from problem_detail import ProblemDetail as pd
@@ -120,8 +127,157 @@ class RequestTimedOut(RequestNetworkException, requests.exceptions.Timeout):
     internal_message = "Timeout accessing %s: %s"
 
 
+class HostLatency(object):
+    """How long requests to one host have been taking."""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def add(self, elapsed, error=False):
+        self.requests += 1
+        if error:
+            self.errors += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+
+    @property
+    def mean_time(self):
+        if not self.requests:
+            return 0
+        return self.total_time / self.requests
+
+    def as_dict(self):
+        return dict(
+            requests=self.requests, errors=self.errors,
+            mean_time=self.mean_time, max_time=self.max_time,
+        )
+
+
 class HTTP(object):
-    """A helper for the `requests` module."""
+    """A helper for the `requests` module.
+
+    Requests are made through a requests Session, one per thread.
+    The Sessions in a process share one set of connection pools, so
+    connections to each host are kept open between requests no
+    matter which thread makes them.
+    """
+
+    # How many connections to keep open to any one host.
+    DEFAULT_POOL_SIZE = 10
+
+    # How many times to retry a request that couldn't connect, or
+    # an idempotent request that got one of these status codes.
+    DEFAULT_MAX_RETRIES = 2
+    RETRY_STATUS_CODES = [502, 503, 504]
+
+    # Retries wait 0, 2*x, 4*x... seconds, where x is this number.
+    RETRY_BACKOFF_FACTOR = 0.5
+
+    _sessions = threading.local()
+
+    _adapters = {}
+    _adapters_lock = threading.Lock()
+
+    _latency = defaultdict(HostLatency)
+    _latency_lock = threading.Lock()
+
+    @classmethod
+    def session(cls, retry_status=True):
+        """The requests Session to be used by this thread.
+
+        :param retry_status: If False, the session won't retry a
+        request because of the status code of its response. A request
+        whose rate is being limited leaves that to its RateLimiter.
+        """
+        if getattr(cls._sessions, 'pid', None) != os.getpid():
+            # A process forked from this one mustn't use its parent's
+            # connections.
+            cls._sessions.by_retry_status = {}
+            cls._sessions.pid = os.getpid()
+        sessions = cls._sessions.by_retry_status
+        if retry_status not in sessions:
+            sessions[retry_status] = cls._create_session(retry_status)
+        return sessions[retry_status]
+
+    @classmethod
+    def _create_session(cls, retry_status=True):
+        adapter = cls._adapter(retry_status)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    @classmethod
+    def _adapter(cls, retry_status=True):
+        """The HTTPAdapter, and so the connection pools, shared by
+        every Session in this process.
+        """
+        # A process forked from this one mustn't use its parent's
+        # connections.
+        key = (os.getpid(), retry_status)
+        with cls._adapters_lock:
+            if key not in cls._adapters:
+                cls._adapters[key] = cls._create_adapter(retry_status)
+            return cls._adapters[key]
+
+    @classmethod
+    def _create_adapter(cls, retry_status=True):
+        pool_size = cls.DEFAULT_POOL_SIZE
+        max_retries = cls.DEFAULT_MAX_RETRIES
+        try:
+            from config import Configuration
+            pool_size = Configuration.http_pool_size()
+            max_retries = Configuration.http_max_retries()
+        except (ImportError, ValueError), e:
+            # No configuration has been loaded. Use the defaults.
+            pass
+
+        status_forcelist = []
+        if retry_status:
+            status_forcelist = cls.RETRY_STATUS_CODES
+        retry = Retry(
+            total=max_retries, read=0,
+            status_forcelist=status_forcelist,
+            backoff_factor=cls.RETRY_BACKOFF_FACTOR,
+            # A server can ask for an arbitrarily long wait, which
+            # would hold up whoever is waiting on this request.
+            respect_retry_after_header=False,
+            # If the retries run out, let _process_response decide
+            # what to do with the final response.
+            raise_on_status=False,
+        )
+        return HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size,
+            max_retries=retry
+        )
+
+    @classmethod
+    def latency_statistics(cls):
+        """How long requests to each host have been taking.
+
+        :return: A dictionary mapping each host to a dictionary with
+        the number of requests made, how many of them failed, and the
+        mean and maximum time taken, in seconds.
+        """
+        with cls._latency_lock:
+            return dict(
+                (host, latency.as_dict())
+                for host, latency in cls._latency.items()
+            )
+
+    @classmethod
+    def reset_latency_statistics(cls):
+        with cls._latency_lock:
+            cls._latency.clear()
+
+    @classmethod
+    def _record_latency(cls, url, elapsed, error=False):
+        host = urlparse.urlparse(url).netloc
+        with cls._latency_lock:
+            cls._latency[host].add(elapsed, error)
 
     @classmethod
     def get_with_timeout(cls, url, *args, **kwargs):
@@ -136,12 +292,20 @@ class HTTP(object):
 
     @classmethod
     def request_with_timeout(cls, http_method, url, *args, **kwargs):
-        """Call requests.request and turn a timeout into a RequestTimedOut
-        exception.
+        """Make a request through this thread's Session and turn a
+        timeout into a RequestTimedOut exception.
         """
-        return cls._request_with_timeout(
-            url, requests.request, http_method, url, *args, **kwargs
-        )
+        session = cls.session(retry_status=not kwargs.get('rate_limiter'))
+        try:
+            return cls._request_with_timeout(
+                url, session.request, http_method, url, *args, **kwargs
+            )
+        finally:
+            # The Session is reused for every request this thread
+            # makes. Cookies set along the way, e.g. by a response in
+            # the middle of a redirect chain, mustn't be sent with
+            # the next one.
+            session.cookies.clear()
 
     @classmethod
     def _request_with_timeout(cls, url, m, *args, **kwargs):
@@ -149,6 +313,9 @@ class HTTP(object):
         exception.
 
         The core of `request_with_timeout` made easy to test.
+
+        If a `rate_limiter` (see rate_limit.RateLimiter) is passed in,
+        the request waits its turn and its response is reported back.
         """
         allowed_response_codes = kwargs.get('allowed_response_codes')
         if 'allowed_response_codes' in kwargs:
@@ -156,6 +323,7 @@ class HTTP(object):
         disallowed_response_codes = kwargs.get('disallowed_response_codes')
         if 'disallowed_response_codes' in kwargs:
             del kwargs['disallowed_response_codes']
+        rate_limiter = kwargs.pop('rate_limiter', None)
 
         if not 'timeout' in kwargs:
             kwargs['timeout'] = 20
@@ -175,16 +343,24 @@ class HTTP(object):
                 new_headers[k] = v
             kwargs['headers'] = new_headers
 
+        if rate_limiter:
+            rate_limiter.acquire()
+        start = time.time()
         try:
             response = m(*args, **kwargs)
         except requests.exceptions.Timeout, e:
             # Wrap the requests-specific Timeout exception 
             # in a generic RequestTimedOut exception.
+            cls._record_latency(url, time.time() - start, error=True)
             raise RequestTimedOut(url, e.message)
         except requests.exceptions.RequestException, e:
             # Wrap all other requests-specific exceptions in
             # a generic RequestNetworkException.
+            cls._record_latency(url, time.time() - start, error=True)
             raise RequestNetworkException(url, e.message)
+        cls._record_latency(url, time.time() - start)
+        if rate_limiter:
+            rate_limiter.update(response.status_code, response.headers)
 
         return cls._process_response(
             url, response, allowed_response_codes, disallowed_response_codes
@@ -238,3 +414,76 @@ class HTTP(object):
             )
         return response
 
+
+class ConcurrentFetcher(object):
+    """Make HTTP requests ahead of time in a pool of threads, so that
+    several documents can be downloaded at once.
+
+    Requests are queued up with prefetch(). Then get() can be used in
+    place of the original `do_get` function: it hands out the response
+    to a prefetched request, waiting for it if necessary, and makes
+    any other request immediately.
+
+    No more than `max_per_host` requests are made to any one host at
+    a time.
+    """
+
+    def __init__(self, do_get, max_workers=5, max_per_host=2):
+        self.do_get = do_get
+        self.pool = ThreadPool(max_workers)
+        self.host_limits = defaultdict(
+            lambda: threading.Semaphore(max_per_host)
+        )
+        self.host_limits_lock = threading.Lock()
+        self.results = {}
+
+    @classmethod
+    def _key(cls, url, headers):
+        return url, tuple(sorted((headers or {}).items()))
+
+    def prefetch(self, url, headers=None, do_get=None):
+        """Start making a request in the background.
+
+        :param do_get: Use this function instead of the default to make
+        this request.
+        """
+        key = self._key(url, headers)
+        if key in self.results:
+            return
+        self.results[key] = self.pool.apply_async(
+            self._get, (do_get or self.do_get, url, headers)
+        )
+
+    def _get(self, do_get, url, headers):
+        host = urlparse.urlparse(url).netloc
+        with self.host_limits_lock:
+            limit = self.host_limits[host]
+        with limit:
+            return do_get(url, headers)
+
+    def get(self, url, headers, **kwargs):
+        """Get the response to a request, as `do_get` would.
+
+        If the request was prefetched, any exception raised while
+        making it is raised here.
+        """
+        result = self.results.pop(self._key(url, headers), None)
+        if result is None:
+            return self.do_get(url, headers, **kwargs)
+        return result.get()
+
+    def close(self):
+        """Wait for all outstanding requests to finish and shut down
+        the thread pool.
+
+        :return: A list of the responses to prefetched requests that
+        were never asked for.
+        """
+        self.pool.close()
+        self.pool.join()
+        unused = []
+        for result in self.results.values():
+            if result.successful():
+                unused.append(result.get())
+        self.results = {}
+        return unused
@@ -137,6 +137,52 @@ class AtomFeed(object):
         string_tree = etree.tostring(self.feed, pretty_print=True)
         return string_tree.encode("utf8")
 
+    def chunks(self, entries=None):
+        """Serialize this feed incrementally.
+
+        Yields the opening <feed> tag, each element already in the
+        feed, each element of `entries` as it is produced, and finally
+        the closing tag. Strings in `entries` are taken to be
+        serialized elements and are passed through as-is. The elements
+        of `entries` are never attached to the feed, so they can be
+        released as soon as they have been serialized.
+
+        Joining the chunks gives a document equivalent to
+        unicode(feed), except that elements already in the feed come
+        before the elements of `entries`.
+        """
+        if self.feed is None:
+            return
+
+        # lxml serializes a childless element as <feed ... />, so
+        # reopen it to get a start tag.
+        shell = etree.Element(
+            self.feed.tag, dict(self.feed.attrib), nsmap=self.feed.nsmap
+        )
+        start_tag = etree.tostring(shell)
+        start_tag = start_tag[:-2].rstrip() + ">"
+        tag_name = start_tag[1:].split(None, 1)[0].rstrip(">")
+        yield start_tag + "\n"
+
+        for element in self.feed:
+            yield self._serialize_chunk(element)
+
+        for element in entries or []:
+            yield self._serialize_chunk(element)
+
+        yield "</%s>\n" % tag_name
+
+    @classmethod
+    def _serialize_chunk(cls, element):
+        if isinstance(element, basestring):
+            # Already serialized.
+            if not element.endswith("\n"):
+                element += "\n"
+            return element
+        if isinstance(element, OPDSMessage):
+            element = element.tag
+        return etree.tostring(element, pretty_print=True, with_tail=False)
+
 
 
 class OPDSFeed(AtomFeed):
@@ -0,0 +1,63 @@
+"""Split a sweep through a database table among several processes."""
+import math
+import multiprocessing
+
+from nose.tools import set_trace
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+
+def id_ranges(highest_id, shards):
+    """Divide the IDs from 1 to `highest_id` into `shards` contiguous
+    ranges of (nearly) equal size.
+
+    :return: A list of (start, end) 2-tuples. Each range contains the
+    IDs greater than `start` and less than or equal to `end`.
+    """
+    shards = max(shards, 1)
+    size = max(int(math.ceil(highest_id / float(shards))), 1)
+    ranges = []
+    start = 0
+    while start < highest_id:
+        end = min(start + size, highest_id)
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+
+def session_for_new_process(_db):
+    """Create a database session for use in a process that was forked
+    from the process that owns `_db`.
+
+    The forked process must not use `_db` (or let it be garbage
+    collected), since its connection to the database is shared with
+    the parent process.
+    """
+    engine = create_engine(_db.get_bind().engine.url)
+    return sessionmaker(bind=engine)()
+
+
+def run_in_processes(target, argument_lists, progress=None,
+                     progress_interval=30):
+    """Call `target` once for each item in `argument_lists`, each call
+    in its own process, and wait for them all to finish.
+
+    :param progress: A function to be called every `progress_interval`
+    seconds while the processes are running.
+
+    :return: A list of the processes' exit codes.
+    """
+    processes = [
+        multiprocessing.Process(target=target, args=args)
+        for args in argument_lists
+    ]
+    for process in processes:
+        process.start()
+    while True:
+        running = [x for x in processes if x.is_alive()]
+        if not running:
+            break
+        running[0].join(progress_interval)
+        if progress and running[0].is_alive():
+            progress()
+    return [x.exitcode for x in processes]